@@ -16,50 +16,64 @@
 
 """
 Script for downloading data for all language pairs from https://data.statmt.org/cc-matrix/
-The data (849GB) is saved in the local directory raw_data/ and takes ~2.5 hrs to run on an i4i.32xlarge instance
+The data (849GB) is saved in the local directory raw_data/ and took ~2.5 hrs to run on an i4i.32xlarge instance with one wget per language pair.
+Files are now fetched as concurrent byte ranges (see downloader.py), interrupted downloads resume from the last completed range,
+and the size and sha256 of every file is recorded in raw_data/manifest.json.
+Run with --verify to re-check all downloaded files against the manifest.
 """
 
-import multiprocessing as mp
-import os.path
+import argparse
 import pathlib
-import subprocess as sp
 import sys
-from time import time
 
 sys.path.append("../")
 
 from ccmatrix_utils.ccmatrix_langpairs import CCMATRIX_LANG_PAIRS
-from config import TESTING, exclude_num, gz_dir
+from config import (
+    TESTING,
+    download_connections,
+    download_range_size,
+    exclude_num,
+    gz_dir,
+    manifest_file,
+    raw_url,
+)
+from downloader import download_files, load_manifest, verify_file
+from scheduler import lpt_order, pair_costs
 
 
-def download(lang_pair):
-    lang0, lang1 = lang_pair.split("-")  # in alphabetical order
-    print("langs:", lang0, lang1, flush=True)
-    pathlib.Path(gz_dir).mkdir(parents=True, exist_ok=True)
-
-    gz_file = f"{gz_dir}/{lang0}-{lang1}.tsv.gz"
-    if os.path.isfile(gz_file):
-        print(f"using already downloaded {gz_file}", flush=True)
-    else:
-        print("downloading data", flush=True)
-        t0 = time()
-        sp.check_call(
-            f"wget --progress=bar:force:noscroll https://data.statmt.org/cc-matrix/{lang0}-{lang1}.bitextf.tsv.gz -O {gz_file}.part",
-            shell=True,
-        )
-        sp.check_call(f"mv {gz_file}.part {gz_file}", shell=True)
-        t1 = time()
-        print(f"downloaded {gz_file} in {t1 - t0:.1f}s", flush=True)
+def url_and_dest(lang_pair):
+    return raw_url(lang_pair), f"{gz_dir}/{lang_pair}.tsv.gz"
 
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser("Download CCMatrix")
+    parser.add_argument(
+        "--verify",
+        action="store_true",
+        help="check size and sha256 of downloaded files against the manifest instead of downloading",
+    )
+    args = parser.parse_args()
+
     lang_pairs = CCMATRIX_LANG_PAIRS
     if TESTING:  # if testing, exlude some higher resource language pairs
         lang_pairs = lang_pairs[exclude_num:]
 
-    num_cpus = mp.cpu_count()
+    pathlib.Path(gz_dir).mkdir(parents=True, exist_ok=True)
+    # largest files first, so their ranges are not the last ones left in flight
+    costs = pair_costs(lang_pairs, use_file_sizes=False)
+    jobs = [url_and_dest(lang_pairs[ii]) for ii in lpt_order(costs)]
 
-    print(f"num language pairs: {len(lang_pairs)}, num cpus: {num_cpus}", flush=True)
+    if args.verify:
+        manifest = load_manifest(manifest_file)
+        bad = [dest for _, dest in jobs if not verify_file(dest, manifest, check_sha256=True)]
+        print(f"{len(jobs) - len(bad):,}/{len(jobs):,} files match the manifest", flush=True)
+        for dest in bad:
+            print(f"missing or corrupt: {dest}", flush=True)
+        sys.exit(1 if bad else 0)
 
-    with mp.Pool(num_cpus) as pool:
-        pool.map(download, lang_pairs)
+    print(
+        f"num language pairs: {len(lang_pairs)}, num connections: {download_connections}",
+        flush=True,
+    )
+    download_files(jobs, manifest_file, download_connections, download_range_size)
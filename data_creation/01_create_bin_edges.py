@@ -14,16 +14,25 @@
 
 
 """
-Create roughly equal sized bins from scores ccmatrix, saves cutoffs in cutoffs.txt
+Create roughly equal sized bins from scores ccmatrix, saves cutoffs in cutoffs.txt and the histogram of quantized scores
+they are computed from in score_hist.npz (see rebin.py)
+
+With score_sample_every = k in config.py only one in k blocks of each block-indexed raw file is read. The lines of a
+sampled block are weighted so that they add up to the lines of the k blocks it stands for. Since the raw files are
+sorted by score, only the k blocks around a cutoff can be on both sides of it. The estimated count below any cutoff is
+therefore off by at most that many lines per lang pair, and since the sampled block of every stratum is random those
+errors mostly cancel out over lang pairs. Both the worst case and the probabilistic bound are reported.
 """
 
-import gzip
 import math
 import multiprocessing as mp
+import random
 import sys
 from collections import Counter
 from time import time
 
+import numpy as np
+
 sys.path.append("../")
 
 from ccmatrix_utils.ccmatrix_langpairs import CCMATRIX_LANG_PAIRS
@@ -33,37 +42,130 @@ from config import (
     cutoffs_file,
     exclude_num,
     gz_dir,
+    kll_k,
     num_score_bins,
+    parse_chunk_size,
+    score_sample_every,
+    score_hist_file,
+    score_sketch,
+    task_bytes,
+)
+from pipeline import raw_chunks, worker_pool
+from scheduler import block_tasks, run_lpt
+from sketches import KLLSketch
+from utils import (
+    legacy_rows,
+    parse_chunk,
+    read_block_index,
+    save_score_hist,
+    score_bin_edges,
+    task_name,
+    write_cutoffs,
 )
 
-
-def get_scores_counter(langpair):
-    scores_count = Counter()
+error_prob = 0.01  # the reported kll error bound holds with probability 1 - error_prob
+
+
+def task_segments(lang_pair, file_path, blocks):
+    """
+    Parts of a task to read, as (block range, lines it stands for, lines it holds), the line counts are None if it
+    stands for itself. Without sampling that is the whole task. With score_sample_every = k the blocks of a file are
+    grouped into strata of k blocks and one block per stratum, chosen at random (seeded by lang pair and stratum), is
+    read and stands for the whole stratum.
+    """
+    if score_sample_every == 1 or blocks is None:
+        return [(blocks, None, None)]
+    index = read_block_index(file_path)
+    segments = []
+    for start in range(blocks[0] - blocks[0] % score_sample_every, blocks[1], score_sample_every):
+        stratum = index[start : start + score_sample_every]
+        ii = start + random.Random(f"{lang_pair}:{start}").randrange(len(stratum))
+        if blocks[0] <= ii < blocks[1]:
+            segments.append(((ii, ii + 1), sum(x[2] for x in stratum), index[ii][2]))
+    return segments
+
+
+def add_counts(scores_count, keys, weights):
+    """
+    Adds the weighted occurrences of every quantized score in keys to a Counter or KLLSketch
+    """
+    if not len(keys):
+        return 0
+    unique_keys, inverse = np.unique(keys, return_inverse=True)
+    counts = np.bincount(inverse, weights=weights).astype(np.int64)
+    if isinstance(scores_count, KLLSketch):
+        for key, count in zip(unique_keys.tolist(), counts.tolist()):
+            scores_count.update(key, count)
+    else:
+        scores_count.update(dict(zip(unique_keys.tolist(), counts.tolist())))
+    return int(counts.sum())
+
+
+def get_scores_counter(task):
+    """
+    Counts quantized scores of a task: (lang pair, block range or None for the whole file)
+    Returns (Counter or KLLSketch of the quantized scores, total rows, lines of the largest sampled stratum or 0,
+    whether the sampled scores were sorted)
+    """
+    langpair, blocks = task
+    scores_count = KLLSketch(kll_k, seed=task_name(langpair, blocks)) if score_sketch == "kll" else Counter()
     total_rows = 0
+    max_stratum = 0
+    is_sorted = True
+    prev = np.zeros(0, dtype=np.int64)  # last regular key seen
+    direction = 0
 
     gz_file = f"{langpair}.tsv.gz"
     file_path = f"{gz_dir}/{gz_file}"
     t0 = time()
-    with gzip.open(file_path, "rt", encoding="utf-8") as csvfile:
-        for ii, line in enumerate(csvfile):
-            row = line.strip().split("\t")
-
-            if ii % 1_000_000 == 0:
+    num_lines = 0
+    for segment, stratum_lines, block_lines in task_segments(langpair, file_path, blocks):
+        if stratum_lines is not None:
+            max_stratum = max(max_stratum, stratum_lines)
+        line_num = 0
+        for data in raw_chunks(file_path, segment, parse_chunk_size):
+            starts, ends, _, _, scores, regular = parse_chunk(data)
+            keys = (scores * bin_edge_prec).astype(np.int64)  # int(score * bin_edge_prec) of regular lines
+
+            line_nums = np.arange(line_num, line_num + len(ends), dtype=np.int64)
+            line_num += len(ends)
+            if stratum_lines is None:
+                weights = np.ones_like(line_nums)
+            else:
+                # spread the stratum over the block's lines, integer weights whose running sum stays within 1 of
+                # the exact fractional one
+                weights = (line_nums + 1) * stratum_lines // block_lines - line_nums * stratum_lines // block_lines
+
+                steps = np.sign(np.diff(np.concatenate([prev, keys[regular]])))
+                steps = steps[steps != 0]
+                if len(steps):
+                    if (steps != steps[0]).any() or (direction and steps[0] != direction):
+                        is_sorted = False
+                    direction = steps[-1]
+                prev = keys[regular][-1:] if regular.any() else prev
+
+            other_keys = []
+            other_weights = []
+            for ii in np.flatnonzero(~regular).tolist():
+                for row in legacy_rows(data[starts[ii] : ends[ii] + 1]):
+                    if len(row) != 3:
+                        print("BAD ROW:", row, flush=True)
+                        continue
+                    other_keys.append(int(float(row[0]) * bin_edge_prec))
+                    other_weights.append(weights[ii])
+
+            total_rows += add_counts(scores_count, keys[regular], weights[regular])
+            total_rows += add_counts(scores_count, np.array(other_keys, dtype=np.int64), other_weights)
+
+            if (num_lines + len(ends)) // 1_000_000 > num_lines // 1_000_000:
                 print(
-                    f"processed {ii:,} lines of {langpair} in {time() - t0:.1f}s",
+                    f"processed {num_lines + len(ends):,} lines of {task_name(langpair, blocks)} in {time() - t0:.1f}s",
                     flush=True,
                 )
-
-            if len(row) != 3:
-                print("BAD ROW:", row, flush=True)
-                continue
-            score = row[0]
-            score_bucket = int(float(score) * bin_edge_prec)
-            scores_count[score_bucket] += 1
-            total_rows += 1
+            num_lines += len(ends)
 
     print(f"all lines processed in {time() - t0:.1f}s", flush=True)
-    return scores_count, total_rows
+    return scores_count, total_rows, max_stratum, is_sorted
 
 
 if __name__ == "__main__":
@@ -75,47 +177,59 @@ if __name__ == "__main__":
 
     num_cpus = mp.cpu_count()
 
-    with mp.Pool(num_cpus) as pool:
-        counter_total = pool.map(get_scores_counter, lang_pairs)
+    tasks, costs = block_tasks(lang_pairs, task_bytes, sample_every=score_sample_every)
+    print(f"num language pairs: {len(lang_pairs)}, num tasks: {len(tasks)}", flush=True)
+
+    with worker_pool(num_cpus) as pool:
+        counter_total = run_lpt(pool, get_scores_counter, tasks, costs, num_cpus)
 
+        sketch = KLLSketch(kll_k) if score_sketch == "kll" else None
         scores_count = Counter()
         total_rows = 0
-        for ii, val in enumerate(counter_total):
-            scores_count.update(val[0])
+        pair_max_stratum = Counter()
+        unsorted = set()
+        for (langpair, _), val in zip(tasks, counter_total):
+            if sketch is not None:
+                sketch.merge(val[0])
+            else:
+                scores_count.update(val[0])
             total_rows += val[1]
-
-    rows_per_bin = math.ceil(
-        total_rows / num_score_bins
-    )  # this is approximate since the distribution for each score is not uniform
+            pair_max_stratum[langpair] = max(pair_max_stratum[langpair], val[2])
+            if not val[3]:
+                unsorted.add(langpair)
+        if sketch is not None:
+            scores_count = sketch.to_counter()
 
     print(f"Total rows: {total_rows}")
-    print(f"Rows per bin: {rows_per_bin}")
-
-    all_scores = list(scores_count.keys())
-    all_scores.sort()
-
-    bin_edges = {}
-    rows_in_bin = 0
-    for ii, score in enumerate(
-        all_scores
-    ):  # we may end up with more than num_score_bins but this will ensure no bin has disproportionately high examples
-        if ii == len(all_scores) - 1:  # last score
-            bin_edges[score] = rows_in_bin + scores_count[score]
-        elif rows_in_bin + scores_count[score] > rows_per_bin:
-            bin_edges[score] = rows_in_bin
-            rows_in_bin = scores_count[score]
-        else:
-            rows_in_bin += scores_count[score]
-
-    print(f"Number of bins: {len(bin_edges)}", flush=True)
-
-    edges = list(bin_edges.keys())
+
+    edges = score_bin_edges(scores_count, total_rows, num_score_bins)
     cutoffs = [x / bin_edge_prec for x in edges]
-    cutoffs.sort()
-    cutoffs.pop()
 
-    with open(cutoffs_file, "w") as fw:
-        for c in cutoffs:
-            fw.write(f"{c}\n")
+    write_cutoffs(cutoffs_file, cutoffs)
+    save_score_hist(
+        score_hist_file, scores_count, bin_edge_prec, exact=score_sample_every == 1 and sketch is None
+    )
+
+    rows_per_bin = max(1, math.ceil(total_rows / num_score_bins))
+    if score_sample_every > 1 or sketch is not None:
+        if unsorted:
+            print(
+                f"WARNING: sampled scores of {sorted(unsorted)} are not sorted, the sampling error is not bounded",
+                flush=True,
+            )
+        strata = [lines + 1 for lines in pair_max_stratum.values() if lines]  # + 1 for rounding the weights
+        num_queries = max(1, len(edges))
+        # Hoeffding: the error of each lang pair is within +-its stratum, with mean about zero
+        sampling_error = min(
+            sum(strata), math.sqrt(2 * sum(x**2 for x in strata) * math.log(2 * num_queries / error_prob))
+        )
+        sketch_error = 0 if sketch is None else sketch.error_bound(error_prob, num_queries)
+        error = sampling_error + sketch_error
+        print(
+            f"Rows below each cutoff are within {error:,.0f} of the exact count ({error / rows_per_bin:.2%} of a bin) "
+            f"with probability {1 - ((score_sample_every > 1) + (sketch is not None)) * error_prob:.0%}: sampling {sampling_error:,.0f} "
+            f"(worst case {sum(strata):,}), sketch {sketch_error:,.0f}",
+            flush=True,
+        )
 
     print(f"Created {len(cutoffs)} cutoffs in {time()-t0}s", flush=True)
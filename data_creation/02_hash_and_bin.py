@@ -15,85 +15,562 @@
 
 """
 Parses the raw CCMatrix bitext data, hashes each sentence and stores it in a subdirectory corresponding to its margin score bin.
+
+If stream_ingest is set in config.py, the raw data is streamed from ccmatrix_url and decompressed on the fly instead of
+being read from gz_dir, so 00_download_data.py does not need to run. With stream_keep_text, the text is also stored in
+gz_dir (block-indexed, see transcode_blocks.py) for 04_build_hash2sent.py.
+
+Sentences are hashed (with sentence_hash in config.py, recorded in binned_data/hash_manifest.json) as the UTF-8 bytes
+of the raw data, which gives the same hashes as hashing the decoded text. Only
+lines that would split differently after decoding (see utils.parse_chunk) are decoded, invalid UTF-8 is handled
+according to invalid_utf8 in config.py.
+
+With bin_layout = "containers" the bin files of all lang pairs are merged at the end into one container per score bin
+(see utils.bin_segments), so 03_build_table.py reads a few large files instead of one small file per lang pair and bin.
+
+--lang-pairs hashes and bins only the given lang pairs, into --bin-dir, e.g. for update_table.py.
 """
 
+import argparse
 import gzip
 import multiprocessing as mp
 import os.path
 import pathlib
+import shutil
 import subprocess as sp
 import sys
+from collections import Counter
+from glob import glob
 from time import time
 
+import numpy as np
+
 sys.path.append("../")
 
 from ccmatrix_utils.ccmatrix_langpairs import CCMATRIX_LANG_PAIRS
-from config import TESTING, bin_dir, cutoffs, exclude_num, find_bin, gz_dir
-from utils import myhash
+from config import (
+    TESTING,
+    bin_dir,
+    bin_buffer_rows,
+    bin_edge_prec,
+    bin_layout,
+    block_compresslevel,
+    block_size,
+    cutoffs,
+    cutoffs_file,
+    exclude_num,
+    find_bin,
+    fused_binning,
+    gz_dir,
+    hll_p,
+    hll_sketch_file,
+    invalid_utf8,
+    locator_dir,
+    num_score_bins,
+    parse_chunk_size,
+    pre_dedup,
+    raw_url,
+    score_hist_file,
+    score_key,
+    sentence_hash,
+    sentence_locators,
+    stream_ingest,
+    stream_keep_text,
+    task_bytes,
+)
+from cykhash import Int64Set, Int64toInt64Map, Int64toInt64Map_from_buffers, Int64toInt64Map_to, isin_int64
+from downloader import open_stream
+from pipeline import raw_chunks, worker_pool
+from scheduler import block_tasks, pair_costs, run_lpt
+from sketches import HyperLogLog, load_hll_sketches, save_hll_sketches
+from utils import (
+    BinWriter,
+    BlockWriter,
+    bin_file,
+    block_index_file,
+    check_hash_manifest,
+    container_files,
+    digests_to_int64,
+    get_sentence_hash,
+    hash_pair_dtype,
+    invalid_lines,
+    legacy_rows,
+    locator_block_bits,
+    locator_dtype,
+    locator_file,
+    locator_line_bits,
+    pack_locators,
+    read_hash_manifest,
+    parse_chunk,
+    read_block_index,
+    read_chunks,
+    save_score_hist,
+    score_bin_edges,
+    score_keys,
+    scored_dtype,
+    task_name,
+    text_errors,
+    write_container_index,
+    write_cutoffs,
+    write_hash_manifest,
+)
+
+hash_one, hash_batch = get_sentence_hash(sentence_hash)
+cutoffs_array = np.array(cutoffs, dtype=np.float64)
+
+
+def seen_before(seen, hashes, keys):
+    """
+    For records (hash, key) in raw data order: marks the ones whose hash already occurred with a key at least as high,
+    in seen (hash -> highest key so far, updated with the records) or earlier in hashes
+    """
+    num = len(hashes)
+    if not num:
+        return np.zeros(0, dtype=bool)
+    hashes = np.ascontiguousarray(hashes, dtype=np.int64)
+    before = np.empty(num, dtype=np.int64)
+    Int64toInt64Map_to(seen, hashes, before, stop_at_unknown=False, default_value=np.iinfo(np.int64).min)
+
+    # highest key of the earlier records with the same hash: running maximum of the key ranks over the records sorted
+    # by hash, with the groups of equal hashes offset so they do not mix
+    order = np.argsort(hashes, kind="stable")
+    sorted_hashes = hashes[order]
+    before = before[order]
+    unique_keys, ranks = np.unique(np.asarray(keys, dtype=np.int64)[order], return_inverse=True)
+    first = np.ones(num, dtype=bool)
+    first[1:] = sorted_hashes[1:] != sorted_hashes[:-1]
+    offsets = (np.cumsum(first) - 1) * len(unique_keys)
+    running = np.maximum.accumulate(ranks + offsets) - offsets
+    earlier = before.copy()
+    later = ~first
+    earlier[later] = np.maximum(before[later], unique_keys[running[:-1][later[1:]]])
+
+    mask = np.empty(num, dtype=bool)
+    mask[order] = earlier >= unique_keys[ranks]
+
+    last = np.append(first[1:], True)
+    seen.update(
+        Int64toInt64Map_from_buffers(sorted_hashes[last], np.maximum(before[last], unique_keys[running[last]]))
+    )
+    return mask
+
 
+def first_occurrences(seen, hashes):
+    """
+    Mask of the hashes that are neither in seen nor earlier in hashes, these are added to seen
+    """
+    _, first = np.unique(hashes, return_index=True)
+    first.sort()
+    known = np.zeros(len(first), dtype=bool)
+    isin_int64(hashes[first], seen, known)
+    first = first[~known]
+    seen.update(hashes[first])
+    mask = np.zeros(len(hashes), dtype=bool)
+    mask[first] = True
+    return mask
 
-def hash_data(lang_pair):
+
+def raw_data_chunks(lang_pair, blocks):
+    """
+    Chunks of the raw data of a task (binary), from gz_dir or streamed from ccmatrix_url
+    """
+    if stream_ingest:
+        with gzip.open(open_stream(raw_url(lang_pair)), "rb") as fin:
+            yield from read_chunks(fin, parse_chunk_size)
+    else:
+        yield from raw_chunks(f"{gz_dir}/{lang_pair}.tsv.gz", blocks, parse_chunk_size)
+
+
+def hash_data(task):
+    """
+    Hashes and bins a task: (lang pair, block range or None for the whole file).
+    A whole file is written to binNNN.bin directly, a block range to binNNN.bin.<start block>.part for merge_parts().
+    With fused_binning, (hash0, hash1, score_key) records are written to scored.<start block>.bin instead, for
+    bin_scored().
+    With sentence_locators, the (hash, locator) of the first occurrence in the task of every sentence is written to
+    locator_dir/<lang pair>/<start block>.<lang>.loc.
+    With pre_dedup, records whose two hashes both occurred earlier in the task with a score bin at least as high are
+    not written: by the time 03_build_table.py reads them, both sentences are in the table already.
+    Returns (Counter of quantized scores with fused_binning else None, number of rows, number of rows dropped,
+    HyperLogLog sketches of the hashes of lang0 and lang1)
+    """
+    lang_pair, blocks = task
     lang0, lang1 = lang_pair.split("-")  # in alphabetical order
-    print("langs:", lang0, lang1, flush=True)
+    print("langs:", lang0, lang1, "blocks:", blocks, flush=True)
 
     outdir = f"{bin_dir}/{lang0}-{lang1}"
     pathlib.Path(outdir).mkdir(parents=True, exist_ok=True)
 
     # open all output files
-    fout = [
-        open(os.path.join(outdir, f"bin{bin_idx:03}.bin.part"), "wb", buffering=2**16)
-        for bin_idx in range(len(cutoffs) + 1)
-    ]
+    if fused_binning:
+        start = 0 if blocks is None else blocks[0]
+        fnames = [os.path.join(outdir, f"scored.{start:07}.bin")]
+        record_dtype = scored_dtype
+        scores_count = Counter()
+    else:
+        suffix = ".part" if blocks is None else f".{blocks[0]:07}.part"
+        fnames = [os.path.join(outdir, f"bin{bin_idx:03}.bin{suffix}") for bin_idx in range(len(cutoffs) + 1)]
+        record_dtype = hash_pair_dtype
+    fout = BinWriter(fnames, record_dtype, bin_buffer_rows)
+
+    def make_records(h0s, h1s, bins):
+        # bins are the score keys with fused_binning
+        records = np.empty(len(h0s), dtype=record_dtype)
+        records["h0"] = digests_to_int64(h0s)
+        records["h1"] = digests_to_int64(h1s)
+        if fused_binning:
+            records["key"] = bins
+        return records
+
+    text_file = None
+    if stream_ingest and stream_keep_text:
+        pathlib.Path(gz_dir).mkdir(parents=True, exist_ok=True)
+        text_file = BlockWriter(
+            f"{gz_dir}/{lang0}-{lang1}.tsv.gz", block_size, block_compresslevel
+        )
+
+    loc_files = None
+    if sentence_locators:
+        first = 0 if blocks is None else blocks[0]
+        index = read_block_index(f"{gz_dir}/{lang_pair}.tsv.gz")
+        stop = len(index) if blocks is None else blocks[1]
+        block_starts = np.cumsum([0] + [block_lines for _, _, block_lines in index[first:stop]])  # task line numbers
+        pair_id = CCMATRIX_LANG_PAIRS.index(lang_pair)
+        pathlib.Path(f"{locator_dir}/{lang_pair}").mkdir(parents=True, exist_ok=True)
+        loc_files = [open(locator_file(locator_dir, lang_pair, first, lang), "wb") for lang in (lang0, lang1)]
+        loc_seen = (Int64Set(), Int64Set())
 
     # process data
-    gz_file = f"{gz_dir}/{lang0}-{lang1}.tsv.gz"
+    errors = text_errors(invalid_utf8)
     t0 = time()
     done = 0
-    with gzip.open(gz_file, "rt", encoding="utf-8") as csvfile:
-        for ii, line in enumerate(csvfile):
-            row = line.strip().split("\t")
-
-            if ii % 1_000_000 == 0:
-                print(
-                    f"processed {ii:,} lines of {lang0}-{lang1} in {time() - t0:.1f}s",
-                    flush=True,
-                )
+    num_lines = 0
+    dropped = 0
+    seen0 = Int64toInt64Map()  # hash -> highest bin (score key with fused_binning) so far, for pre_dedup
+    seen1 = Int64toInt64Map()
+    sketches = (HyperLogLog(hll_p), HyperLogLog(hll_p))  # of the hashes of both languages, for plan_table.py
+    for data in raw_data_chunks(lang_pair, blocks):
+        if text_file is not None:
+            text_file.write(data)
+        starts, ends, tab1, tab2, scores, regular = parse_chunk(data)
+        if invalid_utf8 == "strict":
+            invalid_lines(data, starts, ends, invalid_utf8)  # raises on invalid UTF-8
 
-            if len(row) != 3:
-                print("BAD ROW:", row, flush=True)
-                continue
+        # scores of the whole chunk at once, lines that are not regular are parsed one by one below
+        if fused_binning:
+            bins = score_keys(scores, bin_edge_prec)
+            quantized, counts = np.unique(
+                (scores[regular] * bin_edge_prec).astype(np.int64), return_counts=True
+            )
+            scores_count.update(dict(zip(quantized.tolist(), counts.tolist())))
+        else:
+            bins = np.searchsorted(cutoffs_array, scores, side="left")
 
-            score, src, tgt = row
+        # sentences of regular lines are hashed as the bytes of the raw data, in one batch per chunk
+        tab1_regular = tab1[regular].tolist()
+        tab2_regular = tab2[regular].tolist()
+        regular_bins = bins[regular]
+        record_lines = np.flatnonzero(regular)  # line of every record in the chunk
+        records = make_records(
+            hash_batch([data[t1 + 1 : t2] for t1, t2 in zip(tab1_regular, tab2_regular)]),
+            hash_batch([data[t2 + 1 : end] for t2, end in zip(tab2_regular, ends[regular].tolist())]),
+            regular_bins,
+        )
 
-            score = float(score)
-            h0 = myhash(src)
-            h1 = myhash(tgt)
+        # other lines are parsed one by one, their rows go between the regular ones to keep the raw data order
+        irregular = np.flatnonzero(~regular).tolist()
+        if irregular:
+            pieces = []
+            bin_pieces = []
+            line_pieces = []
+            prev = 0
+            for num_irregular, line_idx in enumerate(irregular):
+                num_regular = line_idx - num_irregular  # regular lines before this one
+                pieces.append(records[prev:num_regular])
+                bin_pieces.append(regular_bins[prev:num_regular])
+                line_pieces.append(record_lines[prev:num_regular])
+                prev = num_regular
 
-            bin_idx = find_bin(score)
-            fout[bin_idx].write(h0)
-            fout[bin_idx].write(h1)
+                h0s, h1s, row_bins = [], [], []
+                for row in legacy_rows(data[starts[line_idx] : ends[line_idx] + 1], errors):
+                    if len(row) != 3:
+                        print("BAD ROW:", row, flush=True)
+                        continue
+                    score, src, tgt = row
+                    score = float(score)
+                    if fused_binning:
+                        scores_count[int(score * bin_edge_prec)] += 1
+                        row_bins.append(score_key(score))
+                    else:
+                        row_bins.append(find_bin(score))
+                    h0s.append(hash_one(src.encode("utf-8", errors)))
+                    h1s.append(hash_one(tgt.encode("utf-8", errors)))
+                pieces.append(make_records(h0s, h1s, row_bins))
+                bin_pieces.append(np.array(row_bins, dtype=regular_bins.dtype))
+                line_pieces.append(np.full(len(row_bins), line_idx, dtype=record_lines.dtype))
+            pieces.append(records[prev:])
+            bin_pieces.append(regular_bins[prev:])
+            line_pieces.append(record_lines[prev:])
+            records = np.concatenate(pieces)
+            regular_bins = np.concatenate(bin_pieces)
+            record_lines = np.concatenate(line_pieces)
 
-            done += 1
+        done += len(records)
+        sketches[0].update(records["h0"])
+        sketches[1].update(records["h1"])
+        if loc_files is not None:
+            lines = record_lines + num_lines
+            block_pos = np.searchsorted(block_starts, lines, side="right") - 1
+            for side, field in enumerate(("h0", "h1")):
+                new = first_occurrences(loc_seen[side], records[field])
+                locators = np.empty(int(new.sum()), dtype=locator_dtype)
+                locators["hash"] = records[field][new]
+                locators["loc"] = pack_locators(
+                    pair_id, side, first + block_pos[new], lines[new] - block_starts[block_pos[new]]
+                )
+                locators.tofile(loc_files[side])
+        if pre_dedup:
+            keys = records["key"] if fused_binning else regular_bins
+            drop = seen_before(seen0, records["h0"], keys) & seen_before(seen1, records["h1"], keys)
+            records = records[~drop]
+            regular_bins = regular_bins[~drop]
+            dropped += int(drop.sum())
 
-    for fh in fout:
-        part_name = fh.name
-        final_name = part_name[: -len(".part")]
-        fh.close()
-        sp.check_call(f"mv {part_name} {final_name}", shell=True)
+        fout.write(records, None if fused_binning else regular_bins)
+
+        if (num_lines + len(ends)) // 1_000_000 > num_lines // 1_000_000:
+            print(
+                f"processed {num_lines + len(ends):,} lines of {task_name(lang_pair, blocks)} in {time() - t0:.1f}s",
+                flush=True,
+            )
+        num_lines += len(ends)
+
+    fout.close()
+    if not fused_binning and blocks is None:
+        for part_name in fnames:
+            final_name = part_name[: -len(".part")]
+            sp.check_call(f"mv {part_name} {final_name}", shell=True)
+
+    if text_file is not None:
+        text_file.close()
+    if loc_files is not None:
+        for loc_file in loc_files:
+            loc_file.close()
 
     print(
-        f"done: processed {done:,} lines of {lang0}-{lang1} in {time() - t0:.1f}s.",
+        f"done: processed {done:,} lines of {task_name(lang_pair, blocks)} in {time() - t0:.1f}s.",
         flush=True,
     )
+    if pre_dedup:
+        print(f"pre_dedup: dropped {dropped:,} of {done:,} records of {task_name(lang_pair, blocks)}", flush=True)
+    return scores_count if fused_binning else None, done, dropped, sketches
+
+
+def bin_scored(task):
+    """
+    Bins the scored records of a lang pair, task: (lang pair, [2 * edge for every bin edge]).
+    The records are read in block order, so the binNNN.bin files are the same as without fused_binning.
+    """
+    lang_pair, key_edges = task
+    outdir = f"{bin_dir}/{lang_pair}"
+    t0 = time()
+
+    fnames = [os.path.join(outdir, f"bin{bin_idx:03}.bin.part") for bin_idx in range(len(key_edges) + 1)]
+    fout = BinWriter(fnames, hash_pair_dtype, bin_buffer_rows)
+    key_edges = np.array(key_edges, dtype=np.int64)
+    done = 0
+    for fname in sorted(glob(f"{outdir}/scored.*.bin")):
+        with open(fname, "rb") as fin:
+            while True:
+                scored = np.fromfile(fin, dtype=scored_dtype, count=parse_chunk_size // scored_dtype.itemsize)
+                if not len(scored):
+                    break
+                records = np.empty(len(scored), dtype=hash_pair_dtype)
+                records["h0"] = scored["h0"]
+                records["h1"] = scored["h1"]
+                fout.write(records, np.searchsorted(key_edges, scored["key"], side="left"))  # find_key_bin()
+                done += len(scored)
+        os.remove(fname)
+
+    fout.close()
+    for part_name in fnames:
+        final_name = part_name[: -len(".part")]
+        sp.check_call(f"mv {part_name} {final_name}", shell=True)
+
+    print(f"done: binned {done:,} records of {lang_pair} in {time() - t0:.1f}s.", flush=True)
+
+
+def merge_parts(lang_pair):
+    """
+    Concatenates the outputs of the block range tasks of a lang pair in block order, giving the same
+    binNNN.bin files as a single task over the whole file
+    """
+    outdir = f"{bin_dir}/{lang_pair}"
+    for bin_idx in range(len(cutoffs) + 1):
+        final_name = os.path.join(outdir, f"bin{bin_idx:03}.bin")
+        parts = sorted(glob(f"{final_name}.*.part"))
+        with open(f"{final_name}.part", "wb") as fout:
+            for part in parts:
+                with open(part, "rb") as fin:
+                    shutil.copyfileobj(fin, fout, 2**20)
+        sp.check_call(f"mv {final_name}.part {final_name}", shell=True)
+        for part in parts:
+            os.remove(part)
+
+
+def build_container(task):
+    """
+    Merges the binNNN.bin files of the lang pairs into the container binned_data/binNNN.bin (see utils.bin_segments)
+    and removes them, task: (bin_idx, lang pairs)
+    """
+    bin_idx, lang_pairs = task
+    container = bin_file(bin_dir, bin_idx)
+    pair_ids = {lang_pair: ii for ii, lang_pair in enumerate(CCMATRIX_LANG_PAIRS)}
+    segments = []
+    offset = 0
+    with open(f"{container}.part", "wb") as fout:
+        for lang_pair in sorted(lang_pairs):
+            fname = bin_file(f"{bin_dir}/{lang_pair}", bin_idx)
+            with open(fname, "rb") as fin:
+                shutil.copyfileobj(fin, fout, 2**20)
+            size = os.stat(fname).st_size
+            segments.append((pair_ids[lang_pair], offset, size // hash_pair_dtype.itemsize))
+            offset += size
+    os.replace(f"{container}.part", container)
+    write_container_index(container, segments)
+    for lang_pair in lang_pairs:
+        os.remove(bin_file(f"{bin_dir}/{lang_pair}", bin_idx))
 
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser("Hash and bin CCMatrix")
+    parser.add_argument("--lang-pairs", nargs="+", help="only these lang pairs, their sketches are merged into the existing ones")
+    parser.add_argument("--bin-dir", default=bin_dir, help="directory of the binned data")
+    args = parser.parse_args()
+    bin_dir = args.bin_dir  # read by the workers, which are forked below
+
     lang_pairs = CCMATRIX_LANG_PAIRS
     if TESTING:
         lang_pairs = lang_pairs[exclude_num:]
+    if args.lang_pairs:
+        unknown_pairs = [lang_pair for lang_pair in args.lang_pairs if lang_pair not in CCMATRIX_LANG_PAIRS]
+        if unknown_pairs:
+            sys.exit(f"unknown lang pairs: {unknown_pairs}")
+        lang_pairs = sorted(args.lang_pairs)
+        if fused_binning:
+            sys.exit("--lang-pairs needs the existing cutoffs, fused_binning would make new ones")
+        if bin_layout == "containers" and container_files(bin_dir):
+            sys.exit(f"the containers in {bin_dir} would only keep --lang-pairs, use another --bin-dir")
+
+    if stream_ingest and not cutoffs and not fused_binning:
+        sys.exit(
+            "streaming needs an existing cutoffs file, 01_create_bin_edges.py cannot run without raw_data"
+        )
+
+    if sentence_locators:
+        for lang_pair in lang_pairs:
+            index = None if stream_ingest else read_block_index(f"{gz_dir}/{lang_pair}.tsv.gz")
+            if not index:
+                sys.exit(f"sentence_locators needs block-indexed raw data, run transcode_blocks.py for {lang_pair}")
+            if len(index) > 2**locator_block_bits or max(lines for _, _, lines in index) >= 2**locator_line_bits:
+                sys.exit(f"{lang_pair} has too many blocks or lines in a block for sentence locators")
+
+    check_hash_manifest(bin_dir, sentence_hash)
+    # 03 with table_mode = "components" needs the records pre_dedup drops, so binned_data says if any are missing
+    dedup = pre_dedup
+    if args.lang_pairs:
+        # the other lang pairs keep their records, None if it is not known how they were made
+        before = False
+        if os.path.isdir(bin_dir) and os.listdir(bin_dir):
+            before = read_hash_manifest(bin_dir).get("pre_dedup")
+        dedup = True if pre_dedup or before else before
+    write_hash_manifest(bin_dir, sentence_hash, **({} if dedup is None else dict(pre_dedup=dedup)))
 
     num_cpus = mp.cpu_count()
     print(f"num language pairs: {len(lang_pairs)}, num cpus: {num_cpus}", flush=True)
 
-    with mp.Pool(num_cpus) as pool:
-        pool.map(hash_data, lang_pairs)
+    tasks, costs = block_tasks(lang_pairs, task_bytes, use_file_sizes=not stream_ingest)
+    split_pairs = sorted({lang_pair for lang_pair, blocks in tasks if blocks is not None})
+    print(f"num tasks: {len(tasks)}, lang pairs split into block ranges: {len(split_pairs)}", flush=True)
+
+    # remove leftovers of an interrupted run, which may have used different block ranges, and old containers
+    for container in container_files(bin_dir):
+        os.remove(container)
+        if os.path.isfile(block_index_file(container)):
+            os.remove(block_index_file(container))
+    for lang_pair in lang_pairs:
+        for part in glob(f"{bin_dir}/{lang_pair}/*.part") + glob(
+            f"{bin_dir}/{lang_pair}/scored.*.bin"
+        ):
+            os.remove(part)
+    if args.lang_pairs:
+        for lang_pair in lang_pairs:
+            shutil.rmtree(f"{locator_dir}/{lang_pair}", ignore_errors=True)
+    else:
+        shutil.rmtree(locator_dir, ignore_errors=True)  # locators of an earlier run do not match the new binned_data
+
+    with worker_pool(num_cpus) as pool:
+        results = run_lpt(pool, hash_data, tasks, costs, num_cpus)
+        total_rows = sum(task_rows for _, task_rows, _, _ in results)
+        if pre_dedup:
+            dropped = sum(task_dropped for _, _, task_dropped, _ in results)
+            print(
+                f"pre_dedup: dropped {dropped:,} of {total_rows:,} records ({dropped / max(total_rows, 1):.1%})",
+                flush=True,
+            )
+
+        # with --lang-pairs the data is added to the table (update_table.py), so the sketches of the existing data
+        # stay and the new ones are merged into them, also for a new release of a lang pair that is in the table
+        pair_sketches = dict()
+        if args.lang_pairs and os.path.isfile(hll_sketch_file):
+            pair_sketches = load_hll_sketches(hll_sketch_file)
+        for (lang_pair, _), (_, _, _, task_sketches) in zip(tasks, results):
+            for lang, sketch in zip(lang_pair.split("-"), task_sketches):
+                name = f"{lang_pair}.{lang}"
+                if name in pair_sketches:
+                    pair_sketches[name].merge(sketch)
+                else:
+                    pair_sketches[name] = sketch
+        save_hll_sketches(hll_sketch_file, pair_sketches)
+        print(f"Saved {hll_sketch_file}, run plan_table.py for the memory needed by 03 and 04", flush=True)
+
+        if fused_binning:
+            scores_count = Counter()
+            for task_count, _, _, _ in results:
+                scores_count.update(task_count)
+            print(f"Total rows: {total_rows}")
+
+            edges = score_bin_edges(scores_count, total_rows, num_score_bins)
+            write_cutoffs(cutoffs_file, [x / bin_edge_prec for x in edges])
+            save_score_hist(score_hist_file, scores_count, bin_edge_prec)
+            print(f"Created {len(edges)} cutoffs", flush=True)
+
+            key_edges = [2 * x for x in edges]
+            run_lpt(
+                pool,
+                bin_scored,
+                [(lang_pair, key_edges) for lang_pair in lang_pairs],
+                pair_costs(lang_pairs, use_file_sizes=not stream_ingest),
+                num_cpus,
+                labels=lang_pairs,
+            )
+            num_bins = len(key_edges) + 1
+        else:
+            run_lpt(pool, merge_parts, split_pairs, pair_costs(split_pairs), num_cpus)
+            num_bins = len(cutoffs) + 1
+
+        if bin_layout == "containers":
+            bin_costs = [
+                sum(os.stat(bin_file(f"{bin_dir}/{lang_pair}", bin_idx)).st_size for lang_pair in lang_pairs)
+                for bin_idx in range(num_bins)
+            ]
+            run_lpt(
+                pool,
+                build_container,
+                [(bin_idx, lang_pairs) for bin_idx in range(num_bins)],
+                bin_costs,
+                num_cpus,
+                labels=[f"bin{bin_idx:03}" for bin_idx in range(num_bins)],
+            )
+            for lang_pair in lang_pairs:
+                os.rmdir(f"{bin_dir}/{lang_pair}")
@@ -15,117 +15,356 @@
 
 """
 Builds the multiway parallel data table
+
+The records of a segment are processed in batches: both hashes of every record are looked up at once, and the rows of
+the records are derived with numpy from what was in the table before the batch. Only records with a hash added by an
+earlier record of the same batch take their row from that record, one by one. The table is the same as adding the
+records one at a time.
+
+A thread reads and prepares the batches ahead (see table_builder.py). With table_shards > 0 the hash maps are split
+over that many processes, which look up the next batch while this process writes the current one. Rows are still
+assigned here, one batch after the other in bin order, so the table does not change. The time every part was busy is
+printed at the end.
+
+With table_checkpoint_seconds > 0 the position in the segments, numrows and the sizes of the output files are saved
+in tables_hashed/checkpoint.pkl between batches. --resume cuts the output files back to a checkpoint, rebuilds the
+maps from them and goes on from there.
+
+With --max-memory the maps are a DiskTable instead: sorted runs on disk plus maps of recent entries that fit in the
+given budget, for hosts without the memory for all languages. The table is the same, the build is slower.
+
+With table_metrics_seconds > 0, counters of the build are written to table_metrics_file as JSON lines (see README).
+
+With table_mode = "components" the rows are the connected components of all records instead (see components.py): the
+maps give every sentence a node id, the records are written to table_edges_file as edges between them, and at the end
+a union-find over the edges finds the components and tables_hashed/<lang>.bin is rewritten with them as rows.
 """
 
+import argparse
+import hashlib
 import os
 import pathlib
 import pickle
 import sys
 from collections import Counter
-from glob import glob
 from time import time
 
+import numpy as np
+
 sys.path.append("../")
 
 from ccmatrix_utils.ccmatrix_langpairs import CCMATRIX_LANGS
-from config import bin_dir, hash2row_dir
-from cykhash import Int64toInt64Map
-from utils import entry_to_row_score, row_score_to_entry
+from components import assign_nodes, components_file, label_rows
+from config import (
+    bin_dir,
+    component_workers,
+    hash2row_dir,
+    sentence_hash,
+    table_checkpoint_seconds,
+    table_edges_file,
+    table_metrics_file,
+    table_metrics_seconds,
+    table_mode,
+    table_plan_file,
+    table_prefetch,
+    table_runs_dir,
+    table_shards,
+    table_store,
+)
+from downloader import dump_json
+from table_builder import (
+    Checkpoints,
+    DiskTable,
+    FlatTable,
+    LocalTable,
+    Metrics,
+    ShardedTable,
+    assign_rows,
+    entry_dtype,
+    load_checkpoint,
+    read_batches,
+    reload,
+    to_entries,
+)
+from utils import (
+    bin_segments,
+    check_hash_manifest,
+    hash_manifest_file,
+    read_hash_manifest,
+    table_capacities,
+    write_hash_manifest,
+)
+
+parser = argparse.ArgumentParser("Build the CCMatrix table")
+parser.add_argument(
+    "--resume", action="store_true", help=f"go on from {hash2row_dir}/checkpoint.pkl if there is one, see README"
+)
+parser.add_argument(
+    "--max-memory",
+    type=float,
+    help=f"GiB for the hash maps: keep them in sorted runs in {table_runs_dir} and only recent entries in memory",
+)
+args = parser.parse_args()
+
+check_hash_manifest(bin_dir, sentence_hash)
+if table_mode not in ("greedy", "components"):
+    raise ValueError(f"unknown table_mode {table_mode}, choose from greedy or components")
+components = table_mode == "components"
+# a record pre_dedup drops changes no greedy row, but it can be the only edge between two components
+binned_dedup = read_hash_manifest(bin_dir).get("pre_dedup")
+if components and binned_dedup:
+    raise SystemExit(f"table_mode components needs every record, but {bin_dir} was made with pre_dedup: run 02 without it")
+if components and binned_dedup is None:
+    raise SystemExit(
+        f"{bin_dir} does not record whether 02_hash_and_bin.py ran with pre_dedup, which table_mode components cannot "
+        f"use: if it did not, add \"pre_dedup\": false to {hash_manifest_file(bin_dir)}"
+    )
+unit = "nodes" if components else "rows"  # what numrows counts until the components are found
+
+read_records = 2**18  # (h0, h1) records read and added at once
 
 numrows = 0
-hash2row = {lang: Int64toInt64Map() for lang in CCMATRIX_LANGS}
+# maps are allocated at their final size if plan_table.py has estimated it, instead of growing by rehashing
+capacities = table_capacities(table_plan_file)
+table_class = {"cykhash": LocalTable, "flat": FlatTable}[table_store]
+if args.max_memory:
+    table = DiskTable(CCMATRIX_LANGS, table_runs_dir, int(args.max_memory * 2**30))
+elif table_shards:
+    table = ShardedTable(CCMATRIX_LANGS, capacities, table_shards, table_class)
+else:
+    table = table_class(CCMATRIX_LANGS, capacities)
 
 t0 = time()
 ii = 0
 
-fnames = glob(f"{bin_dir}/*/*bin")
-fnames.sort(
-    key=lambda x: x.split("/")[-1], reverse=True
-)  # sort from highest score/bin to lowest score/bin
+# from highest score/bin to lowest score/bin, lang pairs in name order within a bin
+segments = bin_segments(bin_dir)
+# a checkpoint is only valid for the same binned data
+segments_digest = hashlib.md5(repr([(b, p, n) for b, p, _, _, n in segments]).encode()).hexdigest()
+
+checkpoint_file = f"{hash2row_dir}/checkpoint.pkl"
+checkpoint = load_checkpoint(checkpoint_file) if args.resume else None
+if args.resume and checkpoint is None:
+    print(f"no {checkpoint_file}, starting from the beginning", flush=True)
+if checkpoint is not None:
+    check_hash_manifest(hash2row_dir, sentence_hash)
+    if checkpoint["segments"] != segments_digest:
+        raise ValueError(f"{checkpoint_file} is from other binned data than {bin_dir}, run without --resume")
 
 # open all output files
 out_files = dict()
 pathlib.Path(f"{hash2row_dir}").mkdir(parents=True, exist_ok=True)
-for lang in CCMATRIX_LANGS:
-    out_files[lang] = open(f"{hash2row_dir}/{lang}.bin", "wb")
-
-
-def add(lang, hh, entry):
-    hash2row[lang][hh] = entry
-    out_files[lang].write(hh.to_bytes(8, byteorder="little", signed=True))
-    out_files[lang].write(entry.to_bytes(8, byteorder="little", signed=True))
+if checkpoint is None:
+    write_hash_manifest(hash2row_dir, sentence_hash)
+    for lang in CCMATRIX_LANGS:
+        out_files[lang] = open(f"{hash2row_dir}/{lang}.bin", "wb")
+    if os.path.exists(components_file(hash2row_dir)):
+        os.remove(components_file(hash2row_dir))
+    # the edges go with the output files into the checkpoints
+    if components:
+        out_files[table_edges_file] = open(table_edges_file, "wb")
+    resume_at = (0, 0)
+else:
+    # drop what was written after the checkpoint, and put the rest back into the maps
+    for lang in CCMATRIX_LANGS:
+        offset = checkpoint["offsets"][lang]
+        out_files[lang] = open(f"{hash2row_dir}/{lang}.bin", "r+b")
+        out_files[lang].truncate(offset)
+        out_files[lang].seek(offset)
+        reload(table, lang, f"{hash2row_dir}/{lang}.bin", offset // entry_dtype.itemsize)
+    if components != (table_edges_file in checkpoint["offsets"]):
+        raise ValueError(f"{checkpoint_file} is not from table_mode {table_mode}, run without --resume")
+    if components:
+        out_files[table_edges_file] = open(table_edges_file, "r+b")
+        out_files[table_edges_file].truncate(checkpoint["offsets"][table_edges_file])
+        out_files[table_edges_file].seek(checkpoint["offsets"][table_edges_file])
+    numrows = checkpoint["numrows"]
+    ii = checkpoint["sent_pairs"]
+    resume_at = checkpoint["position"]
+    print(
+        f"resumed at record {resume_at[1]:,} of segment {resume_at[0] + 1:,}/{len(segments):,} with {numrows:,} {unit} "
+        f"after {ii:,} sent pairs, reloading the maps took {time() - t0:.1f}s",
+        flush=True,
+    )
+checkpoints = Checkpoints(checkpoint_file, table_checkpoint_seconds)
 
 
 def print_sizes():
-    sizes = {lang: len(hash2row[lang]) for lang in CCMATRIX_LANGS}
+    sizes = table.sizes()
     print("unique sentences per language:", Counter(sizes).most_common(), flush=True)
     total_size = sum([v for k, v in sizes.items()])
     print(f"total unique sentences: {total_size:,}", flush=True)
-    print(f"num rows: {numrows:,}", flush=True)
+    print(f"num {unit}: {numrows:,}", flush=True)
+    table_stats = table.stats()
+    if table_stats is not None:
+        print(
+            f"table memory: {table_stats['bytes'] / 2**30:.2f} GiB in {table_stats['slots']:,} slots, "
+            f"load {table_stats['entries'] / table_stats['slots']:.2f}, "
+            f"{table_stats['bytes'] / max(table_stats['entries'], 1):.1f} bytes per entry, "
+            f"{table_stats['resizes']} resizes ({table_stats['resize_seconds']:.1f}s)",
+            flush=True,
+        )
 
 
-for f_ii, fname in enumerate(fnames):
-    num_lines_this_file = os.stat(fname).st_size / (2 * 8)
-    print(
-        f"processing {fname} (lines:{num_lines_this_file}) (file {f_ii + 1:,}/{len(fnames):,}), t={time() - t0:.1f}s",
-        flush=True,
+def print_segments(stop):
+    global next_segment
+    for s_ii in range(next_segment, stop):
+        score_bin, lang_pair, fname, _, num_records = segments[s_ii]
+        print(
+            f"processing {lang_pair} bin {score_bin} of {fname} (lines:{num_records}) (segment {s_ii + 1:,}/{len(segments):,}), t={time() - t0:.1f}s",
+            flush=True,
+        )
+    next_segment = max(next_segment, stop)
+
+
+def metrics_state():
+    # what a line of the metrics has besides the counters
+    return dict(
+        t=round(time() - t0, 3),
+        sent_pairs=ii,
+        rows=numrows,
+        reader_seconds=round(stats["reader"], 3),
+        coordinator_seconds={step: round(value, 3) for step, value in seconds.items()},
+        table=table.stats(),
     )
-    score_bin = int(
-        fname.split("/")[-1].split(".")[0][len("bin") :]
-    )  # bin{bin_idx:03}.bin'
-    lang0, lang1 = fname.split("/")[-2].split("-")
-
-    with open(fname, "rb", buffering=2**16) as fin:
-        while True:
-            ii += 1
-            # convert hashes to int64-compatable int
-            h0 = int.from_bytes(fin.read(8), byteorder="little", signed=True)
-            h1 = int.from_bytes(fin.read(8), byteorder="little", signed=True)
-
-            if not h1:  # end of file
-                break
-
-            # see if hashes allready added
-            h0entry = hash2row[lang0].get(h0)  # get() returns None if not present
-            h1entry = hash2row[lang1].get(h1)
-
-            if h0entry is None and h1entry is None:
-                # new entries, add pair as new row in table
-                new_entry = row_score_to_entry(numrows, score_bin)
-                add(lang0, h0, new_entry)
-                add(lang1, h1, new_entry)
-                numrows += 1
-            elif h0entry is None:
-                # h1 is already in table, add h0 to same row
-                row1, _ = entry_to_row_score(h1entry)
-                entry1 = row_score_to_entry(row1, score_bin)
-                add(lang0, h0, entry1)
-            elif h1entry is None:
-                # h0 is already in table, add h1 to same row
-                row0, _ = entry_to_row_score(h0entry)
-                entry0 = row_score_to_entry(row0, score_bin)
-                add(lang1, h1, entry0)
-            # else they are both already in table (for higher scoring matches), nothing to do
-
-            if ii % 5_000_000 == 0:
-                print(
-                    f"progress: {ii:,} sent pairs ({numrows:,} rows) in {time() - t0:.1f}s. sent_pair/sec::{ii / (time() - t0):.1f}",
-                    flush=True,
-                )
-
-            if ii % 100_000_000 == 0:
-                print_sizes()
 
-# close all output files
-for lang in CCMATRIX_LANGS:
-    out_files[lang].close()
 
-with open(f"{hash2row_dir}/numrows.pkl", "wb") as fout:
-    pickle.dump(numrows, fout)
+next_segment = resume_at[0]
+position = resume_at  # (segment, record) of the next batch
+stats = dict()  # busy seconds of the reader thread
+seconds = dict(wait_table=0.0, assign=0.0, insert=0.0, lookup=0.0, write=0.0, wait_reader=0.0)  # of the coordinator
+metrics = Metrics(table_metrics_file, table_metrics_seconds)
+batches = read_batches(segments, read_records, table_prefetch, stats, resume_at)
+batch = next(batches, None)
+if batch is not None:
+    _, _, lang_pair, h0, h1, _, _ = batch
+    lang0, lang1 = lang_pair.split("-")
+    table.request_lookup(lang0, h0, lang1, h1)
+while batch is not None:
+    s_ii, score_bin, lang_pair, h0, h1, first0, first1 = batch
+    print_segments(s_ii + 1)
+    lang0, lang1 = lang_pair.split("-")
+
+    t1 = time()
+    entries0, missing0, entries1, missing1 = table.wait_lookup()
+    t2 = time()
+    if components:
+        nodes0, nodes1, new0, new1, num_new = assign_nodes(
+            numrows, entries0, missing0, entries1, missing1, first0, first1
+        )
+        entries_new = (to_entries(nodes0, score_bin), to_entries(nodes1, score_bin))
+        edges = np.stack((nodes0, nodes1), axis=1)
+    else:
+        rows, new0, new1, num_new = assign_rows(numrows, entries0, missing0, entries1, missing1, first0, first1)
+        entries_new = (to_entries(rows, score_bin),) * 2
+    numrows += num_new
+    added = []
+    for lang, hashes, new, entries in ((lang0, h0, new0, entries_new[0]), (lang1, h1, new1, entries_new[1])):
+        records = np.empty(int(new.sum()), dtype=entry_dtype)
+        records["hash"] = hashes[new]
+        records["entry"] = entries[new]
+        added.append((lang, records))
+    t3 = time()
+    for lang, records in added:
+        table.insert(lang, np.ascontiguousarray(records["hash"]), np.ascontiguousarray(records["entry"]))
+    t4 = time()
+    seconds["wait_table"] += t2 - t1
+    seconds["assign"] += t3 - t2
+    seconds["insert"] += t4 - t3
+    if metrics.enabled:
+        metrics.count_batch(lang0, new0, lang1, new1)
+
+    prev = ii
+    ii += len(h0)
+    if ii // 5_000_000 > prev // 5_000_000:
+        print(
+            f"progress: {ii:,} sent pairs ({numrows:,} {unit}) in {time() - t0:.1f}s. sent_pair/sec::{ii / (time() - t0):.1f}",
+            flush=True,
+        )
+
+    if ii // 100_000_000 > prev // 100_000_000:
+        print_sizes()
+    # before the next lookup is sent, a ShardedTable answers only one request at a time
+    if metrics.due():
+        metrics.write(metrics_state())
+
+    # the lookups of the next batch run while this one is written
+    t5 = time()
+    batch = next(batches, None)
+    t6 = time()
+    if batch is not None:
+        _, _, next_pair, next_h0, next_h1, _, _ = batch
+        next_lang0, next_lang1 = next_pair.split("-")
+        table.request_lookup(next_lang0, next_h0, next_lang1, next_h1)
+    t7 = time()
+    for lang, records in added:
+        records.tofile(out_files[lang])
+    if components:
+        edges.tofile(out_files[table_edges_file])
+    t8 = time()
+    seconds["wait_reader"] += t6 - t5
+    seconds["lookup"] += t7 - t6
+    seconds["write"] += t8 - t7
+    if metrics.enabled:
+        for lang, records in added:
+            metrics.count_written(lang, records.nbytes)
+        metrics.count_file(segments[s_ii][2], len(h0), t8 - t1 - (t6 - t5))
+
+    position = (s_ii, (position[1] if position[0] == s_ii else 0) + len(h0))
+    if checkpoints.due():
+        checkpoints.save(out_files, dict(segments=segments_digest, position=position, numrows=numrows, sent_pairs=ii))
+print_segments(len(segments))
+
+# close all output files
+checkpoints.wait()
+for fout in out_files.values():
+    fout.close()
 
 print(f"time: {time() - t0:.1f}s", flush=True)
 print(f"num sent pairs: {ii:,}", flush=True)
 print(f"Seconds per sent pair: {(time() - t0) / (ii + .01):.2e}", flush=True)
 print_sizes()
+if capacities:
+    sizes = table.sizes()
+    over = [lang for lang in CCMATRIX_LANGS if sizes[lang] > capacities.get(lang, 0)]
+    print(f"languages with more unique sentences than planned in {table_plan_file}: {over}", flush=True)
+
+metrics.close(metrics_state())
+elapsed = time() - t0
+if args.max_memory:
+    print(
+        f"disk table: {table.flushed:,} entries flushed to runs and {table.merged:,} rewritten by merges "
+        f"({(table.flushed + table.merged) * 16 / 2**30:.2f} GiB)",
+        flush=True,
+    )
+map_busy = table.close()
+print(
+    f"busy over {elapsed:.1f}s: reader {stats['reader'] / elapsed:.0%}, "
+    f"{'shards' if isinstance(table, ShardedTable) else 'maps'} "
+    f"{min(map_busy) / elapsed:.0%}-{max(map_busy) / elapsed:.0%} "
+    f"(mean {sum(map_busy) / len(map_busy) / elapsed:.0%}), coordinator: looking up {seconds['lookup'] / elapsed:.0%}, "
+    f"assigning rows {seconds['assign'] / elapsed:.0%}, inserting {seconds['insert'] / elapsed:.0%}, "
+    f"writing {seconds['write'] / elapsed:.0%}, waiting for the maps {seconds['wait_table'] / elapsed:.0%}, "
+    f"waiting for the reader {seconds['wait_reader'] / elapsed:.0%}",
+    flush=True,
+)
+if components:
+    fnames = [f"{hash2row_dir}/{lang}.bin" for lang in CCMATRIX_LANGS]
+    component_stats = label_rows(
+        fnames, [os.stat(fname).st_size for fname in fnames], table_edges_file, numrows, component_workers
+    )
+    numrows = component_stats["rows"]
+    dump_json(component_stats, components_file(hash2row_dir))
+    os.remove(table_edges_file)
+
+with open(f"{hash2row_dir}/numrows.pkl", "wb") as fout:
+    pickle.dump(numrows, fout)
+checkpoints.close()
+if checkpoints.count:
+    print(
+        f"{checkpoints.count} checkpoints took {checkpoints.busy:.1f}s here "
+        f"and {checkpoints.sync:.1f}s of fsync in the background",
+        flush=True,
+    )
 
 print("done", flush=True)
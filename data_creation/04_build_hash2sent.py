@@ -15,27 +15,303 @@
 
 """
 Parses the file for all languages in the `tables_hashed` directory, and maps each hashed entry to its sentence, row and margin score bin.
+
+The raw data is scanned once per task (a lang pair, or a block range of a block-indexed lang pair), keeping the first
+occurrence of every sentence of both languages in hash2sent/parts/. Each language then merges its parts in file and
+block order, which gives the same first occurrences as scanning its files one after the other.
+
+Sentences are hashed (with sentence_hash in config.py, which has to match tables_hashed/hash_manifest.json) and written
+as the UTF-8 bytes of the raw data, only sentences that need cleaning (whitespace at
+either end) and lines that would split differently after decoding (see utils.parse_chunk) are decoded. Invalid UTF-8
+is handled according to invalid_utf8 in config.py.
+
+With sentence_locators, 02_hash_and_bin.py has recorded where every sentence first occurs in each task. The raw data is
+then not hashed again: gather() picks the first occurrence of every sentence of a language in the same order, and
+fetch() reads only the blocks holding those lines, once each, writing the same parts as scan() would after go()'s
+de-duplication.
 """
 
 import gzip
 import multiprocessing as mp
 import os
 import pathlib
+import shutil
 import sys
 from glob import glob
 from time import time
 
+import numpy as np
+
 sys.path.append("../")
 
-from ccmatrix_utils.ccmatrix_langpairs import CCMATRIX_LANGS
-from config import gz_dir, hash2row_dir, hash2sent_dir, num_buckets
-from cykhash import Int64Set, Int64toInt64Map
-from utils import entry_to_row_score, myhash, myhash2int
+from ccmatrix_utils.ccmatrix_langpairs import CCMATRIX_LANG_PAIRS, CCMATRIX_LANGS
+from config import (
+    gz_dir,
+    hash2row_dir,
+    hash2sent_dir,
+    invalid_utf8,
+    locator_dir,
+    num_buckets,
+    parse_chunk_size,
+    sentence_hash,
+    sentence_locators,
+    table_plan_file,
+    task_bytes,
+)
+from cykhash import Int64Set, Int64toInt64Map, isin_int64
+from pipeline import raw_chunks, worker_pool
+from scheduler import block_tasks, lang_costs, run_lpt
+from utils import (
+    check_hash_manifest,
+    clean_sentence,
+    entry_to_row_score,
+    get_sentence_hash,
+    invalid_lines,
+    legacy_rows,
+    locator_dtype,
+    myhash2int,
+    pack_locators,
+    parse_chunk,
+    plain_fields,
+    read_block_index,
+    table_capacities,
+    task_name,
+    text_errors,
+    unpack_locators,
+)
+
+parts_dir = f"{hash2sent_dir}/parts"
+hash_one, hash_batch = get_sentence_hash(sentence_hash)
+
+
+def part_name(lang_pair, start, lang):
+    return f"{parts_dir}/{lang_pair}.{start:07}.{lang}"
+
+
+def sentence_text(sent, plain):
+    # line of hash2sent text of a sentence: utf-8 bytes as in the raw data, plain: its text is already clean
+    if plain:
+        return bytes(sent) + b"\n"
+    return clean_sentence(str(sent, "utf-8", "replace")).encode("utf-8")
+
+
+def lang_files(lang):
+    # raw files with lang, in the order go() merges them
+    return [fname for fname in glob(f"{gz_dir}/*.tsv.gz") if lang in fname.split("/")[1].split(".")[0].split("-")]
+
+
+def scan(task):
+    """
+    Hashes both sentences of every line of a task: (lang pair, block range or None for the whole file).
+    The first occurrence of each sentence is appended to part files per language: hashes to .bin, text to .txt.gz
+    """
+    lang_pair, blocks = task
+    langs = lang_pair.split("-")
+    start = 0 if blocks is None else blocks[0]
+    t0 = time()
+
+    seen = {lang: Int64Set() for lang in langs}
+    out_files = dict()
+    for lang in langs:
+        out_files[lang] = dict()
+        out_files[lang]["bin"] = open(f"{part_name(lang_pair, start, lang)}.bin", "wb")
+        out_files[lang]["text"] = gzip.open(
+            f"{part_name(lang_pair, start, lang)}.txt.gz", "wb", compresslevel=1
+        )
+
+    def add(lang, sent, plain, hh=None):
+        # sent: utf-8 bytes as in the raw data, plain: its text is already clean, hh: its hash if already computed
+        if hh is None:
+            hh = hash_one(sent)
+        hh_int = myhash2int(hh)
+        if hh_int not in seen[lang]:
+            seen[lang].add(hh_int)
+            out_files[lang]["bin"].write(hh)
+            out_files[lang]["text"].write(sentence_text(sent, plain))
+
+    errors = text_errors(invalid_utf8)
+    lines_read = 0
+    for data in raw_chunks(f"{gz_dir}/{lang_pair}.tsv.gz", blocks, parse_chunk_size):
+        starts, ends, tab1, tab2, _, regular = parse_chunk(data)
+        invalid = invalid_lines(data, starts, ends, invalid_utf8)
+        plain0 = plain_fields(data, tab1 + 1, tab2)
+        plain1 = plain_fields(data, tab2 + 1, ends)
+        if invalid is not None:
+            plain0 &= ~invalid
+            plain1 &= ~invalid
+
+        tab1_regular = tab1[regular].tolist()
+        tab2_regular = tab2[regular].tolist()
+        h0s = hash_batch([data[t1 + 1 : t2] for t1, t2 in zip(tab1_regular, tab2_regular)])
+        h1s = hash_batch([data[t2 + 1 : end] for t2, end in zip(tab2_regular, ends[regular].tolist())])
+
+        num_regular = 0
+        for start, end, t1, t2, is_regular, is_plain0, is_plain1 in zip(
+            starts.tolist(),
+            ends.tolist(),
+            tab1.tolist(),
+            tab2.tolist(),
+            regular.tolist(),
+            plain0.tolist(),
+            plain1.tolist(),
+        ):
+            if is_regular:
+                add(langs[0], data[t1 + 1 : t2], is_plain0, h0s[num_regular])
+                add(langs[1], data[t2 + 1 : end], is_plain1, h1s[num_regular])
+                num_regular += 1
+                num_rows = 1
+            else:
+                num_rows = 0
+                for row in legacy_rows(data[start : end + 1], errors):
+                    score, src, tgt = row
+                    add(langs[0], src.encode("utf-8", errors), False)
+                    add(langs[1], tgt.encode("utf-8", errors), False)
+                    num_rows += 1
+
+            for _ in range(num_rows):
+                lines_read += 1
+                if lines_read % 1_000_000 == 0:
+                    print(
+                        f"scanned {lines_read:,} lines of {task_name(lang_pair, blocks)}, t={time() - t0:.1f}s",
+                        flush=True,
+                    )
+
+    for lang in langs:
+        out_files[lang]["bin"].close()
+        out_files[lang]["text"].close()
+
+    print(
+        f"done scanning {task_name(lang_pair, blocks)}: {lines_read:,} lines, unique: "
+        + ", ".join(f"{lang}={len(seen[lang]):,}" for lang in langs)
+        + f", t={time() - t0:.1f}s",
+        flush=True,
+    )
+
+
+def need_file(lang_pair, lang):
+    return f"{parts_dir}/{lang_pair}.{lang}.need"
+
+
+def gather(lang):
+    """
+    Picks the locator of the first occurrence of every sentence of lang from the locator files of 02_hash_and_bin.py,
+    in the order go() reads the lang pairs and their blocks, and writes them to a .need file per lang pair
+    """
+    t0 = time()
+    seen = Int64Set(number_of_elements_hint=table_capacities(table_plan_file).get(lang))
+    num_locators = 0
+    for fname in lang_files(lang):
+        lang_pair = fname.split("/")[1].split(".")[0]
+        with open(need_file(lang_pair, lang), "wb") as fout:
+            for loc_file in sorted(glob(f"{locator_dir}/{lang_pair}/*.{lang}.loc")):
+                locators = np.fromfile(loc_file, dtype=locator_dtype)  # each sentence once per file
+                known = np.zeros(len(locators), dtype=bool)
+                isin_int64(locators["hash"], seen, known)
+                seen.update(locators["hash"][~known])
+                locators[~known].tofile(fout)
+                num_locators += len(locators)
+    print(f"lang {lang}: {len(seen):,} sentences of {num_locators:,} locators, t={time() - t0:.1f}s", flush=True)
+
+
+def fetch(task):
+    """
+    Reads the sentences gather() picked in a task: (lang pair, block range or None for the whole file), decompressing
+    only the blocks that hold them. Writes the same part files as scan(), minus the sentences go() would skip.
+    """
+    lang_pair, blocks = task
+    langs = lang_pair.split("-")
+    gz_file = f"{gz_dir}/{lang_pair}.tsv.gz"
+    index = read_block_index(gz_file)
+    start, stop = (0, len(index)) if blocks is None else blocks
+    t0 = time()
+
+    wanted = []  # per side: locators in the task's blocks, in raw data order
+    pair_id = CCMATRIX_LANG_PAIRS.index(lang_pair)
+    for side, lang in enumerate(langs):
+        fname = need_file(lang_pair, lang)
+        if not os.path.getsize(fname):
+            wanted.append(np.zeros(0, dtype=locator_dtype))
+            continue
+        need = np.memmap(fname, dtype=locator_dtype, mode="r")  # sorted, locators of one pair and side
+        first, last = np.searchsorted(need["loc"], pack_locators(pair_id, side, np.array([start, stop]), 0))
+        wanted.append(np.array(need[first:last]))
+    _, _, wanted_blocks, _ = unpack_locators(np.concatenate([side["loc"] for side in wanted]))
+    read_blocks = np.unique(wanted_blocks).tolist()
+
+    out_files = dict()
+    for lang in langs:
+        out_files[lang] = dict()
+        out_files[lang]["bin"] = open(f"{part_name(lang_pair, start, lang)}.bin", "wb")
+        out_files[lang]["text"] = gzip.open(f"{part_name(lang_pair, start, lang)}.txt.gz", "wb", compresslevel=1)
+
+    errors = text_errors(invalid_utf8)
+    runs = []  # ranges of consecutive blocks to read
+    for block in read_blocks:
+        if runs and runs[-1][1] == block:
+            runs[-1][1] = block + 1
+        else:
+            runs.append([block, block + 1])
+    for run_start, run_stop in runs:
+        # line numbers in the run of every wanted sentence, per side
+        run_lines = np.cumsum([0] + [num_lines for _, _, num_lines in index[run_start:run_stop]])
+        side_lines = []
+        side_hashes = []
+        for side in wanted:
+            _, _, side_blocks, lines = unpack_locators(side["loc"])
+            in_run = (side_blocks >= run_start) & (side_blocks < run_stop)
+            side_lines.append(run_lines[side_blocks[in_run] - run_start] + lines[in_run])
+            side_hashes.append(side["hash"][in_run])
+
+        line_num = 0
+        for data in raw_chunks(gz_file, (run_start, run_stop), parse_chunk_size):
+            starts, ends, tab1, tab2, _, regular = parse_chunk(data)
+            invalid = invalid_lines(data, starts, ends, invalid_utf8)
+            for side, lang in enumerate(langs):
+                first, last = np.searchsorted(side_lines[side], [line_num, line_num + len(ends)])
+                hashes = side_hashes[side][first:last]
+                lines = (side_lines[side][first:last] - line_num).tolist()
+                if side == 0:
+                    field_starts, field_ends = tab1[lines] + 1, tab2[lines]
+                else:
+                    field_starts, field_ends = tab2[lines] + 1, ends[lines]
+                plain = plain_fields(data, field_starts, field_ends)
+                if invalid is not None:
+                    plain &= ~invalid[lines]
+                texts = []
+                for hh, line, field_start, field_end, is_plain in zip(
+                    hashes.tolist(), lines, field_starts.tolist(), field_ends.tolist(), plain.tolist()
+                ):
+                    if regular[line]:
+                        texts.append(sentence_text(data[field_start:field_end], is_plain))
+                        continue
+                    # the sentence is in one of the rows of the line
+                    for row in legacy_rows(data[starts[line] : ends[line] + 1], errors):
+                        if len(row) != 3:
+                            continue
+                        sent = row[1 + side].encode("utf-8", errors)
+                        if myhash2int(hash_one(sent)) == hh:
+                            texts.append(sentence_text(sent, False))
+                            break
+                out_files[lang]["bin"].write(hashes.astype("<i8").tobytes())
+                out_files[lang]["text"].write(b"".join(texts))
+            line_num += len(ends)
+
+    for lang in langs:
+        out_files[lang]["bin"].close()
+        out_files[lang]["text"].close()
+
+    print(
+        f"done fetching {task_name(lang_pair, blocks)}: "
+        + ", ".join(f"{lang}={len(side):,}" for lang, side in zip(langs, wanted))
+        + f" sentences from {len(read_blocks)} of {stop - start} blocks, t={time() - t0:.1f}s",
+        flush=True,
+    )
 
 
 def go(lang):
     t0 = time()
-    hash2entry = Int64toInt64Map()
+    capacity = table_capacities(table_plan_file).get(lang)  # from plan_table.py, None if not planned
+    hash2entry = Int64toInt64Map(number_of_elements_hint=capacity)
     fname = f"{hash2row_dir}/{lang}.bin"
     num_to_read = os.stat(fname).st_size // 16
     bfile = open(fname, "rb")
@@ -60,16 +336,11 @@ def go(lang):
         flush=True,
     )
 
-    seen = Int64Set()
+    seen = Int64Set(number_of_elements_hint=capacity)
     t0 = time()
 
     lines_read = 0
-    gz_files = glob(f"{gz_dir}/*.tsv.gz")
-    my_files = []
-    for fname in gz_files:
-        lang0, lang1 = fname.split("/")[1].split(".")[0].split("-")
-        if lang in (lang0, lang1):
-            my_files.append(fname)
+    my_files = lang_files(lang)
 
     out_files = dict()
     for bucket in range(num_buckets):
@@ -78,51 +349,82 @@ def go(lang):
         )
         out_files[bucket] = dict()
         out_files[bucket]["text"] = gzip.open(
-            f"{hash2sent_dir}/bucket{bucket:03}/hash2sent_{lang}.txt.gz", "wt"
+            f"{hash2sent_dir}/bucket{bucket:03}/hash2sent_{lang}.txt.gz", "wb"
         )
         out_files[bucket]["bin"] = open(
             f"{hash2sent_dir}/bucket{bucket:03}/hash2sent_{lang}.bin", "wb"
         )
 
     for fname_ii, fname in enumerate(my_files):
-        lang0, lang1 = fname.split("/")[1].split(".")[0].split("-")
-        with gzip.open(fname, "rt", encoding="utf-8") as csvfile:
-            for _, line in enumerate(csvfile):
-                lines_read += 1
-                row = line.strip().split("\t")
-                score, src, tgt = row
-                mysent = src if lang == lang0 else tgt
-                hh = myhash(mysent)
-                hh_int = myhash2int(hh)
-                if hh_int not in seen:
-                    seen.add(hh_int)
-                    mysent = mysent.replace("\n", " ").replace("\t", " ").strip() + "\n"
-                    entry = hash2entry[hh_int]
-                    row, _ = entry_to_row_score(entry)
-                    bucket = row % num_buckets
-                    out_files[bucket]["text"].write(mysent)
-                    out_files[bucket]["bin"].write(hh)
-                    out_files[bucket]["bin"].write(
-                        entry.to_bytes(8, byteorder="little", signed=True)
-                    )
+        lang_pair = fname.split("/")[1].split(".")[0]
+        parts = sorted(glob(f"{parts_dir}/{lang_pair}.*.{lang}.bin"))
+        for part in parts:
+            part = part[: -len(".bin")]
+            with open(f"{part}.bin", "rb") as fh_bin, gzip.open(
+                f"{part}.txt.gz", "rb"
+            ) as fh_text:
+                while True:
+                    hh = fh_bin.read(8)
+                    if not hh:
+                        break
+                    mysent = fh_text.readline()
+                    lines_read += 1
+                    hh_int = myhash2int(hh)
+                    if hh_int not in seen:
+                        seen.add(hh_int)
+                        entry = hash2entry[hh_int]
+                        row, _ = entry_to_row_score(entry)
+                        bucket = row % num_buckets
+                        out_files[bucket]["text"].write(mysent)
+                        out_files[bucket]["bin"].write(hh)
+                        out_files[bucket]["bin"].write(
+                            entry.to_bytes(8, byteorder="little", signed=True)
+                        )
 
-                if lines_read % 1_000_000 == 0:
-                    print(
-                        f"lang={lang}, file {fname} ({fname_ii}/{len(my_files)}), lines read: {lines_read:,}, unique:{len(seen):,}, t={time() - t0:.1f}s",
-                        flush=True,
-                    )
+                    if lines_read % 1_000_000 == 0:
+                        print(
+                            f"lang={lang}, file {fname} ({fname_ii}/{len(my_files)}), sentences read: {lines_read:,}, unique:{len(seen):,}, t={time() - t0:.1f}s",
+                            flush=True,
+                        )
+            os.remove(f"{part}.bin")
+            os.remove(f"{part}.txt.gz")
 
     for bucket in range(num_buckets):
         out_files[bucket]["text"].close()
         out_files[bucket]["bin"].close()
 
     print(
-        f"done lang {lang} lines read: {lines_read:,}, unique:{len(seen):,}, t={time() - t0:.1f}s",
+        f"done lang {lang} sentences read: {lines_read:,}, unique:{len(seen):,}, t={time() - t0:.1f}s",
         flush=True,
     )
 
 
 if __name__ == "__main__":
+    check_hash_manifest(hash2row_dir, sentence_hash)
     num_cpus = mp.cpu_count()
-    with mp.Pool(num_cpus) as pool:
-        pool.map(go, CCMATRIX_LANGS)
+
+    lang_pairs = [
+        fname.split("/")[1].split(".")[0] for fname in glob(f"{gz_dir}/*.tsv.gz")
+    ]
+    tasks, costs = block_tasks(lang_pairs, task_bytes)
+    print(f"num language pairs: {len(lang_pairs)}, num tasks: {len(tasks)}", flush=True)
+
+    if sentence_locators:
+        missing = [lang_pair for lang_pair in lang_pairs if not os.path.isdir(f"{locator_dir}/{lang_pair}")]
+        if missing:
+            sys.exit(f"no sentence locators for {', '.join(missing[:5])}, run 02_hash_and_bin.py with sentence_locators")
+
+    shutil.rmtree(parts_dir, ignore_errors=True)  # leftovers of an interrupted run
+    pathlib.Path(parts_dir).mkdir(parents=True, exist_ok=True)
+
+    with worker_pool(num_cpus) as pool:
+        if sentence_locators:
+            run_lpt(pool, gather, CCMATRIX_LANGS, lang_costs(CCMATRIX_LANGS), num_cpus)
+            run_lpt(pool, fetch, tasks, costs, num_cpus)
+            for need in glob(f"{parts_dir}/*.need"):
+                os.remove(need)
+        else:
+            run_lpt(pool, scan, tasks, costs, num_cpus)
+        run_lpt(pool, go, CCMATRIX_LANGS, lang_costs(CCMATRIX_LANGS), num_cpus)
+
+    os.rmdir(parts_dir)
@@ -0,0 +1,84 @@
+#  Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License").
+#  You may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+
+
+"""
+Times the sentence hashes of utils.sentence_hashes on sentences of a raw file (or synthetic ones), per sentence and in
+batches as 02_hash_and_bin.py and 04_build_hash2sent.py call them.
+"""
+
+import argparse
+import gzip
+import random
+import sys
+from time import perf_counter
+
+sys.path.append("../")
+
+from utils import get_sentence_hash, sentence_hashes
+
+
+def raw_sentences(fname, num_sents):
+    sents = []
+    with gzip.open(fname, "rb") as fin:
+        for line in fin:
+            fields = line.rstrip(b"\n").split(b"\t")
+            sents.extend(fields[1:3])
+            if len(sents) >= num_sents:
+                break
+    return sents[:num_sents]
+
+
+def synthetic_sentences(num_sents, seed=0):
+    rng = random.Random(seed)
+    words = [bytes(rng.choices(b"abcdefghijklmnopqrstuvwxyz", k=rng.randint(1, 10))) for _ in range(10_000)]
+    return [b" ".join(rng.choices(words, k=rng.randint(3, 30))) for _ in range(num_sents)]
+
+
+def best_time(fn, repeats):
+    times = []
+    for _ in range(repeats):
+        t0 = perf_counter()
+        fn()
+        times.append(perf_counter() - t0)
+    return min(times)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser("Benchmark sentence hashes")
+    parser.add_argument("--raw-file", help="raw_data/<lang pair>.tsv.gz to take sentences from, default synthetic")
+    parser.add_argument("--num-sents", type=int, default=1_000_000)
+    parser.add_argument("--repeats", type=int, default=3, help="the best of this many runs is reported")
+    args = parser.parse_args()
+
+    if args.raw_file:
+        sents = raw_sentences(args.raw_file, args.num_sents)
+    else:
+        sents = synthetic_sentences(args.num_sents)
+    avg_len = sum(map(len, sents)) / max(len(sents), 1)
+    print(f"{len(sents):,} sentences, {avg_len:.1f} bytes on average", flush=True)
+
+    for name in sentence_hashes:
+        try:
+            hash_one, hash_batch = get_sentence_hash(name)
+        except ImportError as err:
+            print(f"{name:>12}: skipped ({err})", flush=True)
+            continue
+        one = best_time(lambda: [hash_one(sent) for sent in sents], args.repeats)
+        batch = best_time(lambda: hash_batch(sents), args.repeats)
+        print(
+            f"{name:>12}: {one / len(sents) * 1e9:6.0f} ns/sentence one at a time, "
+            f"{batch / len(sents) * 1e9:6.0f} ns/sentence in a batch",
+            flush=True,
+        )
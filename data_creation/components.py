@@ -0,0 +1,210 @@
+#  Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License").
+#  You may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+
+
+"""
+Parts of 03_build_table.py with table_mode = "components": rows are the connected components of the sentences, with
+every record as an edge between its two sentences, instead of the rows the greedy mode makes.
+
+While 03 reads the binned data, every (language, hash) gets a node id when it is first seen (assign_nodes()), and its
+entry in the maps and in tables_hashed/<lang>.bin is that id with the bin of the record, which is the best bin of the
+sentence since bins are read highest first. The two ids of every record are appended to table_edges_file. Then
+label_rows() finds the components with a union-find over an array of the parent of every node, numbers them in the
+order of their first node, and rewrites the entries of tables_hashed/<lang>.bin with the component as the row.
+
+The parent array is shared memory of num nodes * 4 bytes (8 with 2**32 nodes or more), inherited by component_workers
+processes that each go through a range of the edges in batches: the roots of both ends of the edges are found by
+following the parents with numpy, and the larger root of every edge whose roots differ is hooked under the smaller
+one (the smallest, if several edges hook it), until the roots of all edges of the batch agree. A parent is always
+smaller than its node, so there are no cycles. The processes write to the array without locks, so a hook can be
+overwritten by one of another process at the same time; passes over all edges are repeated until one hooks nothing,
+and then the roots of every edge agree.
+"""
+
+import mmap
+import multiprocessing as mp
+import os
+from time import time
+
+import numpy as np
+
+from scheduler import run_lpt
+from table_builder import entry_dtype, row_mask
+
+union_records = 2**20  # edges united at once by a worker
+task_records = 2**26  # edges per task of a pass (1 GiB)
+node_records = 2**24  # nodes compressed, labelled or counted at once
+
+_parent = None  # the parent array, set before the pool is started so its workers inherit it
+
+
+def assign_nodes(numnodes, entries0, missing0, entries1, missing1, first0, first1):
+    """
+    Node ids of a batch of records (h0, h1): the id in the entry of a hash already in the maps, else a new one, given
+    at the first occurrence of the hash in the batch (see assign_rows). entries and missing are the lookups of the
+    hashes before the batch, first the index of the first occurrence of every hash in the batch.
+    Returns (nodes of h0, nodes of h1, mask of the h0 added, mask of the h1 added, number of new nodes)
+    """
+    records = np.arange(len(first0))
+    new0 = missing0 & (first0 == records)
+    new1 = missing1 & (first1 == records)
+    num_new0 = int(new0.sum())
+    num_new1 = int(new1.sum())
+    nodes0 = entries0 & row_mask
+    nodes1 = entries1 & row_mask
+    nodes0[new0] = np.arange(numnodes, numnodes + num_new0)
+    nodes1[new1] = np.arange(numnodes + num_new0, numnodes + num_new0 + num_new1)
+    return nodes0[first0], nodes1[first1], new0, new1, num_new0 + num_new1
+
+
+def components_file(directory):
+    # written by label_rows(): tables_hashed/ holds components, not greedy rows
+    return f"{directory}/components.json"
+
+
+def _find(parent, nodes):
+    # roots of nodes, whose parents are set to them (path compression)
+    roots = parent[nodes]
+    todo = np.flatnonzero(parent[roots] != roots)
+    while len(todo):
+        roots[todo] = parent[roots[todo]]
+        todo = todo[parent[roots[todo]] != roots[todo]]
+    deep = parent[nodes] != roots
+    parent[nodes[deep]] = roots[deep]
+    return roots
+
+
+def _union(parent, nodes0, nodes1):
+    """
+    Hooks the trees of the ends of the edges (nodes0[ii], nodes1[ii]) together until their roots agree, returns the
+    number of hooks
+    """
+    hooks = 0
+    while len(nodes0):
+        roots0 = _find(parent, nodes0)
+        roots1 = _find(parent, nodes1)
+        apart = roots0 != roots1
+        # the roots are in the components of the ends, go on with them
+        nodes0 = roots0[apart]
+        nodes1 = roots1[apart]
+        high = np.maximum(nodes0, nodes1)
+        np.minimum.at(parent, high, np.minimum(nodes0, nodes1))
+        hooks += len(np.unique(high))
+    return hooks
+
+
+def _union_task(task):
+    edges_file, start, stop = task
+    edges = np.memmap(edges_file, dtype=np.int64, mode="r").reshape(-1, 2)
+    hooks = 0
+    for batch_start in range(start, stop, union_records):
+        batch = np.array(edges[batch_start : min(batch_start + union_records, stop)])
+        hooks += _union(_parent, batch[:, 0].astype(_parent.dtype), batch[:, 1].astype(_parent.dtype))
+    return hooks
+
+
+def _compress_task(task):
+    # every parent of a range of nodes set to its root
+    start, stop = task
+    _find(_parent, np.arange(start, stop, dtype=_parent.dtype))
+
+
+def _relabel_task(fname):
+    # writes fname.part: the entries of fname with the row of their node
+    with open(fname, "rb") as fin, open(f"{fname}.part", "wb") as fout:
+        while True:
+            records = np.fromfile(fin, dtype=entry_dtype, count=node_records)
+            if not len(records):
+                break
+            entries = records["entry"]
+            records["entry"] = (entries & ~row_mask) | _parent[entries & row_mask].astype(np.int64)
+            records.tofile(fout)
+
+
+def _number_components(parent):
+    """
+    Replaces the root of every node (after _compress_task) by the number of its component, in the order of the first
+    node of every component, which is its root. Returns the number of components.
+    """
+    num_rows = 0
+    for start in range(0, len(parent), node_records):
+        stop = min(start + node_records, len(parent))
+        roots = parent[start:stop].copy()
+        is_root = roots == np.arange(start, stop, dtype=parent.dtype)
+        num_roots = int(is_root.sum())
+        parent[start:stop][is_root] = np.arange(num_rows, num_rows + num_roots, dtype=parent.dtype)
+        # a root is never after its nodes, so it has its number by now
+        parent[start:stop][~is_root] = parent[roots[~is_root]]
+        num_rows += num_roots
+    return num_rows
+
+
+def _component_sizes(parent, num_rows):
+    # (nodes of the largest component, number of components of 2**k to 2**(k+1)-1 nodes for every k)
+    sizes = np.zeros(num_rows, dtype=parent.dtype)
+    for start in range(0, len(parent), node_records):
+        np.add.at(sizes, parent[start : start + node_records], 1)
+    histogram = np.zeros(64, dtype=np.int64)
+    for start in range(0, num_rows, node_records):
+        powers = np.log2(sizes[start : start + node_records]).astype(np.intp)
+        histogram += np.bincount(powers, minlength=64)
+    return int(sizes.max()) if num_rows else 0, histogram
+
+
+def label_rows(fnames, costs, edges_file, numnodes, num_workers):
+    """
+    Rows of the connected components of the numnodes nodes and the edges in edges_file: rewrites the entries of the
+    output files fnames of 03 with the row of their node instead. Returns a dict of stats with the number of rows.
+    """
+    global _parent
+    t0 = time()
+    num_edges = os.stat(edges_file).st_size // (2 * 8)
+    dtype = np.uint32 if numnodes < 2**32 else np.int64
+    # an anonymous shared mapping: forked workers write to the same pages
+    _parent = np.frombuffer(mmap.mmap(-1, max(numnodes, 1) * np.dtype(dtype).itemsize), dtype=dtype)[:numnodes]
+    for start in range(0, numnodes, node_records):
+        _parent[start : start + node_records] = np.arange(start, min(start + node_records, numnodes), dtype=dtype)
+    print(
+        f"components of {numnodes:,} nodes and {num_edges:,} edges, parents take {_parent.nbytes / 2**30:.2f} GiB",
+        flush=True,
+    )
+
+    passes = 0
+    with mp.Pool(num_workers) as pool:
+        starts = range(0, num_edges, task_records)
+        tasks = [(edges_file, start, min(start + task_records, num_edges)) for start in starts]
+        while True:
+            t1 = time()
+            hooks = sum(pool.imap_unordered(_union_task, tasks))
+            passes += 1
+            print(f"pass {passes}: {hooks:,} hooks in {time() - t1:.1f}s, t={time() - t0:.1f}s", flush=True)
+            # without other processes no hook is lost, a pass checking that would find nothing to do
+            if hooks == 0 or num_workers == 1:
+                break
+        ranges = [(start, min(start + node_records, numnodes)) for start in range(0, numnodes, node_records)]
+        pool.map(_compress_task, ranges)
+        num_rows = _number_components(_parent)
+        largest, histogram = _component_sizes(_parent, num_rows)
+        print(f"{num_rows:,} rows, the largest has {largest:,} sentences, t={time() - t0:.1f}s", flush=True)
+        print(
+            "rows by sentences:",
+            [(f"{2**k}-{2**(k + 1) - 1}", int(count)) for k, count in enumerate(histogram.tolist()) if count],
+            flush=True,
+        )
+        run_lpt(pool, _relabel_task, fnames, costs, num_workers, name="relabel")
+    # every file is rewritten before any replaces its original, so --resume never finds a mix of ids and rows
+    for fname in fnames:
+        os.replace(f"{fname}.part", fname)
+    _parent = None
+    return dict(nodes=numnodes, edges=num_edges, rows=num_rows, passes=passes, largest=largest, seconds=time() - t0)
@@ -19,6 +19,7 @@ exclude_num = 500
 num_score_bins = 50  # number of score bins to create
 bin_edge_prec = 100_000  # precision of bin edges
 num_buckets = 100  # number of table shards
+sentence_hash = "xxh3_64"  # 8 byte sentence hash used in 02 and 04: "xxh3_64" or "xxh64" (need the xxhash package), "blake2b_64", or "md5" (tables made before this setting existed), see utils.sentence_hashes
 
 gz_dir = "raw_data"  # 849G, stores raw ccMatrix data
 bin_dir = "binned_data"  # 162G, stores binary hash of each sentence pair in ccMatrix, binned by margin score
@@ -28,6 +29,50 @@ hash2row_dir = (
 hash2sent_dir = "hash2sent"  # 395G, stores sentence hash -> sentence and sentence hash -> (row, binned margin score), sharded into output folders
 shard_dir = "shards"  # 296G, stores final table, one json line per entry, gzipped
 cutoffs_file = "cutoffs.txt"  # Stores cutoffs for the score bin edges. Created in 01_create_bin_edges.py
+score_hist_file = "score_hist.npz"  # Histogram of quantized scores behind cutoffs_file, used by rebin.py. Created in 01_create_bin_edges.py
+hll_sketch_file = "hll_sketches.npz"  # HyperLogLog sketches of the sentence hashes of every lang pair and language. Created in 02_hash_and_bin.py
+table_plan_file = "table_plan.json"  # Estimated unique sentences per language and map capacities for 03 and 04. Created by plan_table.py
+locator_dir = "sentence_locators"  # (sentence hash, locator) records per task and language, see utils.pack_locators. Created in 02_hash_and_bin.py with sentence_locators
+table_runs_dir = "table_runs"  # sorted runs of (sentence hash, entry) per language, only used by 03_build_table.py --max-memory and removed at the end
+table_metrics_file = "table_metrics.jsonl"  # counters of 03_build_table.py with table_metrics_seconds, one JSON line per interval
+table_edges_file = "table_edges.bin"  # int64 node ids of both sentences of every record, only used by 03_build_table.py with table_mode = "components" and removed at the end
+langpair_counts_file = "../ccmatrix_utils/ccmatrix_counts/langpair_counts.pickle"  # examples per lang pair, used to schedule the largest tasks first
+lang_counts_file = "../ccmatrix_utils/ccmatrix_counts/lang_counts.pickle"  # examples per lang
+
+ccmatrix_url = "https://data.statmt.org/cc-matrix"  # raw data for lang pair xx-yy is at {ccmatrix_url}/xx-yy.bitextf.tsv.gz
+manifest_file = f"{gz_dir}/manifest.json"  # size and sha256 of every downloaded file. Created in 00_download_data.py
+download_connections = 256  # max number of concurrent http connections, shared by all files
+download_range_size = 64 * 2**20  # bytes per http range request, also the unit of resuming a partial download
+
+block_size = 4 * 2**20  # uncompressed bytes per block of block-indexed raw data, see transcode_blocks.py
+block_compresslevel = 6  # gzip level of each block
+task_bytes = 256 * 2**20  # block-indexed lang pairs are split into tasks of about this many compressed bytes in 01, 02 and 04
+
+parse_chunk_size = 2**24  # bytes of decompressed raw data parsed at once with numpy in 01, 02 and 04
+pipeline_decompressors = 0  # if > 0, every worker of 01, 02 and 04 gets this many processes that decompress its raw data into a shared memory ring buffer, see pipeline.py
+pipeline_slots = 3  # slots of parse_chunk_size bytes per decompressor process in the ring buffers
+bin_buffer_rows = 2**14  # rows buffered per output file in 02_hash_and_bin.py, 16-20 bytes each, see utils.BinWriter
+bin_layout = "pair_dirs"  # "pair_dirs": binned_data/<lang pair>/binNNN.bin, "containers": 02_hash_and_bin.py merges them into one binned_data/binNNN.bin per score bin, see utils.bin_segments
+pre_dedup = False  # if true, 02_hash_and_bin.py drops records whose two hashes both occurred before in the same task at a score at least as high: 03_build_table.py would skip them, see README. Recorded in binned_data/hash_manifest.json; table_mode = "components" refuses such data, since a dropped record can be the only link between two components
+sentence_locators = False  # if true, 02_hash_and_bin.py records where the first occurrence of every sentence is, and 04_build_hash2sent.py reads only the blocks holding those lines instead of hashing the whole raw data again; needs block-indexed raw data (transcode_blocks.py)
+table_store = "cykhash"  # hash maps of 03_build_table.py: "cykhash" (a map per language) or "flat" (one numpy open-addressing table for all languages, with exact memory stats, see table_builder.FlatTable)
+table_shards = 0  # if > 0, 03_build_table.py keeps its hash maps in this many processes, split by hash, see table_builder.py
+table_prefetch = 4  # batches of records 03_build_table.py reads ahead in a thread, 0: read in the main loop
+table_checkpoint_seconds = 0  # if > 0, 03_build_table.py saves a checkpoint at most this often, to go on from with --resume after a crash, see README
+table_metrics_seconds = 0  # if > 0, 03_build_table.py appends its counters to table_metrics_file as a JSON line this often, see README
+table_mode = "greedy"  # rows of 03_build_table.py: "greedy" (a record whose two sentences are both in the table already changes nothing, rows are never merged) or "components" (the connected components of all records, see components.py; needs binned_data made without pre_dedup)
+component_workers = 16  # processes of the union-find of 03_build_table.py with table_mode = "components"
+invalid_utf8 = "strict"  # lines that are not valid UTF-8 in 02 and 04: "strict" raises (like text mode did), "raw" hashes their bytes as they are and 04 writes their text with U+FFFD replacements
+
+score_sketch = "exact"  # how 01_create_bin_edges.py summarizes scores per task: "exact" (Counter of quantized scores) or "kll" (mergeable quantile sketch, see sketches.py)
+kll_k = 2000  # size parameter of the kll sketch, memory and accuracy grow with it
+hll_p = 14  # HyperLogLog sketches in 02_hash_and_bin.py have 2**hll_p registers (one byte each), relative error about 1.04 / sqrt(2**hll_p)
+score_sample_every = 1  # if > 1, 01_create_bin_edges.py only reads every k-th block of block-indexed raw files and reports an error bound for the cutoffs
+
+fused_binning = False  # if true, 02_hash_and_bin.py also computes the score cutoffs (01 is not needed): it stores (hash0, hash1, score_key) per line, then bins those records once the cutoffs are known
+
+stream_ingest = False  # if true, 02_hash_and_bin.py reads each lang pair straight from ccmatrix_url instead of gz_dir (00 is not needed)
+stream_keep_text = False  # if streaming, also store the text in gz_dir, block-indexed (needed by 04_build_hash2sent.py)
 
 cutoffs = []
 
@@ -43,6 +88,10 @@ if os.path.exists(cutoffs_file):  # if the cutoffs file has been created
 import bisect
 
 
+def raw_url(lang_pair):
+    return f"{ccmatrix_url}/{lang_pair}.bitextf.tsv.gz"
+
+
 def find_bin(score):
     """
     Find the bin corresponding to a given score
@@ -50,4 +99,21 @@ def find_bin(score):
     return bisect.bisect_left(cutoffs, score)
 
 
+def score_key(score):
+    """
+    Quantized score, 2 * int(score * bin_edge_prec), moved by one towards the score if the score is not exactly on the
+    bin_edge_prec grid, so it keeps its order relative to every possible cutoff: see find_key_bin
+    """
+    quantized = int(score * bin_edge_prec)
+    grid = quantized / bin_edge_prec
+    return 2 * quantized + (score > grid) - (score < grid)
+
+
+def find_key_bin(key, key_edges):
+    """
+    Same as find_bin(score) for key = score_key(score), if key_edges = [2 * edge, ...] for cutoffs = [edge / bin_edge_prec, ...]
+    """
+    return bisect.bisect_left(key_edges, key)
+
+
 bin_numbers = list(range(find_bin(100), find_bin(0) - 1, -1))
@@ -0,0 +1,392 @@
+#  Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License").
+#  You may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+
+
+"""
+Resumable downloader for the raw CCMatrix files.
+
+Each file is split into byte ranges which are fetched concurrently with HTTP range requests. All files share one
+thread pool, so `num_connections` is a global cap on open connections. Completed ranges are recorded in a
+`<file>.part.ranges` json file next to the partial download, so an interrupted run resumes where it stopped.
+Finished files are checksummed and recorded in a manifest (file name -> size, sha256, url).
+Files already on disk are only used after their sha256 is checked, against the manifest or the sha256 given with the
+job; a gzip file without either is adopted if it decompresses without errors (gzip checks the crc32 of every member).
+A server that sends no Content-Length gets one plain download per file.
+"""
+
+import gzip
+import hashlib
+import http.client
+import io
+import json
+import os
+import threading
+import urllib.request
+import zlib
+from concurrent.futures import FIRST_EXCEPTION, ThreadPoolExecutor, wait
+from time import sleep, time
+
+read_size = 2**20  # bytes read from a http response per read() call
+max_retries = 10  # retries per range before giving up
+http_timeout = 60  # seconds
+
+
+def remote_info(url):
+    """
+    Returns (size, supports_ranges, validator) of a remote file, validator is the ETag or Last-Modified header.
+    size is None if the server does not send a Content-Length.
+    """
+    request = urllib.request.Request(url, method="HEAD")
+    with urllib.request.urlopen(request, timeout=http_timeout) as response:
+        length = response.headers.get("Content-Length")
+        size = None if length is None else int(length)
+        supports_ranges = response.headers.get("Accept-Ranges", "none") == "bytes"
+        validator = response.headers.get("ETag") or response.headers.get(
+            "Last-Modified"
+        )
+    return size, supports_ranges, validator
+
+
+def open_range(url, start, end=None):
+    """
+    Opens a http response for bytes [start, end) of url, end=None means until the end of the file.
+    """
+    request = urllib.request.Request(url)
+    if start or end is not None:
+        request.add_header(
+            "Range", f"bytes={start}-{'' if end is None else end - 1}"
+        )
+    response = urllib.request.urlopen(request, timeout=http_timeout)
+    if (start or end is not None) and response.status != 206:
+        response.close()
+        raise IOError(f"server ignored range request for {url} (status {response.status})")
+    return response
+
+
+class HTTPStream(io.RawIOBase):
+    """
+    Read-only stream over a remote file. If the connection drops, it reconnects with a range request starting at the
+    current position, so a consumer (e.g. a gzip decoder) sees one uninterrupted byte stream.
+    """
+
+    def __init__(self, url):
+        super().__init__()
+        self.url = url
+        self.size, self.supports_ranges, _ = remote_info(url)
+        self.pos = 0
+        self.response = None
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        for attempt in range(max_retries + 1):
+            try:
+                if self.response is None:
+                    if self.pos and not self.supports_ranges:
+                        raise IOError(f"{self.url} does not support range requests, cannot resume")
+                    self.response = open_range(self.url, self.pos)
+                num_read = self.response.readinto(buffer)
+                if not num_read and self.size is not None and self.pos < self.size:
+                    raise IOError(f"connection closed at byte {self.pos:,} of {self.url}")
+                self.pos += num_read
+                return num_read
+            except (OSError, http.client.HTTPException) as err:
+                if self.response is not None:
+                    self.response.close()
+                    self.response = None
+                if attempt == max_retries or not self.supports_ranges:
+                    raise
+                print(f"reconnecting to {self.url} at byte {self.pos:,} ({err})", flush=True)
+                sleep(min(2**attempt, 60))
+
+    def close(self):
+        if self.response is not None:
+            self.response.close()
+            self.response = None
+        super().close()
+
+
+def open_stream(url):
+    return io.BufferedReader(HTTPStream(url), buffer_size=read_size)
+
+
+def file_sha256(path):
+    sha = hashlib.sha256()
+    with open(path, "rb") as fin:
+        while True:
+            data = fin.read(16 * read_size)
+            if not data:
+                break
+            sha.update(data)
+    return sha.hexdigest()
+
+
+def gzip_intact(path):
+    # whether path decompresses to the end without errors, gzip checks the crc32 and size of every member
+    try:
+        with gzip.open(path, "rb") as fin:
+            while fin.read(16 * read_size):
+                pass
+    except (OSError, EOFError, zlib.error):
+        return False
+    return True
+
+
+def load_manifest(manifest_file):
+    if not os.path.isfile(manifest_file):
+        return dict()
+    with open(manifest_file, "r") as fin:
+        return json.load(fin)
+
+
+def dump_json(obj, path):
+    # write to a temporary file first so a crash never leaves a truncated json behind
+    with open(f"{path}.tmp", "w") as fout:
+        json.dump(obj, fout, indent=1, sort_keys=True)
+    os.replace(f"{path}.tmp", path)
+
+
+def verify_file(path, manifest, check_sha256=False):
+    """
+    Checks a downloaded file against its manifest entry. Size is always checked, sha256 only if requested.
+    """
+    entry = manifest.get(os.path.basename(path))
+    if entry is None or not os.path.isfile(path):
+        return False
+    if os.stat(path).st_size != entry["size"]:
+        return False
+    if check_sha256:
+        return file_sha256(path) == entry["sha256"]
+    return True
+
+
+class _Download:
+    """
+    State of a single file: the partial file, its range map and the ranges still to fetch.
+    A file of unknown size is one range with end None, read until the server closes the connection.
+    """
+
+    def __init__(self, url, dest, range_size, sha256=None):
+        self.url = url
+        self.dest = dest
+        self.sha256 = sha256
+        self.part = f"{dest}.part"
+        self.ranges_file = f"{dest}.part.ranges"
+        self.lock = threading.Lock()
+
+        self.size, self.supports_ranges, validator = remote_info(url)
+        if self.size is None:
+            print(f"no Content-Length for {url}, downloading it in one piece", flush=True)
+            self.supports_ranges = False
+        if not self.supports_ranges:
+            range_size = self.size  # one range: plain download, restarted from zero if interrupted
+        if range_size is not None:
+            range_size = max(range_size, 1)
+
+        state = None
+        if os.path.isfile(self.part) and os.path.isfile(self.ranges_file):
+            with open(self.ranges_file, "r") as fin:
+                state = json.load(fin)
+            if (state["url"], state["size"], state["range_size"], state["validator"]) != (
+                url,
+                self.size,
+                range_size,
+                validator,
+            ):
+                print(f"remote file or range size changed, restarting {dest}", flush=True)
+                state = None
+
+        if state is None:
+            state = dict(
+                url=url, size=self.size, range_size=range_size, validator=validator, done=[]
+            )
+            with open(self.part, "wb") as fout:
+                fout.truncate(self.size or 0)
+            dump_json(state, self.ranges_file)
+
+        self.state = state
+        done = set(state["done"])
+        if self.size is None:
+            self.todo = [(0, 0, None)] if 0 not in done else []
+        else:
+            num_ranges = (self.size + range_size - 1) // range_size
+            self.todo = [
+                (ii, ii * range_size, min((ii + 1) * range_size, self.size))
+                for ii in range(num_ranges)
+                if ii not in done
+            ]
+        self.remaining = len(self.todo)
+        self.t0 = time()
+
+    def fetch(self, range_idx, start, end):
+        """
+        Fetches one range into the partial file, retrying from the last written byte on failure.
+        Returns True if this was the last missing range of the file.
+        """
+        pos = start
+        fd = os.open(self.part, os.O_WRONLY)
+        for attempt in range(max_retries + 1):
+            if not self.supports_ranges:
+                pos = start
+            try:
+                with (
+                    open_range(self.url, pos, end)
+                    if self.supports_ranges
+                    else urllib.request.urlopen(self.url, timeout=http_timeout)
+                ) as response:
+                    while end is None or pos < end:
+                        data = response.read(read_size if end is None else min(read_size, end - pos))
+                        if not data:
+                            if end is None:
+                                break
+                            raise IOError(f"connection closed at byte {pos:,} of {self.url}")
+                        os.pwrite(fd, data, pos)
+                        pos += len(data)
+                if end is None:
+                    os.ftruncate(fd, pos)  # an earlier attempt may have written more
+                break
+            except (OSError, http.client.HTTPException) as err:
+                if attempt == max_retries:
+                    os.close(fd)
+                    raise
+                print(f"retrying {self.url} at byte {pos:,} ({err})", flush=True)
+                sleep(min(2**attempt, 60))
+
+        os.fdatasync(fd)  # only record ranges that are safely on disk
+        os.close(fd)
+        with self.lock:
+            self.state["done"].append(range_idx)
+            dump_json(self.state, self.ranges_file)
+            self.remaining -= 1
+            return self.remaining == 0
+
+    def finish(self, manifest, manifest_file, manifest_lock):
+        size = os.stat(self.part).st_size
+        sha256 = file_sha256(self.part)
+        if self.sha256 is not None and sha256 != self.sha256:
+            # a retry would fetch the same bytes again, the partial file is of no use
+            os.remove(self.part)
+            os.remove(self.ranges_file)
+            raise IOError(f"sha256 of {self.url} is {sha256}, expected {self.sha256}")
+        os.replace(self.part, self.dest)
+        os.remove(self.ranges_file)
+        with manifest_lock:
+            manifest[os.path.basename(self.dest)] = dict(
+                size=size, sha256=sha256, url=self.url
+            )
+            dump_json(manifest, manifest_file)
+        t1 = time()
+        print(
+            f"downloaded {self.dest} ({size / 2**30:.2f} GiB) in {t1 - self.t0:.1f}s, sha256={sha256}",
+            flush=True,
+        )
+
+
+def _check_existing(url, dest, sha256, manifest):
+    """
+    Returns the manifest entry of an already downloaded dest, or None if it has to be downloaded.
+    A file in the manifest must match its size and sha256 there, any other file the sha256 of the job if given, else
+    the remote size and, for gzip, a full decompression.
+    """
+    if not os.path.isfile(dest):
+        return None
+    entry = manifest.get(os.path.basename(dest))
+    if entry is not None:
+        downloaded = entry.get("source_sha256", entry["sha256"])  # transcode_blocks.py changes sha256
+        if verify_file(dest, manifest, check_sha256=True) and sha256 in (None, downloaded):
+            print(f"using already downloaded {dest}", flush=True)
+            return entry
+        print(f"{dest} does not match {entry['sha256']} in the manifest, downloading it again", flush=True)
+        return None
+    size = os.stat(dest).st_size
+    if size != remote_info(url)[0]:
+        return None
+    actual = file_sha256(dest)
+    if sha256 is not None:
+        adopt = actual == sha256
+    else:
+        adopt = dest.endswith(".gz") and gzip_intact(dest)
+    if not adopt:
+        print(f"{dest} has the remote size but not the expected content, downloading it again", flush=True)
+        return None
+    print(f"adding already downloaded {dest} to manifest", flush=True)
+    return dict(size=size, sha256=actual, url=url)
+
+
+def download_files(jobs, manifest_file, num_connections, range_size, num_hashers=8):
+    """
+    Downloads (url, dest) or (url, dest, sha256) jobs. Files are started in the given order and every range of every
+    file competes for the same `num_connections` threads. Files already on disk are checked first, see
+    _check_existing(): files in the manifest against their sha256 there, files without a manifest entry (e.g. from an
+    older wget based run) against the remote size and the sha256 of the job, or their gzip crc32s if it has none.
+    A finished download that does not match the sha256 of its job raises IOError. A range that fails after all its
+    retries raises at once: ranges not started yet are cancelled, only the ones in flight are finished first.
+    """
+    manifest = load_manifest(manifest_file)
+    manifest_lock = threading.Lock()
+    t0 = time()
+
+    jobs = [(url, dest, sha256[0] if sha256 else None) for url, dest, *sha256 in jobs]
+    with ThreadPoolExecutor(num_hashers) as hashers:
+        entries = list(hashers.map(lambda job: _check_existing(*job, manifest), jobs))
+    downloads = []
+    for (url, dest, sha256), entry in zip(jobs, entries):
+        if entry is None:
+            downloads.append(_Download(url, dest, range_size, sha256))
+        elif os.path.basename(dest) not in manifest:
+            manifest[os.path.basename(dest)] = entry
+            dump_json(manifest, manifest_file)
+
+    total_bytes = sum(dl.size or 0 for dl in downloads)
+    print(
+        f"downloading {len(downloads):,} files ({total_bytes / 2**30:.1f} GiB) with {num_connections} connections",
+        flush=True,
+    )
+
+    # checksumming runs in its own pool so it never holds up a connection
+    with ThreadPoolExecutor(num_hashers) as hashers:
+        finished = []
+
+        def fetch(dl, range_idx, start, end):
+            if dl.fetch(range_idx, start, end):
+                finished.append(
+                    hashers.submit(dl.finish, manifest, manifest_file, manifest_lock)
+                )
+
+        with ThreadPoolExecutor(num_connections) as fetchers:
+            futures = [
+                fetchers.submit(fetch, dl, *todo) for dl in downloads for todo in dl.todo
+            ]
+            # the first failed range (after its retries) stops the download, ranges not started yet are dropped
+            done, _ = wait(futures, return_when=FIRST_EXCEPTION)
+            failed = [future for future in done if future.exception() is not None]
+            if failed:
+                fetchers.shutdown(wait=False, cancel_futures=True)
+                raise failed[0].exception()
+
+        for dl in downloads:
+            if not dl.todo:  # every range was already on disk from an earlier run
+                finished.append(
+                    hashers.submit(dl.finish, manifest, manifest_file, manifest_lock)
+                )
+        for future in finished:
+            future.result()
+
+    t1 = time()
+    print(
+        f"downloaded {total_bytes / 2**30:.1f} GiB in {t1 - t0:.1f}s ({total_bytes / 2**20 / max(t1 - t0, 1e-9):.1f} MiB/s)",
+        flush=True,
+    )
+    return manifest
@@ -0,0 +1,299 @@
+#  Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License").
+#  You may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+
+
+"""
+Decompression of the raw data in separate processes, so gzip inflate and parsing run on different cores.
+
+With pipeline_decompressors > 0 in config.py, worker_pool() starts every pool worker with its own ring buffer in
+multiprocessing.shared_memory, filled by pipeline_decompressors decompressor processes. A ring has pipeline_slots slots
+of parse_chunk_size bytes per decompressor. Decompressors fill free slots with line-aligned chunks, and the worker
+parses them in place: raw_chunks() yields memoryviews of the slots, which are only reused once the worker asks for the
+next chunk. When all slots of a decompressor are full it waits (backpressure), so memory stays fixed.
+
+A block-indexed range is split into sources of a few blocks, which the decompressors of a ring take in turn. Each
+decompressor fills its own slots and queue, and the worker reads the sources in order, so the chunks come in file order.
+Without the option (or for the streamed input of 02) raw_chunks() reads in the worker process as before.
+
+The rings are created before the pool and inherited by the workers and decompressors (the default fork start method),
+because pool workers cannot start processes of their own.
+"""
+
+import multiprocessing as mp
+import os
+import traceback
+from contextlib import contextmanager
+from multiprocessing import shared_memory
+from time import time
+
+from config import block_size, parse_chunk_size, pipeline_decompressors, pipeline_slots
+from utils import open_task, read_block_index, read_chunks
+
+_ring = None  # the ring of this pool worker, set by _attach()
+
+
+class Ring:
+    """
+    Shared memory slots of a pool worker and the queues to its decompressors: requests (sources to decompress),
+    free (slots the worker has released) and full (chunks ready, as ("slot", slot, size) or ("bytes", data), then
+    ("end",) after every source) per decompressor
+    """
+
+    def __init__(self, num_decompressors, num_slots, slot_size):
+        self.num_decompressors = num_decompressors
+        self.num_slots = num_slots
+        self.slot_size = slot_size
+        self.shm = shared_memory.SharedMemory(create=True, size=num_decompressors * num_slots * slot_size)
+        self.requests = [mp.Queue() for _ in range(num_decompressors)]
+        self.free = [mp.Queue() for _ in range(num_decompressors)]
+        self.full = [mp.Queue() for _ in range(num_decompressors)]
+        for decompressor in range(num_decompressors):
+            for slot in range(num_slots):
+                self.free[decompressor].put(decompressor * num_slots + slot)
+        self.counters = mp.Array("d", 2)  # bytes parsed, seconds the worker waited for chunks
+
+
+def _last_newline(buf, start, stop):
+    """
+    Offset from start of the last newline in buf[start:stop], -1 if there is none. Only the end is copied.
+    """
+    window = 2**16
+    end = stop
+    while end > start:
+        begin = max(start, end - window)
+        pos = bytes(buf[begin:end]).rfind(b"\n")
+        if pos >= 0:
+            return begin + pos - start
+        end = begin
+        window *= 4
+    return -1
+
+
+def _fill(ring, decompressor, fin, stats):
+    """
+    Decompresses fin into the slots of a decompressor, every chunk ending with a newline.
+    A line longer than a slot is sent as bytes instead.
+    """
+    buf = ring.shm.buf
+    free = ring.free[decompressor]
+    full = ring.full[decompressor]
+    carry = b""
+    eof = False
+    while not eof:
+        t0 = time()
+        slot = free.get()
+        t1 = time()
+        stats["wait"] += t1 - t0
+
+        base = slot * ring.slot_size
+        size = len(carry)
+        buf[base : base + size] = carry
+        while size < ring.slot_size:
+            num_read = fin.readinto(buf[base + size : base + ring.slot_size])
+            if not num_read:
+                eof = True
+                break
+            size += num_read
+        cut = _last_newline(buf, base, base + size) + 1
+        if eof and cut < size < ring.slot_size:  # the last line has no newline, as read_chunks() add one
+            buf[base + size] = ord("\n")
+            size += 1
+            cut = size
+
+        if cut:
+            carry = bytes(buf[base + cut : base + size])
+            full.put(("slot", slot, cut))
+        else:
+            free.put(slot)
+            data = bytearray(buf[base : base + size])
+            while not eof and b"\n" not in data[-ring.slot_size :]:
+                more = fin.read(ring.slot_size)
+                eof = not more
+                data += more
+            # like read_chunks(): nothing at all for an empty rest, a newline only after a last line without one
+            if eof and data and not data.endswith(b"\n"):
+                data += b"\n"
+            cut = data.rfind(b"\n") + 1
+            carry = bytes(data[cut:])
+            if cut:
+                full.put(("bytes", bytes(data[:cut])))
+        stats["bytes"] += cut
+        stats["busy"] += time() - t1
+
+
+def _decompressor(ring, decompressor):
+    """
+    Process of a decompressor: decompresses its share of the sources of every request until it gets None
+    """
+    stats = dict(bytes=0, busy=0.0, wait=0.0)
+    while True:
+        request = ring.requests[decompressor].get()
+        if request is None:
+            break
+        gz_file, sources = request
+        try:
+            for blocks in sources[decompressor :: ring.num_decompressors]:
+                with open_task(gz_file, blocks, "rb") as fin:
+                    _fill(ring, decompressor, fin, stats)
+                ring.full[decompressor].put(("end",))
+        except Exception:
+            ring.full[decompressor].put(("error", traceback.format_exc()))
+    ring.full[decompressor].put(("stats", stats))
+
+
+def _alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    return True
+
+
+def _attach(rings, owners):
+    """
+    Gives this pool worker a ring no live worker has: owners holds the pid of the worker of every ring, so a worker
+    the pool starts to replace one that exited takes over its ring
+    """
+    global _ring
+    with owners.get_lock():
+        for ii, pid in enumerate(owners):
+            if pid == 0 or not _alive(pid):
+                owners[ii] = os.getpid()
+                _ring = rings[ii]
+                return
+    raise RuntimeError(f"all {len(rings)} rings belong to live workers")
+
+
+def _sources(gz_file, blocks, num_decompressors):
+    """
+    Splits a block range (or the whole file if it is block-indexed) into block ranges for the decompressors
+    """
+    index = read_block_index(gz_file) if num_decompressors > 1 else None
+    if not index:
+        return [blocks]
+    start, stop = blocks if blocks is not None else (0, len(index))
+    step = max(1, parse_chunk_size // block_size - 1)  # a source should fit in a slot
+    return [(ii, min(ii + step, stop)) for ii in range(start, stop, step)]
+
+
+def raw_chunks(gz_file, blocks, chunk_size):
+    """
+    Chunks of about chunk_size bytes of the part of gz_file covered by a task, like read_chunks(open_task(...)).
+    In a worker of worker_pool() with pipeline_decompressors, they are memoryviews of the worker's ring, only valid
+    until the next chunk is asked for.
+    """
+    if _ring is None:
+        with open_task(gz_file, blocks, "rb") as fin:
+            yield from read_chunks(fin, chunk_size)
+        return
+
+    ring = _ring
+    sources = _sources(gz_file, blocks, ring.num_decompressors)
+    for decompressor in range(ring.num_decompressors):
+        ring.requests[decompressor].put((gz_file, sources))
+    pending = [len(sources[decompressor :: ring.num_decompressors]) for decompressor in range(ring.num_decompressors)]
+    num_bytes = 0
+    wait = 0.0
+    try:
+        for source in range(len(sources)):
+            decompressor = source % ring.num_decompressors
+            while True:
+                t0 = time()
+                message = ring.full[decompressor].get()
+                wait += time() - t0
+                if message[0] == "end":
+                    pending[decompressor] -= 1
+                    break
+                if message[0] == "error":
+                    pending[decompressor] = 0  # it dropped the rest of its sources, the others are drained below
+                    raise RuntimeError(f"decompressing {gz_file} failed:\n{message[1]}")
+                if message[0] == "slot":
+                    _, slot, size = message
+                    base = slot * ring.slot_size
+                    num_bytes += size
+                    try:
+                        yield ring.shm.buf[base : base + size]
+                    finally:
+                        # also if the consumer stops here, else the decompressor would wait for the slot forever
+                        ring.free[slot // ring.num_slots].put(slot)
+                else:
+                    num_bytes += len(message[1])
+                    yield message[1]
+    finally:
+        # if the consumer stopped early, drain the rest of the request so the ring can be used again
+        for decompressor in range(ring.num_decompressors):
+            while pending[decompressor]:
+                message = ring.full[decompressor].get()
+                if message[0] == "slot":
+                    ring.free[decompressor].put(message[1])
+                elif message[0] in ("end", "error"):
+                    pending[decompressor] = 0 if message[0] == "error" else pending[decompressor] - 1
+        with ring.counters.get_lock():
+            ring.counters[0] += num_bytes
+            ring.counters[1] += wait
+
+
+@contextmanager
+def worker_pool(num_workers):
+    """
+    mp.Pool(num_workers), whose workers read raw data through raw_chunks() with pipeline_decompressors decompressor
+    processes each if that is set. Prints the throughput of both stages at the end.
+    """
+    if not pipeline_decompressors:
+        with mp.Pool(num_workers) as pool:
+            yield pool
+        return
+
+    rings = [Ring(pipeline_decompressors, pipeline_slots, parse_chunk_size) for _ in range(num_workers)]
+    processes = [
+        mp.Process(target=_decompressor, args=(ring, decompressor), daemon=True)
+        for ring in rings
+        for decompressor in range(pipeline_decompressors)
+    ]
+    for process in processes:
+        process.start()
+    t0 = time()
+    try:
+        with mp.Pool(num_workers, initializer=_attach, initargs=(rings, mp.Array("q", num_workers))) as pool:
+            yield pool
+    finally:
+        stats = dict(bytes=0, busy=0.0, wait=0.0)
+        for ring in rings:
+            for decompressor in range(pipeline_decompressors):
+                ring.requests[decompressor].put(None)
+            for decompressor in range(pipeline_decompressors):
+                while True:
+                    message = ring.full[decompressor].get()
+                    if message[0] == "stats":
+                        break
+                for key, value in message[1].items():
+                    stats[key] += value
+        for process in processes:
+            process.join()
+        parsed = sum(ring.counters[0] for ring in rings)
+        parser_wait = sum(ring.counters[1] for ring in rings)
+        for ring in rings:
+            ring.shm.close()
+            ring.shm.unlink()
+
+        elapsed = time() - t0
+        print(
+            f"pipeline: {len(processes)} decompressors inflated {stats['bytes'] / 2**20:.1f} MiB "
+            f"({stats['bytes'] / 2**20 / max(stats['busy'], 1e-9):.1f} MiB/s per busy decompressor), busy "
+            f"{stats['busy']:.1f}s and waiting for free slots {stats['wait']:.1f}s of "
+            f"{elapsed * len(processes):.1f} decompressor-seconds; {num_workers} workers parsed "
+            f"{parsed / 2**20:.1f} MiB and waited for chunks {parser_wait:.1f}s of {elapsed * num_workers:.1f} "
+            f"worker-seconds",
+            flush=True,
+        )
@@ -0,0 +1,129 @@
+#  Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License").
+#  You may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+
+
+"""
+Predicts the size of the table before 03_build_table.py runs, from the HyperLogLog sketches saved by 02_hash_and_bin.py.
+
+The sketches of all lang pairs of a language are merged into an estimate of its unique sentences, which is the number
+of entries 03_build_table.py puts in its hash2row map and 04_build_hash2sent.py in its maps of that language.
+From these the peak memory of the cykhash maps in 03 and 04 (and in 02 with pre_dedup) is predicted, and the map
+capacities are written to table_plan.json, which 03 and 04 use to allocate every map at its final size at once.
+"""
+
+import argparse
+import math
+import multiprocessing as mp
+import sys
+
+sys.path.append("../")
+
+from config import hll_sketch_file, table_plan_file
+from downloader import dump_json
+from sketches import HyperLogLog, load_hll_sketches
+from table_builder import FlatTable
+
+# cykhash (khash) tables have a power of 2 number of buckets, filled to at most 77%,
+# a bucket takes 8 bytes per key and value plus 2 bits of flags
+max_load = 0.77
+map_bucket_bytes = 16.25
+set_bucket_bytes = 8.25
+
+
+def num_buckets(num_entries):
+    return 2 ** max(2, math.ceil(math.log2(max(num_entries, 1) / max_load)))
+
+
+def map_bytes(num_entries):
+    return num_buckets(num_entries) * map_bucket_bytes
+
+
+def set_bytes(num_entries):
+    return num_buckets(num_entries) * set_bucket_bytes
+
+
+def largest_sum(values, num):
+    # peak of num workers all busy with the largest tasks at once
+    return sum(sorted(values, reverse=True)[:num])
+
+
+def gib(num_bytes):
+    return f"{num_bytes / 2**30:.2f} GiB"
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser("Plan the CCMatrix table")
+    parser.add_argument("--num-cpus", type=int, default=mp.cpu_count(), help="workers of 02 and 04")
+    parser.add_argument(
+        "--margin", type=float, default=3, help="capacities are the estimates plus this many standard errors"
+    )
+    args = parser.parse_args()
+
+    pair_sketches = load_hll_sketches(hll_sketch_file)
+    lang_sketches = dict()
+    pairs = dict()
+    for name, sketch in pair_sketches.items():
+        lang_pair, lang = name.split(".")
+        pairs.setdefault(lang_pair, dict())[lang] = round(sketch.estimate())
+        if lang in lang_sketches:
+            lang_sketches[lang].merge(sketch)
+        else:
+            lang_sketches[lang] = HyperLogLog(sketch.p, sketch.registers.copy())
+
+    relative_error = next(iter(lang_sketches.values())).relative_error() if lang_sketches else 0
+    langs = dict()
+    for lang, sketch in sorted(lang_sketches.items()):
+        unique = round(sketch.estimate())
+        langs[lang] = dict(unique=unique, capacity=math.ceil(unique * (1 + args.margin * relative_error)))
+
+    capacities = [entry["capacity"] for entry in langs.values()]
+    peak_bytes = {
+        # two hash -> bin maps per task, at most the size of a whole lang pair
+        "02_hash_and_bin (pre_dedup)": largest_sum(
+            [sum(map_bytes(unique) for unique in sides.values()) for sides in pairs.values()], args.num_cpus
+        ),
+        # one hash -> row map per language, all in one process
+        "03_build_table": sum(map_bytes(capacity) for capacity in capacities),
+        # one table of all languages with table_store = "flat"
+        "03_build_table (flat)": math.ceil(sum(capacities) / FlatTable.max_load) * FlatTable.slot_bytes,
+        # scan: one set of seen hashes per language of a task, go: a hash -> row map and a set per language
+        "04_build_hash2sent": max(
+            largest_sum(
+                [sum(set_bytes(unique) for unique in sides.values()) for sides in pairs.values()], args.num_cpus
+            ),
+            largest_sum([map_bytes(capacity) + set_bytes(capacity) for capacity in capacities], args.num_cpus),
+        ),
+    }
+
+    for lang, entry in sorted(langs.items(), key=lambda item: item[1]["unique"], reverse=True)[:10]:
+        print(f"{lang}: ~{entry['unique']:,} unique sentences, map of {gib(map_bytes(entry['capacity']))}", flush=True)
+    print(
+        f"total: ~{sum(entry['unique'] for entry in langs.values()):,} unique sentences in {len(langs)} languages "
+        f"(relative error about {relative_error:.1%})",
+        flush=True,
+    )
+    for step, num_bytes in peak_bytes.items():
+        print(f"peak memory of the hash maps in {step}: {gib(num_bytes)}", flush=True)
+
+    dump_json(
+        dict(
+            langs=langs,
+            pairs=pairs,
+            peak_bytes=peak_bytes,
+            num_cpus=args.num_cpus,
+            relative_error=relative_error,
+        ),
+        table_plan_file,
+    )
+    print(f"Saved {table_plan_file}", flush=True)
@@ -0,0 +1,192 @@
+#  Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License").
+#  You may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+
+
+"""
+Changes the score bins without reading the raw data again.
+
+By default new cutoffs for --num-bins bins are derived from score_hist.npz (saved by 01_create_bin_edges.py, or by
+02_hash_and_bin.py with fused_binning) and written to cutoffs.txt, exactly as 01_create_bin_edges.py would; binned_data
+then has to be recreated with 02_hash_and_bin.py.
+
+With --coarsen the existing binned_data is regrouped instead: adjacent bins are merged into about --num-bins bins of
+similar size and the new bin files are concatenations of the old ones, so nothing is hashed again. New cutoffs can only
+be a subset of the current ones, so bins can be merged but not split. The old bins are concatenated from the highest to
+the lowest, which is the order of the lines in the raw data (sorted by decreasing score), so the result is the same as
+running 02_hash_and_bin.py with the new cutoffs. Steps 03 onwards have to be re-run afterwards.
+
+--coarsen only works with bin_layout = "pair_dirs" in config.py.
+The plan is saved in binned_data/rebin_plan.json and finished lang pairs are marked, so an interrupted --coarsen resumes
+when run again.
+"""
+
+import argparse
+import json
+import math
+import multiprocessing as mp
+import os
+import shutil
+import sys
+from time import time
+
+sys.path.append("../")
+
+from ccmatrix_utils.ccmatrix_langpairs import CCMATRIX_LANG_PAIRS
+from config import (
+    TESTING,
+    bin_dir,
+    bin_edge_prec,
+    cutoffs,
+    cutoffs_file,
+    exclude_num,
+    num_score_bins,
+    score_hist_file,
+)
+from downloader import dump_json
+from scheduler import run_lpt
+from utils import bin_file, container_files, load_score_hist, score_bin_edges, write_cutoffs
+
+plan_file = f"{bin_dir}/rebin_plan.json"
+done_marker = "rebin.done"  # in the directory of a coarsened lang pair until the whole run is finished
+
+
+def group_bins(bin_rows, num_bins):
+    """
+    Groups adjacent bins into about num_bins groups of similar size, with the same greedy rule as score_bin_edges().
+    Returns [(first bin, last bin + 1), ...]
+    """
+    rows_per_bin = math.ceil(sum(bin_rows) / num_bins)
+    groups = []
+    start = 0
+    rows_in_group = 0
+    for bin_idx, rows in enumerate(bin_rows):
+        if rows_in_group and rows_in_group + rows > rows_per_bin:
+            groups.append((start, bin_idx))
+            start = bin_idx
+            rows_in_group = 0
+        rows_in_group += rows
+    groups.append((start, len(bin_rows)))
+    return groups
+
+
+def coarsen(task):
+    """
+    Writes the new bins of a lang pair to <pair>.rebin/ and swaps it with the old directory
+    """
+    lang_pair, groups = task
+    pair_dir = f"{bin_dir}/{lang_pair}"
+    new_dir = f"{pair_dir}.rebin"
+    os.makedirs(new_dir)
+    for new_idx, (start, stop) in enumerate(groups):
+        with open(bin_file(new_dir, new_idx), "wb") as fout:
+            for old_idx in reversed(range(start, stop)):
+                with open(bin_file(pair_dir, old_idx), "rb") as fin:
+                    shutil.copyfileobj(fin, fout, 2**20)
+    open(f"{new_dir}/{done_marker}", "w").close()
+
+    os.rename(pair_dir, f"{pair_dir}.old")
+    os.rename(new_dir, pair_dir)
+    shutil.rmtree(f"{pair_dir}.old")
+
+
+def recover(lang_pair):
+    """
+    Cleans up after a coarsen() that was interrupted
+    """
+    pair_dir = f"{bin_dir}/{lang_pair}"
+    if os.path.isdir(f"{pair_dir}.old"):
+        if not os.path.isdir(pair_dir):  # interrupted between the two renames, the new directory is complete
+            os.rename(f"{pair_dir}.rebin", pair_dir)
+        shutil.rmtree(f"{pair_dir}.old")
+    if os.path.isdir(f"{pair_dir}.rebin"):
+        shutil.rmtree(f"{pair_dir}.rebin")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser("Re-bin CCMatrix scores")
+    parser.add_argument("--num-bins", type=int, default=num_score_bins, help="approximate number of bins")
+    parser.add_argument(
+        "--coarsen",
+        action="store_true",
+        help="merge adjacent bins of binned_data instead of deriving new cutoffs for 02_hash_and_bin.py",
+    )
+    parser.add_argument("--dry-run", action="store_true", help="only print the new bins")
+    args = parser.parse_args()
+    t0 = time()
+
+    if not args.coarsen:
+        scores_count, hist_prec, exact = load_score_hist(score_hist_file)
+        if not exact:
+            print(f"WARNING: {score_hist_file} was estimated from a sample or sketch", flush=True)
+        edges = score_bin_edges(scores_count, sum(scores_count.values()), args.num_bins)
+        new_cutoffs = [x / hist_prec for x in edges]
+        if hist_prec != bin_edge_prec:
+            print(f"WARNING: {score_hist_file} has bin_edge_prec {hist_prec}, config.py {bin_edge_prec}", flush=True)
+        if not args.dry_run:
+            write_cutoffs(cutoffs_file, new_cutoffs)
+            print(f"Created {len(new_cutoffs)} cutoffs, re-run 02_hash_and_bin.py", flush=True)
+        sys.exit()
+
+    if container_files(bin_dir):
+        sys.exit('--coarsen needs bin_layout = "pair_dirs", re-run 02_hash_and_bin.py with the new cutoffs instead')
+
+    lang_pairs = CCMATRIX_LANG_PAIRS
+    if TESTING:
+        lang_pairs = lang_pairs[exclude_num:]
+    lang_pairs = [lang_pair for lang_pair in lang_pairs if os.path.isdir(f"{bin_dir}/{lang_pair}")]
+    for lang_pair in lang_pairs:
+        recover(lang_pair)
+
+    if os.path.isfile(plan_file):
+        with open(plan_file, "r") as fin:
+            plan = json.load(fin)
+        print(f"resuming {plan_file} ({len(plan['groups'])} bins), --num-bins is ignored", flush=True)
+    else:
+        bin_rows = [0] * (len(cutoffs) + 1)
+        for lang_pair in lang_pairs:
+            for bin_idx in range(len(bin_rows)):
+                bin_rows[bin_idx] += os.stat(bin_file(f"{bin_dir}/{lang_pair}", bin_idx)).st_size // (2 * 8)
+        groups = group_bins(bin_rows, args.num_bins)
+        plan = dict(
+            cutoffs=[cutoffs[stop - 1] for _, stop in groups[:-1]],
+            groups=groups,
+            rows=[sum(bin_rows[start:stop]) for start, stop in groups],
+        )
+
+    for new_idx, ((start, stop), rows) in enumerate(zip(plan["groups"], plan["rows"])):
+        print(f"new bin {new_idx}: old bins {start}-{stop - 1}, {rows:,} rows", flush=True)
+    if args.dry_run:
+        sys.exit()
+    dump_json(plan, plan_file)
+
+    todo = [
+        lang_pair
+        for lang_pair in lang_pairs
+        if not os.path.isfile(f"{bin_dir}/{lang_pair}/{done_marker}")
+    ]
+    print(f"coarsening {len(todo)} of {len(lang_pairs)} lang pairs", flush=True)
+
+    num_cpus = mp.cpu_count()
+    with mp.Pool(num_cpus) as pool:
+        costs = [
+            sum(entry.stat().st_size for entry in os.scandir(f"{bin_dir}/{lang_pair}"))
+            for lang_pair in todo
+        ]
+        run_lpt(pool, coarsen, [(lang_pair, plan["groups"]) for lang_pair in todo], costs, num_cpus, labels=todo)
+
+    write_cutoffs(cutoffs_file, plan["cutoffs"])
+    for lang_pair in lang_pairs:
+        os.remove(f"{bin_dir}/{lang_pair}/{done_marker}")
+    os.remove(plan_file)
+    print(f"Created {len(plan['cutoffs'])} cutoffs in {time() - t0:.1f}s, re-run 03_build_table.py", flush=True)
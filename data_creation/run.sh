@@ -16,8 +16,10 @@
 # The final data is ~300GB and is saved as compressed shards with one json line per entry in the directory shards/
 
 time python3 00_download_data.py > log00 #~2.5 hours
-time python3 01_create_bin_edges.py > log01 #~1.5 hours
-time python3 02_hash_and_bin.py > log02 #~2 hours
+# time python3 transcode_blocks.py > log00b # optional, makes raw_data/ block-indexed
+time python3 01_create_bin_edges.py > log01 #~1.5 hours (not needed with fused_binning in config.py)
+time python3 02_hash_and_bin.py > log02 #~2 hours (with stream_ingest in config.py, 00 and 01 can be skipped)
+time python3 plan_table.py > log02b # seconds, predicts the memory of 03 and 04 and presizes their hash maps
 time python3 03_build_table.py > log03 #~8 hours
 time python3 04_build_hash2sent.py > log04 #~7 hours
 time python3 05_make_shards.py > log05 # ~6 hours
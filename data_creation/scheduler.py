@@ -0,0 +1,149 @@
+#  Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License").
+#  You may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+
+
+"""
+Size-aware scheduling of the per language pair / per language tasks.
+
+Tasks are dispatched largest-first (LPT ordering) one at a time, so a giant pair like en-es starts immediately instead
+of whenever pool.map's chunking happens to reach it, and the small pairs fill in the gaps at the end.
+"""
+
+import heapq
+import os
+import pickle
+from time import time
+
+from config import gz_dir, lang_counts_file, langpair_counts_file
+from utils import read_block_index
+
+
+def load_counts(fname):
+    with open(fname, "rb") as fin:
+        return pickle.load(fin)
+
+
+def pair_costs(lang_pairs, use_file_sizes=True):
+    """
+    Cost estimate per language pair: the size of its raw file if every pair has been downloaded, else the number of
+    examples from langpair_counts_file
+    """
+    if use_file_sizes:
+        fnames = [f"{gz_dir}/{lang_pair}.tsv.gz" for lang_pair in lang_pairs]
+        if all(os.path.isfile(fname) for fname in fnames):
+            return [os.stat(fname).st_size for fname in fnames]
+    counts = load_counts(langpair_counts_file)
+    return [counts.get(lang_pair, 1) for lang_pair in lang_pairs]
+
+
+def block_tasks(lang_pairs, task_bytes, use_file_sizes=True, sample_every=1):
+    """
+    Splits every block-indexed lang pair (see transcode_blocks.py) into (lang_pair, (start_block, stop_block)) tasks
+    of about task_bytes compressed bytes, other lang pairs become a single (lang_pair, None) task.
+    With sample_every = k only every k-th block counts towards the size of a task, for tasks that only read those.
+    Returns the tasks and their costs.
+    """
+    tasks = []
+    costs = []
+    for lang_pair, cost in zip(lang_pairs, pair_costs(lang_pairs, use_file_sizes)):
+        index = None
+        if use_file_sizes and os.path.isfile(f"{gz_dir}/{lang_pair}.tsv.gz"):
+            index = read_block_index(f"{gz_dir}/{lang_pair}.tsv.gz")
+        if not index:
+            tasks.append((lang_pair, None))
+            costs.append(cost)
+            continue
+        start = 0
+        size = 0
+        for ii, (_, length, _) in enumerate(index):
+            if ii % sample_every == 0:
+                size += length
+            if size >= task_bytes or ii == len(index) - 1:
+                tasks.append((lang_pair, (start, ii + 1)))
+                costs.append(size)
+                start = ii + 1
+                size = 0
+    return tasks, costs
+
+
+def lang_costs(langs):
+    """
+    Cost estimate per language: the number of examples it occurs in, from lang_counts_file
+    """
+    counts = load_counts(lang_counts_file)
+    return [counts.get(lang, 1) for lang in langs]
+
+
+def lpt_order(costs):
+    """
+    Task indices, largest cost first
+    """
+    return sorted(range(len(costs)), key=lambda ii: costs[ii], reverse=True)
+
+
+def lpt_makespan(costs, num_workers):
+    """
+    Makespan (in cost units) of greedily assigning tasks largest-first to the least loaded worker
+    """
+    loads = [0] * max(1, min(num_workers, len(costs)))
+    for ii in lpt_order(costs):
+        heapq.heappush(loads, heapq.heappop(loads) + costs[ii])
+    return max(loads)
+
+
+def _timed_call(args):
+    fn, idx, task = args
+    t0 = time()
+    result = fn(task)
+    return idx, result, time() - t0
+
+
+def run_lpt(pool, fn, tasks, costs, num_workers, name=None, labels=None, on_result=None):
+    """
+    Drop-in replacement for pool.map(fn, tasks): tasks are dispatched largest-first with imap_unordered and chunksize 1,
+    results are returned in the order of tasks. Prints the predicted makespan (LPT schedule of the cost estimates,
+    scaled by the measured time per unit of cost) next to the actual one.
+    on_result(task, result) is called in this process as soon as a task is done, e.g. to record it for a restart.
+    """
+    name = name or getattr(fn, "__name__", "tasks")
+    labels = labels or tasks
+    t0 = time()
+    results = [None] * len(tasks)
+    durations = [0.0] * len(tasks)
+    order = lpt_order(costs)
+    jobs = [(fn, ii, tasks[ii]) for ii in order]
+    for done, (ii, result, duration) in enumerate(
+        pool.imap_unordered(_timed_call, jobs, chunksize=1)
+    ):
+        results[ii] = result
+        durations[ii] = duration
+        if on_result is not None:
+            on_result(tasks[ii], result)
+        print(
+            f"{name}: finished {labels[ii]} in {duration:.1f}s ({done + 1}/{len(tasks)}), t={time() - t0:.1f}s",
+            flush=True,
+        )
+
+    actual = time() - t0
+    total_cost = sum(costs)
+    if total_cost and len(tasks):
+        seconds_per_cost = sum(durations) / total_cost
+        predicted = lpt_makespan(costs, num_workers) * seconds_per_cost
+        lower_bound = max(sum(durations) / num_workers, max(durations))
+        print(
+            f"{name}: makespan predicted {predicted:.1f}s, actual {actual:.1f}s, lower bound {lower_bound:.1f}s, "
+            f"busy {sum(durations):.1f} of {actual * num_workers:.1f} worker-seconds",
+            flush=True,
+        )
+    return results
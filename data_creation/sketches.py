@@ -0,0 +1,172 @@
+#  Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License").
+#  You may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+
+
+"""
+Mergeable sketches, small enough to be built per worker and pickled back to the parent process.
+"""
+
+import math
+import os
+import random
+from collections import Counter
+
+import numpy as np
+
+
+class KLLSketch:
+    """
+    KLL quantile sketch (Karnin, Lang, Liberty 2016). Items live in a stack of compactors, an item in compactor h stands
+    for 2**h inserted items. A full compactor is sorted and every other item (random offset) is promoted to the next
+    one, so memory stays O(k) no matter how many items are inserted, and sketches of different workers can be merged.
+    """
+
+    c = 2 / 3  # capacity ratio between consecutive compactors
+
+    def __init__(self, k=2000, seed=None):
+        self.k = k
+        self.compactors = [[]]
+        self.size = 0  # items held
+        self.n = 0  # total weight inserted
+        self.sq_error = 0  # sum of squared item weights over all compactions, bounds the variance of any rank
+        self.random = random.Random(seed)
+        self._update_max_size()
+
+    def _capacity(self, h):
+        depth = len(self.compactors) - h - 1
+        return int(math.ceil(self.k * self.c**depth)) + 1
+
+    def _update_max_size(self):
+        self.max_size = sum(self._capacity(h) for h in range(len(self.compactors)))
+
+    def _grow(self):
+        self.compactors.append([])
+        self._update_max_size()
+
+    def update(self, item, weight=1):
+        """
+        Inserts item with an integer weight: one copy goes to compactor h for every bit h set in weight
+        """
+        self.n += weight
+        h = 0
+        while weight:
+            if weight & 1:
+                while h >= len(self.compactors):
+                    self._grow()
+                self.compactors[h].append(item)
+                self.size += 1
+            weight >>= 1
+            h += 1
+        if self.size >= self.max_size:
+            self._compress()
+
+    def _compress(self):
+        for h in range(len(self.compactors)):
+            if len(self.compactors[h]) >= self._capacity(h):
+                if h + 1 >= len(self.compactors):
+                    self._grow()
+                items = self.compactors[h]
+                items.sort()
+                keep = [items.pop()] if len(items) % 2 else []
+                self.compactors[h + 1].extend(items[self.random.getrandbits(1) :: 2])
+                self.compactors[h] = keep
+                self.sq_error += 4**h
+                self.size = sum(len(items) for items in self.compactors)
+                if self.size < self.max_size:
+                    break
+
+    def merge(self, other):
+        while len(self.compactors) < len(other.compactors):
+            self._grow()
+        for h, items in enumerate(other.compactors):
+            self.compactors[h].extend(items)
+        self.size += other.size
+        self.n += other.n
+        self.sq_error += other.sq_error
+        while self.size >= self.max_size:
+            self._compress()
+
+    def to_counter(self):
+        """
+        Counter of item -> estimated count, the counts sum to n
+        """
+        counts = Counter()
+        for h, items in enumerate(self.compactors):
+            for item in items:
+                counts[item] += 2**h
+        return counts
+
+    def error_bound(self, delta=0.01, num_queries=1):
+        """
+        Bound on the rank error that holds for num_queries ranks at once with probability 1 - delta.
+        Every compaction at level h moves any rank by 0 or +-2**h with mean zero, so Azuma's inequality applies.
+        """
+        return math.sqrt(2 * self.sq_error * math.log(2 * num_queries / delta))
+
+
+class HyperLogLog:
+    """
+    HyperLogLog distinct counter (Flajolet et al. 2007) of 64 bit hashes, with linear counting for small cardinalities
+    (Heule et al. 2013). 2**p one byte registers, relative standard error about 1.04 / sqrt(2**p).
+    The sentence hashes are uniformly distributed already, so they are used as they are.
+    """
+
+    def __init__(self, p=14, registers=None):
+        assert 11 <= p <= 18
+        self.p = p
+        self.registers = np.zeros(2**p, dtype=np.uint8) if registers is None else registers
+
+    def update(self, hashes):
+        """
+        Adds an array of int64 hashes: the first p bits pick a register, which keeps the highest position of the first
+        1 bit in the other 64 - p bits
+        """
+        hashes = np.asarray(hashes, dtype=np.int64).view(np.uint64)
+        idx = (hashes >> np.uint64(64 - self.p)).astype(np.intp)
+        rest = hashes & np.uint64(2 ** (64 - self.p) - 1)
+        # rest < 2**53 converts to float64 exactly, so frexp gives its bit length
+        rank = ((64 - self.p + 1) - np.frexp(rest.astype(np.float64))[1]).astype(np.uint8)
+        higher = rank > self.registers[idx]
+        np.maximum.at(self.registers, idx[higher], rank[higher])
+
+    def merge(self, other):
+        np.maximum(self.registers, other.registers, out=self.registers)
+
+    def estimate(self):
+        m = len(self.registers)
+        alpha = 0.7213 / (1 + 1.079 / m)
+        raw = alpha * m * m / np.sum(np.ldexp(1.0, -self.registers.astype(np.int64)))
+        zeros = int(np.count_nonzero(self.registers == 0))
+        if raw <= 2.5 * m and zeros:
+            return m * math.log(m / zeros)
+        return raw
+
+    def relative_error(self):
+        return 1.04 / math.sqrt(len(self.registers))
+
+
+def save_hll_sketches(fname, sketches):
+    """
+    Saves a dict of name -> HyperLogLog (all with the same p) as npz
+    """
+    with open(f"{fname}.part", "wb") as fout:
+        np.savez(fout, **{name: sketch.registers for name, sketch in sketches.items()})
+    os.replace(f"{fname}.part", fname)
+
+
+def load_hll_sketches(fname):
+    with np.load(fname) as registers:
+        return {
+            name: HyperLogLog(int(math.log2(len(registers[name]))), registers[name]) for name in registers.files
+        }
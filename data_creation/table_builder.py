@@ -0,0 +1,746 @@
+#  Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License").
+#  You may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+
+
+"""
+Parts of 03_build_table.py: the batches of records it reads, the row assignment of a batch, and the hash -> entry maps.
+
+read_batches() reads and prepares the batches in a thread, up to table_prefetch batches ahead of the table.
+The maps are kept by a LocalTable (in the process of 03) or, with table_shards > 0, by a ShardedTable: table_shards
+processes that each own the hashes h with h % table_shards == shard of every language. Lookups and inserts go to the
+shards in batches, and the lookups of the next batch are sent right after the inserts of the current one, so the
+shards work while 03 writes the output files. Cykhash holds the GIL, so shards have to be processes, not threads.
+With --max-memory, a DiskTable keeps most entries in sorted runs on disk instead, for hosts that cannot hold the maps.
+With table_store = "flat", one FlatTable holds all languages instead of a cykhash map per language (also in shards).
+
+Checkpoints hold no copy of the maps: every entry added to them is also appended to tables_hashed/<lang>.bin, so
+the maps are rebuilt from the output files cut at the offsets of the checkpoint (see reload()).
+"""
+
+import json
+import multiprocessing as mp
+import os
+import pickle
+import queue
+import shutil
+import threading
+from time import time
+
+import numpy as np
+from cykhash import Int64toInt64Map, Int64toInt64Map_from_buffers, Int64toInt64Map_to
+
+from utils import hash_pair_dtype
+
+entry_dtype = np.dtype([("hash", "<i8"), ("entry", "<i8")])  # records of tables_hashed/<lang>.bin
+row_mask = 2**56 - 1  # an entry is row + score bin * 2**56 (see utils.row_score_to_entry)
+unknown = np.iinfo(np.int64).min  # entry of row 0 with score bin 128, only trusted if the map says so
+
+
+def first_index(hashes):
+    # index of the first occurrence of every hash
+    _, first, inverse = np.unique(hashes, return_index=True, return_inverse=True)
+    return first[inverse]
+
+
+def _read(segments, batch_records, stats, resume_at):
+    fin = None
+    try:
+        for s_ii, (score_bin, lang_pair, fname, offset, num_records) in enumerate(segments):
+            if s_ii < resume_at[0]:
+                continue
+            first = resume_at[1] if s_ii == resume_at[0] else 0
+            # a container holds the segments of all lang pairs of a bin one after the other, keep it open
+            if fin is None or fin.name != fname:
+                if fin is not None:
+                    fin.close()
+                fin = open(fname, "rb")
+            fin.seek(offset + first * hash_pair_dtype.itemsize)
+            for start in range(first, num_records, batch_records):
+                t0 = time()
+                records = np.fromfile(fin, dtype=hash_pair_dtype, count=min(batch_records, num_records - start))
+                h0 = np.ascontiguousarray(records["h0"])
+                h1 = np.ascontiguousarray(records["h1"])
+                batch = (s_ii, score_bin, lang_pair, h0, h1, first_index(h0), first_index(h1))
+                stats["reader"] += time() - t0
+                yield batch
+    finally:
+        if fin is not None:
+            fin.close()
+
+
+def read_batches(segments, batch_records, prefetch, stats, resume_at=(0, 0)):
+    """
+    Yields (segment index, score bin, lang pair, h0, h1, first index of h0, first index of h1) for batches of up to
+    batch_records records of the segments (see utils.bin_segments), read and prepared by a thread up to prefetch
+    batches ahead (in the calling thread if prefetch is 0). stats["reader"] gets its busy time.
+    Starts at record resume_at[1] of segment resume_at[0].
+    """
+    stats["reader"] = 0.0
+    if not prefetch:
+        yield from _read(segments, batch_records, stats, resume_at)
+        return
+
+    batches = queue.Queue(maxsize=prefetch)
+
+    def read():
+        try:
+            for batch in _read(segments, batch_records, stats, resume_at):
+                batches.put(batch)
+            batches.put(None)
+        except BaseException as err:
+            batches.put(err)
+
+    thread = threading.Thread(target=read, daemon=True)
+    thread.start()
+    while True:
+        batch = batches.get()
+        if batch is None:
+            break
+        if isinstance(batch, BaseException):
+            raise batch
+        yield batch
+    thread.join()
+
+
+def assign_rows(numrows, entries0, missing0, entries1, missing1, first0, first1):
+    """
+    Rows of a batch of records (h0, h1), with the same result as adding them one by one in order: both hashes new:
+    a new row, one hash new: the row of the other one, none new: nothing to do. entries and missing are the lookups
+    of the hashes before the batch, first the index of the first occurrence of every hash in the batch.
+    Returns (rows, mask of the h0 added, mask of the h1 added, number of new rows)
+    """
+    num = len(first0)
+    records = np.arange(num)
+    earlier0 = missing0 & (first0 != records)  # added by an earlier record of the batch
+    earlier1 = missing1 & (first1 != records)
+    new0 = missing0 & ~earlier0  # added by this record
+    new1 = missing1 & ~earlier1
+
+    rows = np.zeros(num, dtype=np.int64)
+    both_new = new0 & new1
+    num_new = int(both_new.sum())
+    rows[both_new] = np.arange(numrows, numrows + num_new)
+    rows[new0 & ~missing1] = entries1[new0 & ~missing1] & row_mask
+    rows[new1 & ~missing0] = entries0[new1 & ~missing0] & row_mask
+    # the other hash was added by an earlier record of the batch, whose row is known by now
+    for ii in np.flatnonzero((new0 & earlier1) | (new1 & earlier0)).tolist():
+        rows[ii] = rows[first1[ii]] if earlier1[ii] else rows[first0[ii]]
+    return rows, new0, new1, num_new
+
+
+def to_entries(rows, score_bin):
+    # utils.row_score_to_entry() of arrays
+    return (rows.astype(np.uint64) | np.uint64(score_bin) << np.uint64(56)).view(np.int64)
+
+
+def lookup(hash2row, hashes):
+    """
+    Entries of hashes in a map and the mask of the ones missing
+    """
+    entries = np.empty(len(hashes), dtype=np.int64)
+    found = Int64toInt64Map_to(hash2row, hashes, entries, stop_at_unknown=False, default_value=unknown)
+    missing = entries == unknown
+    if found != len(hashes) - missing.sum():
+        missing = np.array([hh not in hash2row for hh in hashes.tolist()], dtype=bool)
+    return entries, missing
+
+
+def insert(hash2row, hashes, entries):
+    hash2row.update(Int64toInt64Map_from_buffers(hashes, entries))
+
+
+class LocalTable:
+    """
+    hash -> entry maps of all languages in this process
+    """
+
+    def __init__(self, langs, capacities):
+        self.maps = {lang: Int64toInt64Map(number_of_elements_hint=capacities.get(lang)) for lang in langs}
+        self.busy = 0.0
+        self.pending = None
+
+    def request_lookup(self, lang0, hashes0, lang1, hashes1):
+        t0 = time()
+        self.pending = lookup(self.maps[lang0], hashes0) + lookup(self.maps[lang1], hashes1)
+        self.busy += time() - t0
+
+    def wait_lookup(self):
+        # (entries0, missing0, entries1, missing1) of the last request_lookup()
+        pending, self.pending = self.pending, None
+        return pending
+
+    def insert(self, lang, hashes, entries):
+        t0 = time()
+        insert(self.maps[lang], hashes, entries)
+        self.busy += time() - t0
+
+    def sizes(self):
+        return {lang: len(hash2row) for lang, hash2row in self.maps.items()}
+
+    def stats(self):
+        # cykhash does not expose the memory of its maps
+        return None
+
+    def close(self):
+        return [self.busy]
+
+
+class FlatTable:
+    """
+    hash -> entry maps of all languages in one open-addressing table over two numpy arrays, keyed by (language, hash).
+    keys holds the hashes, values the entries with the language in bits 49-55 (so rows have to stay below 2**49),
+    0 marks an empty slot. Linear probing from a multiplicative hash of (language, hash), scaled to the number of
+    slots, which need not be a power of 2. Batches are looked up and inserted with numpy, one probe step at a time.
+    The table is allocated at capacities / max_load slots (see plan_table.py) and grows by grow_factor when it would
+    be more than max_load full. stats() has its exact memory.
+    """
+
+    max_load = 0.75
+    grow_factor = 1.5  # lower than doubling: old and new arrays exist at once while growing
+    slot_bytes = 16
+    lang_shift = 49
+    lang_mask = 127 << lang_shift
+    min_slots = 2**16
+
+    def __init__(self, langs, capacities):
+        if len(langs) >= 127:
+            raise ValueError(f"FlatTable holds up to 126 languages, not {len(langs)}")
+        self.lang_ids = {lang: ii + 1 for ii, lang in enumerate(langs)}
+        self.counts = {lang: 0 for lang in langs}
+        self.resizes = 0
+        self.resize_seconds = 0.0
+        self._allocate(sum(capacities.get(lang, 0) for lang in langs) / self.max_load)
+        self.busy = 0.0
+        self.pending = None
+
+    def _allocate(self, num_slots):
+        # np.zeros gets pages from the OS as they are touched
+        self.num_slots = max(self.min_slots, int(np.ceil(num_slots)))
+        self.keys = np.zeros(self.num_slots, dtype=np.int64)
+        self.values = np.zeros(self.num_slots, dtype=np.int64)
+
+    def _home(self, lang_ids, hashes):
+        # first slot of every key: the top 53 bits of a multiplicative hash, scaled to [0, num_slots)
+        lang_ids = np.asarray(lang_ids, dtype=np.uint64).reshape(-1)  # arrays wrap around without warnings
+        mixed = (hashes.view(np.uint64) ^ (lang_ids * np.uint64(0x9E3779B97F4A7C15))) * np.uint64(0xBF58476D1CE4E5B9)
+        slots = ((mixed >> np.uint64(11)).astype(np.float64) * (self.num_slots / 2**53)).astype(np.int64)
+        return np.minimum(slots, self.num_slots - 1)
+
+    def _next(self, slots):
+        slots += 1
+        slots[slots == self.num_slots] = 0
+        return slots
+
+    def _find(self, lang_id, hashes):
+        # slot of every hash and whether it is there: if not, the slot is the empty one that ended its search
+        slots = self._home(lang_id, hashes)
+        found = np.zeros(len(hashes), dtype=bool)
+        tag = np.int64(lang_id << self.lang_shift)
+        todo = np.arange(len(hashes))
+        while len(todo):
+            values = self.values[slots[todo]]
+            hit = (self.keys[slots[todo]] == hashes[todo]) & (values & self.lang_mask == tag)
+            found[todo[hit]] = True
+            todo = todo[~hit & (values != 0)]
+            slots[todo] = self._next(slots[todo])
+        return slots, found
+
+    def _place(self, lang_ids, hashes, values):
+        """
+        Puts keys that are not in the table, without duplicates, into the first empty slot of their probe sequence.
+        Of several keys reaching the same empty slot in a step, the first one takes it and the others go on.
+        """
+        slots = self._home(lang_ids, hashes)
+        todo = np.arange(len(hashes))
+        while len(todo):
+            free = np.flatnonzero(self.values[slots[todo]] == 0)
+            taken, first = np.unique(slots[todo[free]], return_index=True)
+            winners = todo[free[first]]
+            self.keys[taken] = hashes[winners]
+            self.values[taken] = values[winners]
+            placed = np.zeros(len(todo), dtype=bool)
+            placed[free[first]] = True
+            todo = todo[~placed]
+            slots[todo] = self._next(slots[todo])
+
+    def _grow(self, num_entries):
+        t0 = time()
+        keys, values = self.keys, self.values
+        self._allocate(max(self.num_slots * self.grow_factor, num_entries / self.max_load))
+        self.resizes += 1
+        step = 2**20  # slots moved at once, the temporary arrays of a step are several times their size
+        for start in range(0, len(keys), step):
+            used = np.flatnonzero(values[start : start + step]) + start
+            lang_ids = (values[used] & self.lang_mask) >> self.lang_shift
+            self._place(lang_ids, keys[used], values[used])
+        self.resize_seconds += time() - t0
+
+    def lookup(self, lang, hashes):
+        """
+        Entries of hashes of a language and the mask of the ones missing, like lookup() of a map
+        """
+        slots, found = self._find(self.lang_ids[lang], hashes)
+        entries = np.full(len(hashes), unknown, dtype=np.int64)
+        entries[found] = self.values[slots[found]] & ~self.lang_mask
+        return entries, ~found
+
+    def request_lookup(self, lang0, hashes0, lang1, hashes1):
+        t0 = time()
+        self.pending = self.lookup(lang0, hashes0) + self.lookup(lang1, hashes1)
+        self.busy += time() - t0
+
+    def wait_lookup(self):
+        # (entries0, missing0, entries1, missing1) of the last request_lookup()
+        pending, self.pending = self.pending, None
+        return pending
+
+    def insert(self, lang, hashes, entries):
+        """
+        Adds entries of hashes of a language that are not in the table yet, without duplicates
+        """
+        t0 = time()
+        if ((entries & row_mask) >> self.lang_shift).any():
+            raise ValueError(f"FlatTable holds rows below 2**{self.lang_shift}")
+        num_entries = sum(self.counts.values()) + len(hashes)
+        if num_entries > self.max_load * self.num_slots:
+            self._grow(num_entries)
+        lang_id = self.lang_ids[lang]
+        self._place(lang_id, hashes, entries | np.int64(lang_id << self.lang_shift))
+        self.counts[lang] += len(hashes)
+        self.busy += time() - t0
+
+    def sizes(self):
+        return dict(self.counts)
+
+    def stats(self):
+        # memory of the table: bytes, slots, entries, and resizes and the seconds they took
+        return dict(
+            bytes=self.keys.nbytes + self.values.nbytes,
+            slots=self.num_slots,
+            entries=sum(self.counts.values()),
+            resizes=self.resizes,
+            resize_seconds=self.resize_seconds,
+        )
+
+    def close(self):
+        return [self.busy]
+
+
+class DiskTable:
+    """
+    hash -> entry maps of all languages within about max_memory bytes. The entries of a language are sorted runs of
+    hashes and entries in run_dir, memory-mapped and searched with np.searchsorted, plus a map of the entries added
+    since its last flush (its delta). A batch only touches the two languages of its lang pair, so the deltas act as a
+    cache of the languages in use: when they would take more than max_memory, the deltas of the languages used least
+    recently are sorted and written as new runs. The newest runs of a language are merged while the last is at least
+    half the size of the one before, which keeps O(log entries) runs per language.
+    Only the deltas count against max_memory; the pages of the runs belong to the page cache.
+    """
+
+    entry_bytes = 64  # memory per delta entry: the map, with room to grow, and the arrays kept to write the run
+    merge_records = 2**21  # records per step of merging two runs
+
+    def __init__(self, langs, run_dir, max_memory):
+        shutil.rmtree(run_dir, ignore_errors=True)
+        os.makedirs(run_dir)
+        self.run_dir = run_dir
+        self.max_entries = max(1, max_memory // self.entry_bytes)
+        self.runs = {lang: [] for lang in langs}  # [(file name, hashes, entries), ...], oldest and largest first
+        self.deltas = {lang: Int64toInt64Map() for lang in langs}
+        self.added = {lang: [] for lang in langs}  # (hashes, entries) arrays in the delta
+        self.delta_entries = 0
+        self.last_use = {lang: 0 for lang in langs}
+        self.uses = 0
+        self.num_runs = 0
+        self.flushed = 0  # entries written as new runs
+        self.merged = 0  # entries written by merges
+        self.busy = 0.0
+        self.pending = None
+
+    def _use(self, lang):
+        self.uses += 1
+        self.last_use[lang] = self.uses
+
+    def _lookup(self, lang, hashes):
+        self._use(lang)
+        entries, missing = lookup(self.deltas[lang], hashes)
+        todo = np.flatnonzero(missing)
+        if self.runs[lang] and len(todo):
+            # sorted keys walk the runs in order, so the pages they touch are mostly the same ones
+            order = todo[np.argsort(hashes[todo])]
+            keys = hashes[order]
+            for _, run_hashes, run_entries in self.runs[lang]:
+                pos = np.minimum(np.searchsorted(run_hashes, keys), len(run_hashes) - 1)
+                hit = run_hashes[pos] == keys
+                entries[order[hit]] = run_entries[pos[hit]]
+                missing[order[hit]] = False
+        return entries, missing
+
+    def request_lookup(self, lang0, hashes0, lang1, hashes1):
+        t0 = time()
+        self.pending = self._lookup(lang0, hashes0) + self._lookup(lang1, hashes1)
+        self.busy += time() - t0
+
+    def wait_lookup(self):
+        # (entries0, missing0, entries1, missing1) of the last request_lookup()
+        pending, self.pending = self.pending, None
+        return pending
+
+    def insert(self, lang, hashes, entries):
+        if not len(hashes):
+            return
+        t0 = time()
+        self._use(lang)
+        insert(self.deltas[lang], hashes, entries)
+        self.added[lang].append((hashes, entries))
+        self.delta_entries += len(hashes)
+        while self.delta_entries > self.max_entries:
+            self._flush(min((lang for lang in self.added if self.added[lang]), key=self.last_use.get))
+        self.busy += time() - t0
+
+    def _new_run(self, lang):
+        name = f"{self.run_dir}/{lang}_{self.num_runs}"
+        self.num_runs += 1
+        return name
+
+    def _open_run(self, name):
+        hashes = np.memmap(f"{name}.hash", dtype=np.int64, mode="r")
+        return name, hashes, np.memmap(f"{name}.entry", dtype=np.int64, mode="r")
+
+    def _flush(self, lang):
+        hashes = np.concatenate([hh for hh, _ in self.added[lang]])
+        entries = np.concatenate([ee for _, ee in self.added[lang]])
+        order = np.argsort(hashes)
+        name = self._new_run(lang)
+        hashes[order].tofile(f"{name}.hash")
+        entries[order].tofile(f"{name}.entry")
+        self.runs[lang].append(self._open_run(name))
+        self.deltas[lang] = Int64toInt64Map()
+        self.added[lang] = []
+        self.delta_entries -= len(hashes)
+        self.flushed += len(hashes)
+
+        runs = self.runs[lang]
+        while len(runs) > 1 and 2 * len(runs[-1][1]) >= len(runs[-2][1]):
+            runs[-2:] = [self._merge(lang, runs[-2], runs[-1])]
+
+    def _merge(self, lang, run_a, run_b):
+        """
+        Merges two runs of a language step by step: each step takes up to merge_records records of each run, cut at
+        the smaller of their last hashes, so everything before the cut is in the step
+        """
+        name_a, hashes_a, entries_a = run_a
+        name_b, hashes_b, entries_b = run_b
+        name = self._new_run(lang)
+        ii = jj = 0
+        with open(f"{name}.hash", "wb") as fhash, open(f"{name}.entry", "wb") as fentry:
+            while ii < len(hashes_a) or jj < len(hashes_b):
+                stop_a = min(ii + self.merge_records, len(hashes_a))
+                stop_b = min(jj + self.merge_records, len(hashes_b))
+                # a run whose rest is all in the step does not limit it
+                windows = ((hashes_a, stop_a), (hashes_b, stop_b))
+                lasts = [hashes[stop - 1] for hashes, stop in windows if stop < len(hashes)]
+                if lasts:
+                    cut = min(lasts)
+                    stop_a = ii + np.searchsorted(hashes_a[ii:stop_a], cut, side="right")
+                    stop_b = jj + np.searchsorted(hashes_b[jj:stop_b], cut, side="right")
+                hashes = np.concatenate([hashes_a[ii:stop_a], hashes_b[jj:stop_b]])
+                entries = np.concatenate([entries_a[ii:stop_a], entries_b[jj:stop_b]])
+                order = np.argsort(hashes)
+                hashes[order].tofile(fhash)
+                entries[order].tofile(fentry)
+                self.merged += len(hashes)
+                ii, jj = stop_a, stop_b
+        for old in (name_a, name_b):
+            os.remove(f"{old}.hash")
+            os.remove(f"{old}.entry")
+        return self._open_run(name)
+
+    def sizes(self):
+        return {lang: sum(len(run[1]) for run in runs) + len(self.deltas[lang]) for lang, runs in self.runs.items()}
+
+    def stats(self):
+        # the maps of the deltas are cykhash maps, whose memory is not exposed
+        return None
+
+    def close(self):
+        shutil.rmtree(self.run_dir, ignore_errors=True)
+        return [self.busy]
+
+
+def _shard(conn, table_class, langs, capacities):
+    """
+    Process of a ShardedTable shard: answers the messages of conn with a table_class table until None, then sends its
+    busy time
+    """
+    table = table_class(langs, capacities)
+    busy = 0.0
+    while True:
+        message = conn.recv()
+        t0 = time()
+        if message is None:
+            break
+        if message[0] == "lookup":
+            table.request_lookup(*message[1:])
+            conn.send(table.wait_lookup())
+        elif message[0] == "insert":
+            table.insert(*message[1:])
+        elif message[0] == "sizes":
+            conn.send(table.sizes())
+        elif message[0] == "stats":
+            conn.send(table.stats())
+        busy += time() - t0
+    conn.send(busy)
+    conn.close()
+
+
+class ShardedTable:
+    """
+    hash -> entry maps of all languages, split over num_shards processes by hash % num_shards, each with a table of
+    table_class (LocalTable or FlatTable).
+    At most one lookup is outstanding: wait_lookup() has to be called before the next request_lookup() or sizes().
+    """
+
+    def __init__(self, langs, capacities, num_shards, table_class=LocalTable):
+        self.num_shards = num_shards
+        shard_capacities = {lang: -(-capacity // num_shards) for lang, capacity in capacities.items()}
+        self.conns = []
+        self.processes = []
+        for _ in range(num_shards):
+            conn, child_conn = mp.Pipe()
+            process = mp.Process(target=_shard, args=(child_conn, table_class, langs, shard_capacities), daemon=True)
+            process.start()
+            child_conn.close()
+            self.conns.append(conn)
+            self.processes.append(process)
+        self.pending = None
+
+    def _split(self, hashes):
+        # order of the hashes grouped by shard, and the bounds of the groups
+        shards = (hashes.view(np.uint64) % np.uint64(self.num_shards)).astype(np.intp)
+        order = np.argsort(shards, kind="stable")
+        bounds = np.concatenate([[0], np.cumsum(np.bincount(shards, minlength=self.num_shards))])
+        return order, bounds
+
+    def request_lookup(self, lang0, hashes0, lang1, hashes1):
+        order0, bounds0 = self._split(hashes0)
+        order1, bounds1 = self._split(hashes1)
+        for shard, conn in enumerate(self.conns):
+            conn.send(
+                (
+                    "lookup",
+                    lang0,
+                    hashes0[order0[bounds0[shard] : bounds0[shard + 1]]],
+                    lang1,
+                    hashes1[order1[bounds1[shard] : bounds1[shard + 1]]],
+                )
+            )
+        self.pending = (order0, order1)
+
+    def wait_lookup(self):
+        order0, order1 = self.pending
+        self.pending = None
+        replies = [conn.recv() for conn in self.conns]
+        results = []
+        for side, order in enumerate((order0, order1)):
+            for part, dtype in ((0, np.int64), (1, bool)):
+                values = np.empty(len(order), dtype=dtype)
+                values[order] = np.concatenate([reply[2 * side + part] for reply in replies])
+                results.append(values)
+        return tuple(results)
+
+    def insert(self, lang, hashes, entries):
+        order, bounds = self._split(hashes)
+        for shard, conn in enumerate(self.conns):
+            chosen = order[bounds[shard] : bounds[shard + 1]]
+            if len(chosen):
+                conn.send(("insert", lang, hashes[chosen], entries[chosen]))
+
+    def sizes(self):
+        for conn in self.conns:
+            conn.send(("sizes",))
+        totals = dict()
+        for conn in self.conns:
+            for lang, size in conn.recv().items():
+                totals[lang] = totals.get(lang, 0) + size
+        return totals
+
+    def stats(self):
+        # stats() of the tables of the shards added up, None if they have none
+        for conn in self.conns:
+            conn.send(("stats",))
+        replies = [conn.recv() for conn in self.conns]
+        if replies[0] is None:
+            return None
+        return {key: sum(reply[key] for reply in replies) for key in replies[0]}
+
+    def close(self):
+        # busy seconds of every shard
+        for conn in self.conns:
+            conn.send(None)
+        busy = [conn.recv() for conn in self.conns]
+        for process in self.processes:
+            process.join()
+        return busy
+
+
+def reload(table, lang, fname, num_records, chunk_records=2**22):
+    """
+    Inserts the first num_records entries of an output file of 03 (entry_dtype) into the table
+    """
+    with open(fname, "rb") as fin:
+        for start in range(0, num_records, chunk_records):
+            records = np.fromfile(fin, dtype=entry_dtype, count=min(chunk_records, num_records - start))
+            table.insert(lang, np.ascontiguousarray(records["hash"]), np.ascontiguousarray(records["entry"]))
+
+
+def load_checkpoint(fname):
+    # the state saved by Checkpoints.save(), None if there is none
+    if not os.path.exists(fname):
+        return None
+    with open(fname, "rb") as fin:
+        return pickle.load(fin)
+
+
+class Checkpoints:
+    """
+    Checkpoints of 03 in fname, at most one every interval seconds (never if interval is 0). save() only flushes the
+    output files; a thread fsyncs them and then replaces the checkpoint file, so a checkpoint never points past data
+    that is on disk. busy is the time 03 spent in save(), sync the time of the thread.
+    """
+
+    def __init__(self, fname, interval):
+        self.fname = fname
+        self.interval = interval
+        self.last = time()
+        self.thread = None
+        self.error = None
+        self.count = 0
+        self.busy = 0.0
+        self.sync = 0.0
+
+    def due(self):
+        return self.interval > 0 and time() - self.last >= self.interval
+
+    def save(self, out_files, state):
+        """
+        Saves state (a dict) plus the offsets of the output files {lang: file}
+        """
+        t0 = time()
+        state = dict(state, offsets=dict())
+        for lang, fout in out_files.items():
+            fout.flush()
+            state["offsets"][lang] = fout.tell()
+        self.wait()
+        self.thread = threading.Thread(target=self._write, args=([fout.fileno() for fout in out_files.values()], state))
+        self.thread.start()
+        self.count += 1
+        self.last = time()
+        self.busy += self.last - t0
+
+    def _write(self, fds, state):
+        t0 = time()
+        try:
+            for fd in fds:
+                os.fsync(fd)
+            with open(f"{self.fname}.part", "wb") as fout:
+                pickle.dump(state, fout)
+                fout.flush()
+                os.fsync(fout.fileno())
+            os.replace(f"{self.fname}.part", self.fname)
+        except BaseException as err:
+            self.error = err
+        self.sync += time() - t0
+
+    def wait(self):
+        # waits for the thread of the last save(), raising its error if it failed
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        if self.error is not None:
+            raise self.error
+
+    def close(self):
+        # waits for the last checkpoint and removes the file: the table is complete
+        self.wait()
+        if os.path.exists(self.fname):
+            os.remove(self.fname)
+
+
+class Metrics:
+    """
+    Counters of 03, appended to fname as JSON lines at most every interval seconds (never if interval is 0, and then
+    03 does not count). A line has the totals so far of the records by branch (new row, h0 added to the row of h1, h1
+    added to the row of h0, both present) and of the hits and misses of the lookups and bytes written per language,
+    the records and seconds of every file since the previous line, and the state 03 passes to write().
+    """
+
+    def __init__(self, fname, interval):
+        self.enabled = interval > 0
+        self.interval = interval
+        self.last = time()
+        self.fout = open(fname, "w") if self.enabled else None
+        self.branches = dict(new_row=0, attach_h0=0, attach_h1=0, both_present=0)
+        self.langs = dict()  # lang -> dict(hits, misses, bytes)
+        self.files = dict()  # file name -> [records, seconds] since the last line
+
+    def _lang(self, lang):
+        return self.langs.setdefault(lang, dict(hits=0, misses=0, bytes=0))
+
+    def count_batch(self, lang0, new0, lang1, new1):
+        """
+        Counts a batch from the hashes it inserted (new, see assign_rows): a miss is a hash inserted, anything else a
+        hit, also a repeat within the batch of a hash that was missing before it, since its first occurrence added it
+        """
+        both = int(np.count_nonzero(new0 & new1))
+        num_new0 = int(np.count_nonzero(new0))
+        num_new1 = int(np.count_nonzero(new1))
+        self.branches["new_row"] += both
+        self.branches["attach_h0"] += num_new0 - both
+        self.branches["attach_h1"] += num_new1 - both
+        self.branches["both_present"] += len(new0) - num_new0 - num_new1 + both
+        for lang, new, misses in ((lang0, new0, num_new0), (lang1, new1, num_new1)):
+            counts = self._lang(lang)
+            counts["hits"] += len(new) - misses
+            counts["misses"] += misses
+
+    def count_written(self, lang, num_bytes):
+        self._lang(lang)["bytes"] += num_bytes
+
+    def count_file(self, fname, num_records, seconds):
+        counts = self.files.setdefault(fname, [0, 0.0])
+        counts[0] += num_records
+        counts[1] += seconds
+
+    def due(self):
+        return self.enabled and time() - self.last >= self.interval
+
+    def write(self, state):
+        files = {
+            fname: dict(
+                records=records, seconds=round(seconds, 3), records_per_second=round(records / max(seconds, 1e-9))
+            )
+            for fname, (records, seconds) in self.files.items()
+        }
+        line = dict(state, branches=self.branches, langs=self.langs, files=files)
+        self.fout.write(json.dumps(line) + "\n")
+        self.fout.flush()
+        self.files = dict()
+        self.last = time()
+
+    def close(self, state):
+        # writes the last line
+        if self.enabled:
+            self.write(state)
+            self.fout.close()
@@ -0,0 +1,50 @@
+#  Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License").
+#  You may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+
+import json
+import os
+import subprocess
+import sys
+
+import pytest
+
+code_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# sets the config overrides before the script imports config, like editing config.py
+_runner = """
+import json, runpy, sys
+import config
+for name, value in json.loads(sys.argv[1]).items():
+    setattr(config, name, value)
+script = sys.argv[2]
+sys.argv = sys.argv[2:]
+runpy.run_path(script, run_name="__main__")
+"""
+
+
+@pytest.fixture
+def run_script():
+    """
+    run_script(workdir, script, overrides=None, args=()) runs a step of data_creation/ in workdir, with the names of
+    config.py in overrides set, and returns its output. Fails the test if the step fails.
+    """
+
+    def run(workdir, script, overrides=None, args=()):
+        env = dict(os.environ, PYTHONPATH=os.pathsep.join([code_dir, os.path.dirname(code_dir)]))
+        command = [sys.executable, "-c", _runner, json.dumps(overrides or {}), os.path.join(code_dir, script), *args]
+        result = subprocess.run(command, cwd=workdir, env=env, capture_output=True, text=True)
+        assert result.returncode == 0, result.stdout[-2000:] + result.stderr[-2000:]
+        return result.stdout
+
+    return run
@@ -0,0 +1,93 @@
+#  Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License").
+#  You may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+
+
+"""
+The containers made by build_container() of 02_hash_and_bin.py give 03 the same segments and records as the
+per-pair bin files they were merged from.
+Run from data_creation/ with python3 -m pytest tests
+"""
+
+import importlib
+import os
+import sys
+
+import numpy as np
+import pytest
+
+sys.path.append(".")
+sys.path.append("../")
+
+from ccmatrix_utils.ccmatrix_langpairs import CCMATRIX_LANG_PAIRS
+from table_builder import _read
+from utils import bin_file, bin_segments, block_index_file, hash_pair_dtype, read_container_index
+
+hash_and_bin = importlib.import_module("02_hash_and_bin")
+
+num_bins = 3
+lang_pairs = sorted(CCMATRIX_LANG_PAIRS[:4])
+
+
+def write_pair_dirs(bin_dir):
+    rng = np.random.default_rng(0)
+    for pair_ii, lang_pair in enumerate(lang_pairs):
+        os.makedirs(f"{bin_dir}/{lang_pair}")
+        for bin_idx in range(num_bins):
+            # the first pair has an empty bin
+            num_records = 0 if pair_ii == bin_idx == 0 else int(rng.integers(1, 50))
+            records = np.empty(num_records, dtype=hash_pair_dtype)
+            records["h0"] = rng.integers(-(2**63), 2**63 - 1, num_records)
+            records["h1"] = rng.integers(-(2**63), 2**63 - 1, num_records)
+            records.tofile(bin_file(f"{bin_dir}/{lang_pair}", bin_idx))
+
+
+def read_all(segments, batch_records=7):
+    stats = dict(reader=0.0)
+    return [
+        (score_bin, lang_pair, h0.tobytes(), h1.tobytes())
+        for _, score_bin, lang_pair, h0, h1, _, _ in _read(segments, batch_records, stats, (0, 0))
+    ]
+
+
+@pytest.fixture
+def containers(tmp_path, monkeypatch):
+    bin_dir = str(tmp_path / "binned_data")
+    write_pair_dirs(bin_dir)
+    pair_segments = bin_segments(bin_dir)
+    pair_records = read_all(pair_segments)
+    monkeypatch.setattr(hash_and_bin, "bin_dir", bin_dir)
+    for bin_idx in range(num_bins):
+        hash_and_bin.build_container((bin_idx, lang_pairs))
+    return bin_dir, pair_segments, pair_records
+
+
+def test_containers_match_pair_dirs(containers):
+    bin_dir, pair_segments, pair_records = containers
+    assert not any(os.path.exists(bin_file(f"{bin_dir}/{lang_pair}", 0)) for lang_pair in lang_pairs)
+    segments = bin_segments(bin_dir)
+    assert [(s[0], s[1], s[4]) for s in segments] == [(s[0], s[1], s[4]) for s in pair_segments]
+    assert {s[2] for s in segments} == {bin_file(bin_dir, bin_idx) for bin_idx in range(num_bins)}
+    assert read_all(segments) == pair_records
+
+
+def test_container_index_of_another_container(containers):
+    bin_dir = containers[0]
+    container = bin_file(bin_dir, 1)
+    with open(container, "ab") as fout:
+        fout.write(np.zeros(1, dtype=hash_pair_dtype).tobytes())
+    assert read_container_index(container) is None
+    with pytest.raises(IOError, match="has no index"):
+        bin_segments(bin_dir)
+    os.remove(block_index_file(container))
+    assert read_container_index(container) is None
@@ -0,0 +1,123 @@
+#  Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License").
+#  You may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+
+
+"""
+03_build_table.py writes the same bytes as the record by record loop it replaced (reference_table() below), with
+every table store.
+Run from data_creation/ with python3 -m pytest tests
+"""
+
+import os
+import pickle
+import sys
+from glob import glob
+
+import numpy as np
+import pytest
+
+sys.path.append(".")
+sys.path.append("../")
+
+from ccmatrix_utils.ccmatrix_langpairs import CCMATRIX_LANGS
+from config import sentence_hash
+from cykhash import Int64toInt64Map
+from utils import bin_file, entry_to_row_score, hash_pair_dtype, row_score_to_entry, write_hash_manifest
+
+lang_pairs = ["af-da", "af-de", "da-de", "de-en", "en-es"]
+num_bins = 4
+
+
+def write_binned_data(bin_dir, seed=0):
+    """
+    Random records of a few hundred hashes per language, so that most sentences recur: within a batch, across lang
+    pairs and across bins
+    """
+    rng = np.random.default_rng(seed)
+    pools = {lang: rng.integers(1, 2**63 - 1, 300) for lang in ("af", "da", "de", "en", "es")}
+    for lang_pair in lang_pairs:
+        lang0, lang1 = lang_pair.split("-")
+        os.makedirs(f"{bin_dir}/{lang_pair}")
+        for bin_idx in range(num_bins):
+            num_records = int(rng.integers(0, 400))
+            records = np.empty(num_records, dtype=hash_pair_dtype)
+            records["h0"] = rng.choice(pools[lang0], num_records)
+            records["h1"] = rng.choice(pools[lang1], num_records)
+            records.tofile(bin_file(f"{bin_dir}/{lang_pair}", bin_idx))
+    write_hash_manifest(bin_dir, sentence_hash, pre_dedup=False)
+
+
+def reference_table(bin_dir):
+    """
+    The loop of 03 before it was vectorized, one record at a time (files in the order of bin_segments(): highest bin
+    first, lang pairs in name order). Returns ({lang: bytes of tables_hashed/<lang>.bin}, numrows)
+    """
+    numrows = 0
+    hash2row = {lang: Int64toInt64Map() for lang in CCMATRIX_LANGS}
+    out = {lang: bytearray() for lang in CCMATRIX_LANGS}
+
+    def add(lang, hh, entry):
+        hash2row[lang][hh] = entry
+        out[lang] += hh.to_bytes(8, byteorder="little", signed=True)
+        out[lang] += entry.to_bytes(8, byteorder="little", signed=True)
+
+    fnames = glob(f"{bin_dir}/*/bin*.bin")
+    fnames.sort(key=lambda fname: (-int(os.path.basename(fname)[len("bin") : -len(".bin")]), fname))
+    for fname in fnames:
+        score_bin = int(os.path.basename(fname)[len("bin") : -len(".bin")])
+        lang0, lang1 = os.path.basename(os.path.dirname(fname)).split("-")
+        with open(fname, "rb") as fin:
+            while True:
+                h0 = int.from_bytes(fin.read(8), byteorder="little", signed=True)
+                h1 = int.from_bytes(fin.read(8), byteorder="little", signed=True)
+                if not h1:  # end of file
+                    break
+                h0entry = hash2row[lang0].get(h0)
+                h1entry = hash2row[lang1].get(h1)
+                if h0entry is None and h1entry is None:
+                    new_entry = row_score_to_entry(numrows, score_bin)
+                    add(lang0, h0, new_entry)
+                    add(lang1, h1, new_entry)
+                    numrows += 1
+                elif h0entry is None:
+                    row1, _ = entry_to_row_score(h1entry)
+                    add(lang0, h0, row_score_to_entry(row1, score_bin))
+                elif h1entry is None:
+                    row0, _ = entry_to_row_score(h0entry)
+                    add(lang1, h1, row_score_to_entry(row0, score_bin))
+    return {lang: bytes(data) for lang, data in out.items()}, numrows
+
+
+@pytest.mark.parametrize(
+    "overrides, args",
+    [
+        ({}, []),
+        ({"table_store": "flat"}, []),
+        ({"table_shards": 2}, []),
+        ({"table_prefetch": 0}, []),
+        ({}, ["--max-memory", "0.00001"]),
+    ],
+    ids=["cykhash", "flat", "shards", "no_prefetch", "max_memory"],
+)
+def test_table_matches_record_loop(tmp_path, run_script, overrides, args):
+    write_binned_data(str(tmp_path / "binned_data"))
+    expected, expected_rows = reference_table(str(tmp_path / "binned_data"))
+    assert expected_rows and sum(map(len, expected.values()))
+
+    run_script(tmp_path, "03_build_table.py", overrides, args)
+    for lang in CCMATRIX_LANGS:
+        with open(tmp_path / "tables_hashed" / f"{lang}.bin", "rb") as fin:
+            assert fin.read() == expected[lang], lang
+    with open(tmp_path / "tables_hashed" / "numrows.pkl", "rb") as fin:
+        assert pickle.load(fin) == expected_rows
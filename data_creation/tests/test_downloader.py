@@ -0,0 +1,191 @@
+#  Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License").
+#  You may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+
+
+"""
+downloader.py against a local http.server: resuming after failed ranges, checksum mismatches and a server without
+Content-Length.
+Run from data_creation/ with python3 -m pytest tests
+"""
+
+import gzip
+import hashlib
+import json
+import os
+import sys
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+sys.path.append(".")
+sys.path.append("../")
+
+import downloader
+from downloader import download_files
+
+range_size = 1000
+
+
+class Handler(BaseHTTPRequestHandler):
+    # serves server.files, with range requests unless server.plain, failing the ranges starting at server.fail_from
+
+    def log_message(self, *args):
+        pass
+
+    def do_HEAD(self):
+        self.respond(head=True)
+
+    def do_GET(self):
+        self.respond(head=False)
+
+    def respond(self, head):
+        data = self.server.files[self.path.lstrip("/")]
+        start, end = 0, len(data)
+        ranged = not self.server.plain and "Range" in self.headers
+        if ranged:
+            first, last = self.headers["Range"][len("bytes=") :].split("-")
+            start, end = int(first), int(last) + 1 if last else len(data)
+        if not head:
+            self.server.requests.append((self.path, start))
+            if self.server.fail_from is not None and start >= self.server.fail_from:
+                self.send_error(503)
+                return
+        self.send_response(206 if ranged else 200)
+        if not self.server.plain:
+            self.send_header("Accept-Ranges", "bytes")
+            self.send_header("Content-Length", str(end - start))
+        self.end_headers()
+        if not head:
+            self.wfile.write(data[start:end])
+
+
+@pytest.fixture
+def server():
+    httpd = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    httpd.files = {}
+    httpd.plain = False
+    httpd.fail_from = None
+    httpd.requests = []
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    yield httpd
+    httpd.shutdown()
+    httpd.server_close()
+
+
+def serve(server, name, data):
+    server.files[name] = data
+    return f"http://127.0.0.1:{server.server_address[1]}/{name}"
+
+
+def download(tmp_path, jobs):
+    return download_files(jobs, str(tmp_path / "manifest.json"), 4, range_size, num_hashers=2)
+
+
+def sample(seed=0, num_lines=2000):
+    # hex digests do not compress much, so the file has a few dozen ranges
+    lines = (b"%d\t%s\n" % (ii, hashlib.sha256(b"%d %d" % (seed, ii)).hexdigest().encode()) for ii in range(num_lines))
+    return gzip.compress(b"".join(lines), mtime=0)
+
+
+def test_resume_fetches_only_missing_ranges(server, tmp_path, monkeypatch):
+    monkeypatch.setattr(downloader, "max_retries", 0)
+    data = sample()
+    url = serve(server, "a.tsv.gz", data)
+    dest = str(tmp_path / "a.tsv.gz")
+    server.fail_from = 5 * range_size
+    with pytest.raises(OSError):
+        download(tmp_path, [(url, dest)])
+    done = json.load(open(f"{dest}.part.ranges"))["done"]
+    assert sorted(done) == [0, 1, 2, 3, 4]
+
+    server.fail_from = None
+    server.requests.clear()
+    manifest = download(tmp_path, [(url, dest)])
+    assert open(dest, "rb").read() == data
+    assert not os.path.exists(f"{dest}.part") and not os.path.exists(f"{dest}.part.ranges")
+    assert sorted(start for _, start in server.requests) == list(range(5 * range_size, len(data), range_size))
+    assert manifest["a.tsv.gz"] == dict(size=len(data), sha256=hashlib.sha256(data).hexdigest(), url=url)
+
+
+def test_failed_range_cancels_the_rest(server, tmp_path, monkeypatch):
+    monkeypatch.setattr(downloader, "max_retries", 0)
+    data = sample(num_lines=4000)
+    url = serve(server, "a.tsv.gz", data)
+    server.fail_from = 0
+    with pytest.raises(OSError):
+        download(tmp_path, [(url, str(tmp_path / "a.tsv.gz"))])
+    num_ranges = (len(data) + range_size - 1) // range_size
+    # 4 connections: the failed range, the ones in flight, and at most a few started before the shutdown
+    assert len(server.requests) < num_ranges // 4
+
+
+def test_corrupt_file_in_manifest_is_downloaded_again(server, tmp_path):
+    data = sample()
+    url = serve(server, "a.tsv.gz", data)
+    dest = str(tmp_path / "a.tsv.gz")
+    download(tmp_path, [(url, dest)])
+    server.requests.clear()
+    download(tmp_path, [(url, dest)])
+    assert not server.requests
+
+    corrupt = bytearray(data)
+    corrupt[len(data) // 2] ^= 1
+    open(dest, "wb").write(corrupt)
+    download(tmp_path, [(url, dest)])
+    assert server.requests
+    assert open(dest, "rb").read() == data
+
+
+def test_adopting_files_without_manifest_entry(server, tmp_path):
+    good, bad = sample(0), bytearray(sample(1))
+    bad[len(bad) // 2] ^= 1
+    urls = [serve(server, "good.tsv.gz", good), serve(server, "bad.tsv.gz", bytes(bad))]
+    server.files["bad.tsv.gz"] = sample(1)  # the remote file is fine, the local copy is not
+    dests = [str(tmp_path / "good.tsv.gz"), str(tmp_path / "bad.tsv.gz")]
+    open(dests[0], "wb").write(good)
+    open(dests[1], "wb").write(bad)
+    manifest = download(tmp_path, list(zip(urls, dests)))
+    assert {path for path, _ in server.requests} == {"/bad.tsv.gz"}
+    assert open(dests[1], "rb").read() == sample(1)
+    assert manifest["good.tsv.gz"]["sha256"] == hashlib.sha256(good).hexdigest()
+
+
+def test_sha256_mismatch_of_job(server, tmp_path):
+    data = sample()
+    url = serve(server, "a.tsv.gz", data)
+    dest = str(tmp_path / "a.tsv.gz")
+    with pytest.raises(OSError, match="expected"):
+        download(tmp_path, [(url, dest, "0" * 64)])
+    assert not os.path.exists(dest) and not os.path.exists(f"{dest}.part")
+
+    open(dest, "wb").write(data)
+    server.requests.clear()
+    download(tmp_path, [(url, dest, hashlib.sha256(data).hexdigest())])
+    assert not server.requests
+
+
+def test_no_content_length(server, tmp_path):
+    server.plain = True
+    data = sample()
+    url = serve(server, "a.tsv.gz", data)
+    dest = str(tmp_path / "a.tsv.gz")
+    manifest = download(tmp_path, [(url, dest)])
+    assert open(dest, "rb").read() == data
+    assert manifest["a.tsv.gz"]["size"] == len(data)
+    assert server.requests == [("/a.tsv.gz", 0)]
+
+    with downloader.open_stream(url) as fin:
+        assert fin.read() == data
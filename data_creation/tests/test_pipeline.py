@@ -0,0 +1,129 @@
+#  Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License").
+#  You may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+
+
+"""
+The chunks a decompressor of pipeline.py fills into its slots hold the same bytes as read_chunks() of the same input.
+Run from data_creation/ with python3 -m pytest tests
+"""
+
+import gzip
+import io
+import os
+import sys
+import threading
+
+import pytest
+
+sys.path.append(".")
+sys.path.append("../")
+
+import pipeline
+from pipeline import Ring, _fill
+from utils import read_chunks
+
+slot_size = 20
+
+
+def fill_bytes(data, num_slots=2):
+    # what _fill() sends for data, as the consumer of raw_chunks() gets it
+    ring = Ring(1, num_slots, slot_size)
+    stats = dict(bytes=0, busy=0.0, wait=0.0)
+
+    def fill():
+        _fill(ring, 0, io.BytesIO(data), stats)
+        ring.full[0].put(("end",))
+
+    thread = threading.Thread(target=fill)
+    thread.start()
+    chunks = []
+    try:
+        while True:
+            message = ring.full[0].get(timeout=10)
+            if message[0] == "end":
+                break
+            if message[0] == "slot":
+                _, slot, size = message
+                chunks.append(bytes(ring.shm.buf[slot * slot_size : slot * slot_size + size]))
+                ring.free[0].put(slot)
+            else:
+                chunks.append(message[1])
+        thread.join()
+    finally:
+        ring.shm.close()
+        ring.shm.unlink()
+    return chunks
+
+
+@pytest.mark.parametrize(
+    "data",
+    [
+        b"",
+        b"0.50\ta\tbc\n" * 8,  # 80 bytes, every slot ends on a newline
+        b"0.5\ta\tb\n" * 3 + b"0.5\tc\td",  # the last line has no newline
+        b"0.5\tx\ty\n" + b"0.5\t" + b"z" * 45 + b"\tw\n",  # a line longer than a slot
+        b"0.5\ta\tb\n0.5\tc\td",
+        b"\n\n\n",
+    ],
+)
+def test_fill_matches_read_chunks(data):
+    chunks = fill_bytes(data)
+    assert all(chunk.endswith(b"\n") for chunk in chunks)
+    assert b"".join(chunks) == b"".join(read_chunks(io.BytesIO(data), slot_size))
+
+
+def first_chunk_then_fail(gz_file):
+    # reads one chunk and stops with an error, as a worker whose parsing fails
+    try:
+        for _ in pipeline.raw_chunks(gz_file, None, slot_size):
+            raise ValueError("parse error")
+    except ValueError:
+        pass
+    return b"".join(bytes(chunk) for chunk in pipeline.raw_chunks(gz_file, None, slot_size))
+
+
+def ring_pid(_):
+    return os.getpid(), id(pipeline._ring)
+
+
+@pytest.fixture
+def ring_pool(monkeypatch, tmp_path):
+    monkeypatch.setattr(pipeline, "pipeline_decompressors", 1)
+    monkeypatch.setattr(pipeline, "pipeline_slots", 2)
+    monkeypatch.setattr(pipeline, "parse_chunk_size", slot_size)
+    data = b"".join(b"0.5\tline %d\tzeile %d\n" % (ii, ii) for ii in range(50))
+    gz_file = str(tmp_path / "xx-yy.tsv.gz")
+    with gzip.open(gz_file, "wb") as fout:
+        fout.write(data)
+    with pipeline.worker_pool(1) as pool:
+        yield pool, gz_file, data
+
+
+def test_consumer_error_returns_slot(ring_pool):
+    # with the slot of the failed chunk lost, the ring runs out of its 2 slots and the decompressor waits forever
+    pool, gz_file, data = ring_pool
+    for _ in range(3):
+        assert pool.apply_async(first_chunk_then_fail, (gz_file,)).get(timeout=30) == data
+
+
+def test_replaced_worker_takes_over_ring(ring_pool):
+    pool, gz_file, data = ring_pool
+    pid, ring = pool.apply(ring_pid, (0,))
+    pool.apply_async(os._exit, (0,))  # a worker that exits while the pool goes on, its result never comes
+    for _ in range(100):  # the pool starts a new worker
+        new_pid, new_ring = pool.apply_async(ring_pid, (0,)).get(timeout=30)
+        if new_pid != pid:
+            break
+    assert new_pid != pid and new_ring == ring
+    assert pool.apply_async(first_chunk_then_fail, (gz_file,)).get(timeout=30) == data
@@ -0,0 +1,77 @@
+#  Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License").
+#  You may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+
+
+"""
+pre_dedup in 02_hash_and_bin.py drops records, but 03_build_table.py builds the same table from what is left.
+Run from data_creation/ with python3 -m pytest tests
+"""
+
+import gzip
+import os
+import re
+import sys
+from glob import glob
+
+import numpy as np
+
+sys.path.append(".")
+sys.path.append("../")
+
+from ccmatrix_utils.ccmatrix_langpairs import CCMATRIX_LANGS
+
+lang_pairs = ["af-da", "af-de", "da-de"]
+
+
+def write_raw_data(workdir, num_lines=3000, seed=0):
+    """
+    Lines of a few hundred sentences per language with random scores in random order, so sentences recur in all bins,
+    plus cutoffs of 5 bins
+    """
+    rng = np.random.default_rng(seed)
+    os.makedirs(f"{workdir}/raw_data")
+    for lang_pair in lang_pairs:
+        lang0, lang1 = lang_pair.split("-")
+        ids0 = rng.integers(0, 300, num_lines)
+        ids1 = rng.integers(0, 300, num_lines)
+        scores = rng.uniform(1.0, 1.3, num_lines)
+        lines = [f"{score:.6f}\t{lang0} s{id0}\t{lang1} s{id1}\n" for score, id0, id1 in zip(scores, ids0, ids1)]
+        with gzip.open(f"{workdir}/raw_data/{lang_pair}.tsv.gz", "wt", encoding="utf-8") as fout:
+            fout.write("".join(lines))
+    with open(f"{workdir}/cutoffs.txt", "w") as fout:
+        fout.write("".join(f"{edge}\n" for edge in (1.06, 1.12, 1.18, 1.24)))
+
+
+def num_records(bin_dir):
+    return sum(os.stat(fname).st_size for fname in glob(f"{bin_dir}/*/bin*.bin")) // 16
+
+
+def test_pre_dedup_keeps_the_table(tmp_path, run_script):
+    write_raw_data(tmp_path)
+    tables = dict()
+    for dedup in (False, True):
+        bin_dir, table_dir = f"binned_{dedup}", f"tables_{dedup}"
+        args = ["--bin-dir", bin_dir, "--lang-pairs", *lang_pairs]
+        output = run_script(tmp_path, "02_hash_and_bin.py", dict(pre_dedup=dedup), args)
+        if dedup:
+            total = re.search(r"pre_dedup: dropped ([\d,]+) of [\d,]+ records \(", output)  # of all tasks
+            dropped = int(total.group(1).replace(",", ""))
+        run_script(tmp_path, "03_build_table.py", dict(bin_dir=bin_dir, hash2row_dir=table_dir))
+        tables[dedup] = {lang: (tmp_path / table_dir / f"{lang}.bin").read_bytes() for lang in CCMATRIX_LANGS}
+        tables[dedup]["numrows.pkl"] = (tmp_path / table_dir / "numrows.pkl").read_bytes()
+
+    kept, all_records = num_records(tmp_path / "binned_True"), num_records(tmp_path / "binned_False")
+    assert all_records == 3 * 3000
+    assert dropped > 0 and kept == all_records - dropped
+    assert tables[True] == tables[False]
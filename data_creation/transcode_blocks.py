@@ -0,0 +1,138 @@
+#  Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License").
+#  You may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+
+
+"""
+One-time rewrite of the raw CCMatrix files in raw_data/ into block-indexed gzip (see utils.BlockWriter), in place.
+The rewritten files are still valid gzip files with the same content, plus a <file>.idx sidecar that lets the later
+steps decompress any range of blocks independently.
+The manifest entry of each file is updated to the new size and sha256 (the downloaded sha256 is kept as source_sha256).
+
+A file is transcoded into <file>.part and <file>.idx.part. As soon as a file is done, its manifest entry is written
+first, then the index and last the data file are renamed into place, so an interrupted run keeps the files it finished. If that is interrupted, the next run
+finds <file>.part with an index or a manifest entry that already describes it, and finishes the renames (finish()).
+"""
+
+import gzip
+import multiprocessing as mp
+import os
+import sys
+from time import time
+
+sys.path.append("../")
+
+from ccmatrix_utils.ccmatrix_langpairs import CCMATRIX_LANG_PAIRS
+from config import (
+    TESTING,
+    block_compresslevel,
+    block_size,
+    exclude_num,
+    gz_dir,
+    manifest_file,
+)
+from downloader import dump_json, file_sha256, load_manifest, verify_file
+from scheduler import pair_costs, run_lpt
+from utils import BlockWriter, block_index_file, read_block_index
+
+
+def finish(gz_file, entry):
+    """
+    Renames a transcoded <file>.part and its index into place if commit() got as far as the manifest or the index.
+    Returns whether it did. Any other .part files are leftovers of a transcode that did not finish.
+    """
+    idx_file = block_index_file(gz_file)
+    if not os.path.exists(f"{gz_file}.part"):
+        return False
+    if os.path.exists(f"{idx_file}.part"):
+        # the index was not renamed yet, so only the manifest tells whether commit() started
+        if not (entry.get("block_indexed") and entry.get("size") == os.stat(f"{gz_file}.part").st_size):
+            return False
+        os.replace(f"{idx_file}.part", idx_file)
+    elif not os.path.exists(idx_file):
+        return False
+    os.replace(f"{gz_file}.part", gz_file)
+    print(f"finished the interrupted transcode of {gz_file}", flush=True)
+    return True
+
+
+def commit(gz_file, manifest, result):
+    # the manifest entry, then the index, then the data: finish() can complete this from any point
+    if result is not None:
+        fname, size, sha256 = result
+        entry = manifest[fname]
+        entry.setdefault("source_sha256", entry["sha256"])
+        entry.update(size=size, sha256=sha256, block_indexed=True)
+        dump_json(manifest, manifest_file)
+    if os.path.exists(f"{gz_file}.part"):
+        os.replace(f"{block_index_file(gz_file)}.part", block_index_file(gz_file))
+        os.replace(f"{gz_file}.part", gz_file)
+
+
+def transcode(lang_pair):
+    """
+    Transcodes a raw file into <file>.part and <file>.idx.part, for commit().
+    Returns (file name, new size, new sha256) for the manifest, or None if the manifest is already up to date
+    """
+    gz_file = f"{gz_dir}/{lang_pair}.tsv.gz"
+    manifest = load_manifest(manifest_file)
+    entry = manifest.get(os.path.basename(gz_file), {})
+
+    if finish(gz_file, entry) or read_block_index(gz_file) is not None:
+        print(f"{gz_file} is already block-indexed", flush=True)
+        for part in (f"{gz_file}.part", f"{block_index_file(gz_file)}.part"):
+            if os.path.exists(part):
+                os.remove(part)
+    else:
+        if manifest and not verify_file(gz_file, manifest):
+            raise IOError(f"{gz_file} does not match {manifest_file}, re-run 00_download_data.py")
+
+        t0 = time()
+        with gzip.open(gz_file, "rb") as fin:
+            fout = BlockWriter(gz_file, block_size, block_compresslevel)
+            while True:
+                data = fin.read(block_size)
+                if not data:
+                    break
+                fout.write(data)
+            fout.close(replace=False)
+
+        print(
+            f"transcoded {gz_file} into {len(fout.index) // 3:,} blocks in {time() - t0:.1f}s",
+            flush=True,
+        )
+
+    if not manifest or entry.get("block_indexed"):
+        return None
+    done_file = f"{gz_file}.part" if os.path.exists(f"{gz_file}.part") else gz_file
+    return os.path.basename(gz_file), os.stat(done_file).st_size, file_sha256(done_file)
+
+
+if __name__ == "__main__":
+    lang_pairs = CCMATRIX_LANG_PAIRS
+    if TESTING:
+        lang_pairs = lang_pairs[exclude_num:]
+
+    num_cpus = mp.cpu_count()
+    print(f"num language pairs: {len(lang_pairs)}, num cpus: {num_cpus}", flush=True)
+
+    manifest = load_manifest(manifest_file)
+    with mp.Pool(num_cpus) as pool:
+        run_lpt(
+            pool,
+            transcode,
+            lang_pairs,
+            pair_costs(lang_pairs),
+            num_cpus,
+            on_result=lambda lang_pair, result: commit(f"{gz_dir}/{lang_pair}.tsv.gz", manifest, result),
+        )
@@ -0,0 +1,329 @@
+#  Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License").
+#  You may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+
+
+"""
+Adds new lang pairs (or a new release of some) to a finished table, instead of running 02 to 05 on the whole corpus:
+
+    python3 02_hash_and_bin.py --lang-pairs xx-yy --bin-dir binned_update
+    python3 update_table.py --bin-dir binned_update --name xx-yy
+
+The update is applied as if its score bins came after all bins of the table. Rows and entries already in the table
+never change, and the records of the update are added in the order of 03_build_table.py (highest bin first) with the
+same three cases:
+- both sentences are new: a new row, numbered after the existing ones
+- one sentence is new: it joins the row of the other one with the bin of the new record. 05_make_shards.py shows it
+  instead of the sentence the row already has in that language only if its bin is higher
+- both sentences are in the table: nothing, even if the new record scores higher than the records that made their rows.
+  Rows are never merged or split, so a full rebuild may group these sentences differently
+
+The new entries are appended to tables_hashed/<lang>.bin, giving the table 03 would build from the existing binned
+data followed by the update's. The text of the new sentences, from a scan of the raw data of the update's lang pairs
+only, is appended to hash2sent/bucketNNN/hash2sent_<lang>.*, and the shards of the buckets with a new or changed row
+are made again.
+
+tables_hashed/update_<name>.json records the size of every file the update appends to, so --rollback <name> can undo
+it (and makes the shards of those buckets again). Only the newest update can be rolled back: the files are cut back to
+their sizes before it, which would also drop the updates after it.
+
+A table made with table_mode = "components" cannot be updated: new records can merge its rows.
+"""
+
+import argparse
+import gzip
+import importlib
+import json
+import multiprocessing as mp
+import os
+import pickle
+import shutil
+import sys
+from glob import glob
+from time import time
+
+import numpy as np
+
+sys.path.append("../")
+
+from components import components_file
+from config import (
+    gz_dir,
+    hash2row_dir,
+    hash2sent_dir,
+    num_buckets,
+    sentence_hash,
+    table_plan_file,
+    table_prefetch,
+    table_store,
+    task_bytes,
+)
+from cykhash import Int64toInt64Map_from_buffers
+from downloader import dump_json
+from pipeline import worker_pool
+from scheduler import block_tasks, lang_costs, run_lpt
+from table_builder import FlatTable, LocalTable, assign_rows, entry_dtype, read_batches, reload, to_entries
+from utils import bin_segments, check_hash_manifest, entry_to_row_score, myhash2int, table_capacities
+
+hash2sent = importlib.import_module("04_build_hash2sent")
+make_shards = importlib.import_module("05_make_shards")
+
+read_records = 2**18  # (h0, h1) records added at once
+
+
+def journal_file(name):
+    return f"{hash2row_dir}/update_{name}.json"
+
+
+def hash2sent_files(langs):
+    # files of hash2sent/ that an update of langs appends to
+    return [
+        f"{hash2sent_dir}/bucket{bucket:03}/hash2sent_{lang}.{ext}"
+        for bucket in range(num_buckets)
+        for lang in langs
+        for ext in ("bin", "txt.gz")
+    ]
+
+
+def apply_update(segments, langs, offsets, numrows):
+    """
+    Adds the records of the segments to the table of langs, appending the new entries to tables_hashed/<lang>.bin.
+    Returns (numrows, mask of the buckets with a new or changed row)
+    """
+    t0 = time()
+    table_class = {"cykhash": LocalTable, "flat": FlatTable}[table_store]
+    table = table_class(langs, table_capacities(table_plan_file))
+    for lang in langs:
+        reload(table, lang, f"{hash2row_dir}/{lang}.bin", offsets[lang] // entry_dtype.itemsize)
+    print(f"loaded the table of {len(langs)} languages in {time() - t0:.1f}s", flush=True)
+
+    out_files = {lang: open(f"{hash2row_dir}/{lang}.bin", "ab") for lang in langs}
+    buckets = np.zeros(num_buckets, dtype=bool)
+    stats = dict()
+    sent_pairs = 0
+    first_row = numrows
+    for _, score_bin, lang_pair, h0, h1, first0, first1 in read_batches(segments, read_records, table_prefetch, stats):
+        lang0, lang1 = lang_pair.split("-")
+        table.request_lookup(lang0, h0, lang1, h1)
+        entries0, missing0, entries1, missing1 = table.wait_lookup()
+        rows, new0, new1, num_new = assign_rows(numrows, entries0, missing0, entries1, missing1, first0, first1)
+        numrows += num_new
+        entries = to_entries(rows, score_bin)
+        for lang, hashes, new in ((lang0, h0, new0), (lang1, h1, new1)):
+            records = np.empty(int(new.sum()), dtype=entry_dtype)
+            records["hash"] = hashes[new]
+            records["entry"] = entries[new]
+            table.insert(lang, np.ascontiguousarray(records["hash"]), np.ascontiguousarray(records["entry"]))
+            records.tofile(out_files[lang])
+        buckets[np.unique(rows[new0 | new1] % num_buckets)] = True
+        sent_pairs += len(h0)
+    for fout in out_files.values():
+        fout.close()
+    table.close()
+
+    sizes = {lang: os.stat(f"{hash2row_dir}/{lang}.bin").st_size for lang in langs}
+    added = sum(sizes[lang] - offsets[lang] for lang in langs) // entry_dtype.itemsize
+    print(
+        f"added {sent_pairs:,} sent pairs: {numrows - first_row:,} new rows, {added:,} new entries, "
+        f"{buckets.sum()} buckets changed, t={time() - t0:.1f}s",
+        flush=True,
+    )
+    return numrows, buckets
+
+
+def append_text(task):
+    """
+    Appends the new sentences of a language to hash2sent/, task: (lang, lang pairs of the update, size of
+    tables_hashed/<lang>.bin before the update). The parts of the scan are read in the order of 04_build_hash2sent.py.
+    """
+    lang, lang_pairs, offset = task
+    t0 = time()
+    with open(f"{hash2row_dir}/{lang}.bin", "rb") as fin:
+        fin.seek(offset)
+        records = np.fromfile(fin, dtype=entry_dtype)
+    new_entries = Int64toInt64Map_from_buffers(
+        np.ascontiguousarray(records["hash"]), np.ascontiguousarray(records["entry"])
+    )
+
+    out_files = dict()  # opened when a bucket gets its first sentence, the others stay as they are
+
+    def bucket_files(bucket):
+        if bucket not in out_files:
+            os.makedirs(f"{hash2sent_dir}/bucket{bucket:03}", exist_ok=True)
+            out_files[bucket] = dict()
+            out_files[bucket]["text"] = gzip.open(f"{hash2sent_dir}/bucket{bucket:03}/hash2sent_{lang}.txt.gz", "ab")
+            out_files[bucket]["bin"] = open(f"{hash2sent_dir}/bucket{bucket:03}/hash2sent_{lang}.bin", "ab")
+        return out_files[bucket]
+
+    written = 0
+    for lang_pair in lang_pairs:
+        if lang not in lang_pair.split("-"):
+            continue
+        for part in sorted(glob(f"{hash2sent.parts_dir}/{lang_pair}.*.{lang}.bin")):
+            part = part[: -len(".bin")]
+            with open(f"{part}.bin", "rb") as fh_bin, gzip.open(f"{part}.txt.gz", "rb") as fh_text:
+                while True:
+                    hh = fh_bin.read(8)
+                    if not hh:
+                        break
+                    mysent = fh_text.readline()
+                    entry = new_entries.pop(myhash2int(hh), None)
+                    if entry is not None:  # a new entry, the first time it occurs
+                        row, _ = entry_to_row_score(entry)
+                        files = bucket_files(row % num_buckets)
+                        files["text"].write(mysent)
+                        files["bin"].write(hh)
+                        files["bin"].write(entry.to_bytes(8, byteorder="little", signed=True))
+                        written += 1
+            os.remove(f"{part}.bin")
+            os.remove(f"{part}.txt.gz")
+
+    for files in out_files.values():
+        files["text"].close()
+        files["bin"].close()
+    if len(new_entries):
+        raise ValueError(f"{len(new_entries):,} new {lang} sentences are not in the raw data of {lang_pairs}")
+    print(f"done lang {lang}: appended {written:,} sentences, t={time() - t0:.1f}s", flush=True)
+
+
+def remake_shards(buckets, num_workers):
+    with mp.Pool(num_workers) as pool:
+        pool.map(make_shards.go, buckets)
+
+
+def load_journal(fname):
+    with open(fname, "r") as fin:
+        return json.load(fin)
+
+
+def update(args):
+    name = args.name
+    for fname in glob(journal_file("*")):
+        if not load_journal(fname)["done"]:
+            sys.exit(f"{fname} did not finish, undo it with --rollback first")
+    if os.path.exists(journal_file(name)):
+        sys.exit(f"there is already an update {name}")
+    if os.path.exists(components_file(hash2row_dir)):
+        sys.exit(f"{hash2row_dir} holds connected components (table_mode components), run 03 to 05 again instead")
+    check_hash_manifest(args.bin_dir, sentence_hash)
+    check_hash_manifest(hash2row_dir, sentence_hash)
+
+    segments = bin_segments(args.bin_dir)
+    lang_pairs = sorted({lang_pair for _, lang_pair, _, _, _ in segments})
+    langs = sorted({lang for lang_pair in lang_pairs for lang in lang_pair.split("-")})
+    missing = [lang_pair for lang_pair in lang_pairs if not os.path.isfile(f"{gz_dir}/{lang_pair}.tsv.gz")]
+    if missing:
+        sys.exit(f"no raw data for {missing}, the text of the new sentences comes from it")
+    print(f"update {name}: {len(segments)} segments of {lang_pairs}", flush=True)
+
+    with open(f"{hash2row_dir}/numrows.pkl", "rb") as fin:
+        numrows = pickle.load(fin)
+    offsets = {lang: os.stat(f"{hash2row_dir}/{lang}.bin").st_size for lang in langs}
+    journal = dict(
+        name=name,
+        bin_dir=args.bin_dir,
+        lang_pairs=lang_pairs,
+        numrows=numrows,
+        offsets=offsets,
+        hash2sent={
+            fname: os.stat(fname).st_size if os.path.exists(fname) else None for fname in hash2sent_files(langs)
+        },
+        buckets=list(range(num_buckets)),  # until the changed buckets are known
+        done=False,
+        sequence=1 + max((load_journal(fname)["sequence"] for fname in glob(journal_file("*"))), default=0),
+    )
+    dump_json(journal, journal_file(name))
+
+    new_numrows, buckets = apply_update(segments, langs, offsets, numrows)
+    journal["buckets"] = np.flatnonzero(buckets).tolist()
+    journal["new_numrows"] = new_numrows
+    dump_json(journal, journal_file(name))
+    with open(f"{hash2row_dir}/numrows.pkl.part", "wb") as fout:
+        pickle.dump(new_numrows, fout)
+    os.replace(f"{hash2row_dir}/numrows.pkl.part", f"{hash2row_dir}/numrows.pkl")
+
+    t0 = time()
+    shutil.rmtree(hash2sent.parts_dir, ignore_errors=True)
+    os.makedirs(hash2sent.parts_dir)
+    num_cpus = mp.cpu_count()
+    tasks, costs = block_tasks(lang_pairs, task_bytes)
+    with worker_pool(num_cpus) as pool:
+        run_lpt(pool, hash2sent.scan, tasks, costs, num_cpus)
+        run_lpt(
+            pool,
+            append_text,
+            [(lang, lang_pairs, offsets[lang]) for lang in langs],
+            lang_costs(langs),
+            num_cpus,
+            labels=langs,
+        )
+    os.rmdir(hash2sent.parts_dir)
+    print(f"appended the new sentences to {hash2sent_dir} in {time() - t0:.1f}s", flush=True)
+
+    t0 = time()
+    remake_shards(journal["buckets"], args.shard_workers)
+    print(f"made the shards of {len(journal['buckets'])} buckets again in {time() - t0:.1f}s", flush=True)
+    journal["done"] = True
+    dump_json(journal, journal_file(name))
+
+
+def rollback(args):
+    name = args.rollback
+    if not os.path.exists(journal_file(name)):
+        sys.exit(f"there is no update {name}")
+    journal = load_journal(journal_file(name))
+    # the files are cut back to where they were before the update, which would also drop every later update
+    later = sorted(
+        (other["sequence"], other["name"])
+        for other in map(load_journal, glob(journal_file("*")))
+        if other["sequence"] > journal["sequence"]
+    )
+    if later:
+        sys.exit(f"updates {[other for _, other in later]} came after {name}, roll them back first, newest first")
+
+    for lang, offset in journal["offsets"].items():
+        with open(f"{hash2row_dir}/{lang}.bin", "r+b") as fout:
+            fout.truncate(offset)
+    with open(f"{hash2row_dir}/numrows.pkl.part", "wb") as fout:
+        pickle.dump(journal["numrows"], fout)
+    os.replace(f"{hash2row_dir}/numrows.pkl.part", f"{hash2row_dir}/numrows.pkl")
+    for fname, size in journal["hash2sent"].items():
+        if size is None:
+            if os.path.exists(fname):
+                os.remove(fname)
+        elif os.path.exists(fname):
+            with open(fname, "r+b") as fout:
+                fout.truncate(size)
+    shutil.rmtree(hash2sent.parts_dir, ignore_errors=True)
+
+    t0 = time()
+    remake_shards(journal["buckets"], args.shard_workers)
+    print(f"made the shards of {len(journal['buckets'])} buckets again in {time() - t0:.1f}s", flush=True)
+    os.remove(journal_file(name))
+    print(f"rolled back update {name}", flush=True)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser("Update the CCMatrix table")
+    parser.add_argument("--bin-dir", help="binned data of the update, from 02_hash_and_bin.py --lang-pairs")
+    parser.add_argument("--name", help="name of the update, for --rollback")
+    parser.add_argument("--rollback", metavar="NAME", help="undo the update NAME")
+    parser.add_argument("--shard-workers", type=int, default=20, help="buckets made at once (memory bound, see 05)")
+    args = parser.parse_args()
+
+    if args.rollback:
+        rollback(args)
+    elif args.bin_dir and args.name:
+        update(args)
+    else:
+        parser.error("give --bin-dir and --name, or --rollback")
@@ -13,12 +13,123 @@
 #  limitations under the License.
 
 
+import gzip
 import hashlib
+import io
+import json
+import math
+import os
+import pathlib
+from array import array
+from collections import Counter
+from glob import glob
+
+import numpy as np
+from ccmatrix_utils.ccmatrix_langpairs import CCMATRIX_LANG_PAIRS
 
 def myhash(s):
     return hashlib.md5(s.encode('utf-8')).digest()[:8]  # TODO: replace newline&tab with ' ', strip ?
 
 
+# Sentence hashes: 8 byte digests of the utf-8 encoded sentence. The one used is sentence_hash in config.py and is
+# recorded in a hash manifest in bin_dir and hash2row_dir (see check_hash_manifest). "md5" is myhash(), the hash of
+# tables made before sentence_hash existed.
+
+
+def _md5_64(b):
+    return hashlib.md5(b).digest()[:8]
+
+
+def _md5_64_batch(sents):
+    md5 = hashlib.md5
+    return [md5(b).digest()[:8] for b in sents]
+
+
+def _blake2b_64(b):
+    return hashlib.blake2b(b, digest_size=8).digest()
+
+
+def _blake2b_64_batch(sents):
+    blake2b = hashlib.blake2b
+    return [blake2b(b, digest_size=8).digest() for b in sents]
+
+
+def _xxhash(name):
+    try:
+        import xxhash
+    except ImportError:
+        raise ImportError(f"sentence_hash {name} needs the xxhash package (pip install xxhash)")
+    digest = getattr(xxhash, f"{name}_digest")
+    return digest, lambda sents: list(map(digest, sents))
+
+
+sentence_hashes = {
+    "md5": lambda: (_md5_64, _md5_64_batch),
+    "blake2b_64": lambda: (_blake2b_64, _blake2b_64_batch),
+    "xxh64": lambda: _xxhash("xxh64"),
+    "xxh3_64": lambda: _xxhash("xxh3_64"),
+}
+
+
+def get_sentence_hash(name):
+    """
+    Returns (hash function of one sentence, hash function of a list of sentences) for a name in sentence_hashes.
+    Both take utf-8 bytes and give 8 byte digests, the batch version as a list.
+    """
+    if name not in sentence_hashes:
+        raise ValueError(f"unknown sentence_hash {name}, choose from {sorted(sentence_hashes)}")
+    return sentence_hashes[name]()
+
+
+def hash_manifest_file(directory):
+    return f"{directory}/hash_manifest.json"
+
+
+def check_hash_manifest(directory, name):
+    """
+    Refuses (SystemExit) to use directory with sentence hash name if the hashes in it were made with another one.
+    A directory with files but without manifest holds md5 hashes from before the manifest existed.
+    """
+    manifest_file = hash_manifest_file(directory)
+    found = None
+    if os.path.isfile(manifest_file):
+        with open(manifest_file, "r") as fin:
+            found = json.load(fin)["sentence_hash"]
+    elif os.path.isdir(directory) and os.listdir(directory):
+        found = "md5"
+    if found is not None and found != name:
+        raise SystemExit(
+            f"{directory} holds {found} sentence hashes, but sentence_hash is {name} in config.py: "
+            f"set it back to {found} or delete {directory} and the steps after it"
+        )
+
+
+def read_hash_manifest(directory):
+    # the manifest of directory, {} if it has none
+    manifest_file = hash_manifest_file(directory)
+    if not os.path.isfile(manifest_file):
+        return dict()
+    with open(manifest_file, "r") as fin:
+        return json.load(fin)
+
+
+def write_hash_manifest(directory, name, **fields):
+    """
+    Writes the manifest of directory with sentence hash name, plus fields about how its data was made (binned_data
+    records pre_dedup)
+    """
+    pathlib.Path(directory).mkdir(parents=True, exist_ok=True)
+    manifest_file = hash_manifest_file(directory)
+    with open(f"{manifest_file}.part", "w") as fout:
+        json.dump(dict(sentence_hash=name, digest_bytes=8, **fields), fout)
+    os.replace(f"{manifest_file}.part", manifest_file)
+
+
+def clean_sentence(sent):
+    # text of a sentence in hash2sent/
+    return sent.replace("\n", " ").replace("\t", " ").strip() + "\n"
+
+
 def myhash2int(hh):
     assert len(hh) == 8
     return int.from_bytes(hh, byteorder='little', signed=True)
@@ -36,3 +147,540 @@ def entry_to_row_score(entry):
     row = int.from_bytes(bytes[:7], byteorder='little', signed=False)
     score = int.from_bytes(bytes[7:], byteorder='little', signed=False)
     return row, score
+
+
+def score_bin_edges(scores_count, total_rows, num_score_bins):
+    """
+    Given a Counter of quantized scores, returns the sorted quantized scores at which a new bin starts,
+    such that bins have roughly total_rows / num_score_bins rows each
+    """
+    rows_per_bin = math.ceil(
+        total_rows / num_score_bins
+    )  # this is approximate since the distribution for each score is not uniform
+    print(f"Rows per bin: {rows_per_bin}")
+
+    all_scores = list(scores_count.keys())
+    all_scores.sort()
+
+    bin_edges = {}
+    rows_in_bin = 0
+    for ii, score in enumerate(
+        all_scores
+    ):  # we may end up with more than num_score_bins but this will ensure no bin has disproportionately high examples
+        if ii == len(all_scores) - 1:  # last score
+            bin_edges[score] = rows_in_bin + scores_count[score]
+        elif rows_in_bin + scores_count[score] > rows_per_bin:
+            bin_edges[score] = rows_in_bin
+            rows_in_bin = scores_count[score]
+        else:
+            rows_in_bin += scores_count[score]
+
+    print(f"Number of bins: {len(bin_edges)}", flush=True)
+
+    edges = list(bin_edges.keys())
+    edges.sort()
+    edges.pop()
+    return edges
+
+
+def write_cutoffs(fname, cutoffs):
+    with open(fname, "w") as fw:
+        for c in cutoffs:
+            fw.write(f"{c}\n")
+
+
+def save_score_hist(fname, scores_count, bin_edge_prec, exact=True):
+    """
+    Saves a Counter of quantized scores (int(score * bin_edge_prec) -> rows) as npz of sorted keys and their counts.
+    exact is False if the counts were estimated (sampled or sketched)
+    """
+    keys = sorted(scores_count)
+    with open(f"{fname}.part", "wb") as fout:
+        np.savez(
+            fout,
+            keys=np.array(keys, dtype=np.int64),
+            counts=np.array([scores_count[key] for key in keys], dtype=np.int64),
+            bin_edge_prec=bin_edge_prec,
+            exact=exact,
+        )
+    os.replace(f"{fname}.part", fname)
+
+
+def load_score_hist(fname):
+    """
+    Returns (Counter of quantized scores, bin_edge_prec, exact) saved by save_score_hist()
+    """
+    with np.load(fname) as hist:
+        scores_count = Counter(dict(zip(hist["keys"].tolist(), hist["counts"].tolist())))
+        return scores_count, int(hist["bin_edge_prec"]), bool(hist["exact"])
+
+
+def table_capacities(plan_file):
+    """
+    Returns lang -> capacity of its hash maps from the table plan made by plan_table.py, {} if there is none
+    """
+    if not os.path.isfile(plan_file):
+        return dict()
+    with open(plan_file, "r") as fin:
+        return {lang: entry["capacity"] for lang, entry in json.load(fin)["langs"].items()}
+
+
+# Binned data: binNNN.bin files of (h0, h1) records, the two int64 sentence hashes of a row, in raw data order.
+# With fused_binning, 02_hash_and_bin.py first writes scored.NNNNNNN.bin files of (h0, h1, score_key) records.
+hash_pair_dtype = np.dtype([("h0", "<i8"), ("h1", "<i8")])
+scored_dtype = np.dtype([("h0", "<i8"), ("h1", "<i8"), ("key", "<i4")])
+
+
+def digests_to_int64(digests):
+    # list of 8 byte digests -> int64 array with the same bytes
+    return np.frombuffer(b"".join(digests), dtype="<i8")
+
+
+class BinWriter:
+    """
+    Writes numpy records to one file per bin. Records are buffered per bin and appended to the file with tofile()
+    every buffer_rows records, so the memory used is fixed: num bins * buffer_rows * dtype.itemsize bytes.
+    The records of a bin are written in the order they were given.
+    """
+
+    def __init__(self, fnames, dtype, buffer_rows):
+        self.fouts = [open(fname, "wb") for fname in fnames]
+        self.buffers = [np.empty(buffer_rows, dtype=dtype) for _ in fnames]
+        self.sizes = [0] * len(fnames)
+
+    def write(self, records, bins=None):
+        """
+        Appends records[ii] to the file of bin bins[ii], bins=None if there is a single file
+        """
+        if bins is None:
+            self._append(0, records)
+            return
+        order = np.argsort(bins, kind="stable")
+        sorted_bins = bins[order]
+        records = records[order]
+        present, starts = np.unique(sorted_bins, return_index=True)
+        stops = np.append(starts[1:], len(records))
+        for bin_idx, start, stop in zip(present.tolist(), starts.tolist(), stops.tolist()):
+            self._append(bin_idx, records[start:stop])
+
+    def _append(self, bin_idx, records):
+        buffer = self.buffers[bin_idx]
+        size = self.sizes[bin_idx]
+        while len(records):
+            num = min(len(buffer) - size, len(records))
+            buffer[size : size + num] = records[:num]
+            records = records[num:]
+            size += num
+            if size == len(buffer):
+                buffer.tofile(self.fouts[bin_idx])
+                size = 0
+        self.sizes[bin_idx] = size
+
+    def close(self):
+        for fout, buffer, size in zip(self.fouts, self.buffers, self.sizes):
+            buffer[:size].tofile(fout)
+            fout.close()
+
+
+# With bin_layout = "containers" the bins of all lang pairs are merged into one container per score bin,
+# binned_data/binNNN.bin, holding one segment of (h0, h1) records per lang pair (in lang pair name order), plus a
+# sidecar index "binNNN.bin.idx" of int64 (pair id, offset, num records) triples, one per segment.
+# The pair id is the position of the lang pair in CCMATRIX_LANG_PAIRS.
+
+
+def bin_file(directory, bin_idx):
+    return f"{directory}/bin{bin_idx:03}.bin"
+
+
+def write_container_index(path, segments):
+    # segments: [(pair id, offset, num records), ...]
+    values = array("q", [value for segment in segments for value in segment])
+    idx_file = block_index_file(path)
+    with open(f"{idx_file}.part", "wb") as fout:
+        fout.write(values.tobytes())
+    os.replace(f"{idx_file}.part", idx_file)
+
+
+def read_container_index(path):
+    """
+    Returns [(pair id, offset, num records), ...] for every segment of a bin container, or None if it has no index
+    """
+    values = _read_index(path)
+    # a container of another run than its index does not end after the last segment
+    if values is None or (values[-2] + values[-1] * hash_pair_dtype.itemsize if values else 0) != os.stat(path).st_size:
+        return None
+    return [tuple(values[ii : ii + 3]) for ii in range(0, len(values), 3)]
+
+
+def container_files(bin_dir):
+    return sorted(glob(f"{bin_dir}/bin[0-9][0-9][0-9].bin"))
+
+
+def bin_segments(bin_dir):
+    """
+    Returns [(score bin, lang pair, file name, offset, num records), ...] of binned_data in the order
+    03_build_table.py reads them: highest score bin first, lang pairs in name order within a bin.
+    Works for both bin layouts, the containers are used if there are any.
+    """
+    segments = []
+    containers = container_files(bin_dir)
+    if containers:
+        for fname in containers:
+            score_bin = int(os.path.basename(fname)[len("bin") : -len(".bin")])
+            index = read_container_index(fname)
+            if index is None:
+                raise IOError(f"{fname} has no index, re-run 02_hash_and_bin.py")
+            for pair_id, offset, num_records in index:
+                segments.append((score_bin, CCMATRIX_LANG_PAIRS[pair_id], fname, offset, num_records))
+    else:
+        for fname in glob(f"{bin_dir}/*/bin[0-9][0-9][0-9].bin"):
+            score_bin = int(os.path.basename(fname)[len("bin") : -len(".bin")])
+            lang_pair = os.path.basename(os.path.dirname(fname))
+            segments.append((score_bin, lang_pair, fname, 0, os.stat(fname).st_size // hash_pair_dtype.itemsize))
+    segments.sort(key=lambda segment: (-segment[0], segment[1]))
+    return segments
+
+
+# Block-indexed raw data: a gzip file made of independently compressed members ("blocks"), each holding whole lines,
+# plus a sidecar index "<file>.idx" of int64 (offset, compressed size, num lines) triples, one per block.
+# The data file is still a valid (multi-member) gzip file, so plain gzip.open() reads it start to end.
+
+
+def block_index_file(path):
+    return f"{path}.idx"
+
+
+def _read_index(path):
+    # the int64 values of the sidecar index of path (a block index or a container index), None if there is none
+    idx_file = block_index_file(path)
+    if not os.path.isfile(idx_file):
+        return None
+    values = array("q")
+    with open(idx_file, "rb") as fin:
+        values.frombytes(fin.read())
+    return values
+
+
+def read_block_index(path):
+    """
+    Returns [(offset, compressed size, num lines), ...] for every block of path, or None if path has no index
+    """
+    values = _read_index(path)
+    # an index whose blocks do not end at the end of path belongs to a transcode not renamed into place yet
+    if values is None or (values[-3] + values[-2] if values else 0) != os.stat(path).st_size:
+        return None
+    return [tuple(values[ii : ii + 3]) for ii in range(0, len(values), 3)]
+
+
+class BlockWriter:
+    """
+    Writes bytes as gzip blocks of at least block_size uncompressed bytes, always cut after a newline.
+    Data and index are written to .part files and renamed on close().
+    """
+
+    def __init__(self, path, block_size, compresslevel=6):
+        self.path = path
+        self.block_size = block_size
+        self.compresslevel = compresslevel
+        self.fout = open(f"{path}.part", "wb")
+        self.index = array("q")
+        self.offset = 0
+        self.buffer = bytearray()
+
+    def write(self, data):
+        self.buffer += data
+        if len(self.buffer) >= self.block_size:
+            cut = self.buffer.rfind(b"\n") + 1
+            if cut:  # else a single line longer than block_size, wait for its end
+                self._write_block(self.buffer[:cut])
+                del self.buffer[:cut]
+
+    def _write_block(self, data):
+        compressed = gzip.compress(data, compresslevel=self.compresslevel, mtime=0)
+        self.fout.write(compressed)
+        num_lines = data.count(b"\n") + (not data.endswith(b"\n"))
+        self.index.extend((self.offset, len(compressed), num_lines))
+        self.offset += len(compressed)
+
+    def close(self, replace=True):
+        """
+        Writes the rest and the index. With replace=False both stay .part files, for the caller to rename
+        """
+        if self.buffer:
+            self._write_block(self.buffer)
+            self.buffer = bytearray()
+        self.fout.close()
+        idx_file = block_index_file(self.path)
+        with open(f"{idx_file}.part", "wb") as fout:
+            fout.write(self.index.tobytes())
+        if replace:
+            os.replace(f"{self.path}.part", self.path)
+            os.replace(f"{idx_file}.part", idx_file)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class _FileRange(io.RawIOBase):
+    # read-only view of bytes [start, start + length) of a file
+
+    def __init__(self, path, start, length):
+        super().__init__()
+        self.fin = open(path, "rb")
+        self.fin.seek(start)
+        self.left = length
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        view = memoryview(buffer)[: self.left]
+        num_read = self.fin.readinto(view)
+        self.left -= num_read
+        return num_read
+
+    def close(self):
+        self.fin.close()
+        super().close()
+
+
+def open_blocks(path, start=0, stop=None, mode="rb", encoding="utf-8"):
+    """
+    Opens blocks [start, stop) of a block-indexed gz file for reading, like gzip.open().
+    Without start/stop the whole file is opened and no index is needed.
+    """
+    if start == 0 and stop is None:
+        return gzip.open(path, mode, encoding=None if "b" in mode else encoding)
+    index = read_block_index(path)
+    if index is None:
+        raise ValueError(f"{path} has no block index, transcode it with transcode_blocks.py")
+    blocks = index[start:stop]
+    begin = blocks[0][0] if blocks else 0
+    end = blocks[-1][0] + blocks[-1][1] if blocks else 0
+    raw = io.BufferedReader(_FileRange(path, begin, end - begin), buffer_size=2**20)
+    binary = gzip.GzipFile(fileobj=raw, mode="rb")
+    binary.myfileobj = raw  # so closing the gzip stream closes the file too
+    if "b" in mode:
+        return binary
+    return io.TextIOWrapper(binary, encoding=encoding)
+
+
+def open_task(gz_file, blocks, mode="rb", encoding="utf-8"):
+    """
+    Opens the part of gz_file covered by a task: blocks is a (start, stop) block range or None for the whole file
+    """
+    if blocks is None:
+        return open_blocks(gz_file, mode=mode, encoding=encoding)
+    return open_blocks(gz_file, *blocks, mode=mode, encoding=encoding)
+
+
+def task_name(lang_pair, blocks):
+    return lang_pair if blocks is None else f"{lang_pair}[{blocks[0]}:{blocks[1]}]"
+
+
+# Sentence locators: int64 positions of sentences in block-indexed raw data, written by 02_hash_and_bin.py with
+# sentence_locators so that 04_build_hash2sent.py only reads the lines it needs. From the highest bits to the lowest:
+# pair id (11 bits, position in CCMATRIX_LANG_PAIRS), side (0 for the first language of the pair), block (24 bits)
+# and line in the block (27 bits). A task's locator file holds (hash, locator) records of the first occurrence of
+# every sentence of one language in the task, in raw data order.
+
+locator_dtype = np.dtype([("hash", "<i8"), ("loc", "<i8")])
+locator_block_bits = 24
+locator_line_bits = 27
+
+
+def pack_locators(pair_id, side, blocks, lines):
+    return (((pair_id * 2 + side) << locator_block_bits | blocks) << locator_line_bits) | lines
+
+
+def unpack_locators(locs):
+    # (pair ids, sides, blocks, lines)
+    lines = locs & (2**locator_line_bits - 1)
+    blocks = (locs >> locator_line_bits) & (2**locator_block_bits - 1)
+    pair_side = locs >> (locator_line_bits + locator_block_bits)
+    return pair_side >> 1, pair_side & 1, blocks, lines
+
+
+def locator_file(directory, lang_pair, start, lang):
+    return f"{directory}/{lang_pair}/{start:07}.{lang}.loc"
+
+
+# Chunked parsing of raw "score\tsrc\ttgt" lines with numpy. Lines are located and their scores converted a whole chunk
+# at a time. A line is "regular" if line.strip().split("\t") on its decoded text gives exactly the fields between its
+# two tabs: two tabs, no "\r" (a line break in text mode), no whitespace at either end and a plain decimal score.
+# Everything else goes through legacy_rows(), so the result is the same as reading the file in text mode line by line.
+
+_ascii_space = np.zeros(256, dtype=bool)
+_ascii_space[[c for c in range(128) if chr(c).isspace()]] = True
+_not_leading = _ascii_space.copy()
+_not_leading[128:] = True  # scores are ascii, a non-ascii first byte may be unicode whitespace
+_score_chars = np.zeros(256, dtype=bool)
+_score_chars[list(b"0123456789.eE+-")] = True
+_unicode_space = [chr(c).encode("utf-8") for c in range(128, 0x3001) if chr(c).isspace()]  # none above U+3000
+_space_suffix2 = np.array([int.from_bytes(x, "big") for x in _unicode_space if len(x) == 2], dtype=np.int64)
+_space_suffix3 = np.array([int.from_bytes(x, "big") for x in _unicode_space if len(x) == 3], dtype=np.int64)
+max_score_len = 32  # longer score fields are parsed by legacy_rows()
+
+
+def _space_before(buf, ends):
+    # whether the character before each position is whitespace
+    last = buf[np.maximum(ends - 1, 0)].astype(np.int64)
+    last2 = buf[np.maximum(ends - 2, 0)].astype(np.int64)
+    last3 = buf[np.maximum(ends - 3, 0)].astype(np.int64)
+    return (
+        _ascii_space[last]
+        | np.isin(last2 << 8 | last, _space_suffix2)
+        | np.isin(last3 << 16 | last2 << 8 | last, _space_suffix3)
+    )
+
+
+def _space_at(buf, starts):
+    # whether the character at each position is whitespace
+    first = buf[np.minimum(starts, len(buf) - 1)].astype(np.int64)
+    second = buf[np.minimum(starts + 1, len(buf) - 1)].astype(np.int64)
+    third = buf[np.minimum(starts + 2, len(buf) - 1)].astype(np.int64)
+    return (
+        _ascii_space[first]
+        | np.isin(first << 8 | second, _space_suffix2)
+        | np.isin(first << 16 | second << 8 | third, _space_suffix3)
+    )
+
+
+def read_chunks(fin, chunk_size):
+    """
+    Reads a binary file in chunks of about chunk_size bytes that end with a newline (one is added to the last line if
+    it has none)
+    """
+    rest = b""
+    while True:
+        data = fin.read(chunk_size)
+        if not data:
+            break
+        data = rest + data
+        cut = data.rfind(b"\n") + 1
+        rest = data[cut:]
+        if cut:
+            yield data[:cut]
+    if rest:
+        yield rest + b"\n"
+
+
+def parse_chunk(data):
+    """
+    Locates the lines and fields of a chunk from read_chunks().
+    Returns int64 arrays (line start, position of its newline, first tab, second tab), the float64 scores and a bool
+    array of regular lines. Fields and scores are only meaningful for regular lines.
+    """
+    buf = np.frombuffer(data, dtype=np.uint8)
+    ends = np.flatnonzero(buf == 10)
+    starts = np.empty_like(ends)
+    starts[:1] = 0
+    starts[1:] = ends[:-1] + 1
+
+    tabs = np.flatnonzero(buf == 9)
+    tab_line = np.searchsorted(ends, tabs)
+    num_tabs = np.bincount(tab_line, minlength=len(ends))
+    first = np.minimum(np.searchsorted(tab_line, np.arange(len(ends))), max(len(tabs) - 2, 0))
+    tab1 = tabs[first] if len(tabs) >= 2 else np.zeros_like(ends)
+    tab2 = tabs[first + 1] if len(tabs) >= 2 else np.zeros_like(ends)
+
+    regular = num_tabs == 2
+    regular &= np.bincount(np.searchsorted(ends, np.flatnonzero(buf == 13)), minlength=len(ends)) == 0
+    regular &= ~_not_leading[buf[starts]]
+    regular &= ~_space_before(buf, ends)
+
+    score_len = tab1 - starts
+    regular &= (score_len > 0) & (score_len <= max_score_len)
+    width = int(score_len[regular].max()) if regular.any() else 1
+    # (lines, width) bytes from the start of each line, without an index array per byte
+    padded = np.concatenate([buf, np.zeros(width, dtype=np.uint8)])
+    score_bytes = np.lib.stride_tricks.sliding_window_view(padded, width)[starts]
+    in_score = np.arange(width) < score_len[:, None]
+    score_bytes[~in_score] = 0
+    regular &= (_score_chars[score_bytes] | ~in_score).all(axis=1)
+
+    score_bytes[~regular] = ord("0")
+    scores = score_bytes.view(f"S{width}").ravel()
+    try:
+        scores = scores.astype(np.float64)
+    except ValueError:  # malformed numbers like "1.2.3", leave them to float() in legacy_rows()
+        scores = np.array([_to_float(x) for x in scores.tolist()])
+        regular &= ~np.isnan(scores)
+    return starts, ends, tab1, tab2, scores, regular
+
+
+def score_keys(scores, bin_edge_prec):
+    """
+    config.score_key() of an array of scores
+    """
+    quantized = (scores * bin_edge_prec).astype(np.int64)
+    grid = quantized / bin_edge_prec
+    return 2 * quantized + (scores > grid).astype(np.int64) - (scores < grid)
+
+
+def _to_float(score):
+    try:
+        return float(score)
+    except ValueError:
+        return np.nan
+
+
+def plain_fields(data, starts, ends):
+    """
+    Bool array of the fields data[start:end] of a chunk that are not empty and do not start or end with whitespace,
+    i.e. that str.strip() would not change
+    """
+    buf = np.frombuffer(data, dtype=np.uint8)
+    return (ends > starts) & ~_space_at(buf, starts) & ~_space_before(buf, ends)
+
+
+def invalid_lines(data, starts, ends, policy):
+    """
+    Bool array of the lines of a chunk that are not valid UTF-8, or None if they all are. The chunk is validated with
+    a single decode (skipped if it is ASCII). With policy "strict" invalid UTF-8 raises UnicodeDecodeError, like
+    reading the file in text mode did.
+    """
+    if _is_ascii(data):
+        return None
+    try:
+        str(data, "utf-8")
+        return None
+    except UnicodeDecodeError:
+        if policy == "strict":
+            raise
+    return np.array([not _is_utf8(data[start:end]) for start, end in zip(starts.tolist(), ends.tolist())])
+
+
+def _is_ascii(data):
+    # chunks are bytes, or memoryviews of a ring buffer (see pipeline.py)
+    if isinstance(data, bytes):
+        return data.isascii()
+    return len(data) == 0 or np.frombuffer(data, dtype=np.uint8).max() < 128
+
+
+def _is_utf8(data):
+    try:
+        str(data, "utf-8")
+        return True
+    except UnicodeDecodeError:
+        return False
+
+
+def text_errors(policy):
+    """
+    Error handler for decoding lines that are not regular with an invalid_utf8 policy: "surrogateescape" keeps invalid
+    bytes, so text.encode("utf-8", errors) gives back the bytes of the line
+    """
+    return "strict" if policy == "strict" else "surrogateescape"
+
+
+def legacy_rows(line, errors="strict"):
+    """
+    Rows of a raw line (bytes or a memoryview) that is not regular, exactly as reading it in text mode and splitting it would give:
+    "\r" also ends a line there
+    """
+    for text in io.StringIO(str(line, "utf-8", errors), newline=None):
+        yield text.strip().split("\t")